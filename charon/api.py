@@ -2,7 +2,11 @@
 
 import json
 import logging
+import math
+import time
+import urllib.parse
 
+import tornado.iostream
 import tornado.web
 import couchdb
 import requests
@@ -10,6 +14,8 @@ import requests
 from . import constants
 from . import settings
 from . import utils
+from . import cache
+from . import metrics
 from .requesthandler import RequestHandler
 from .user import UserSaver
 
@@ -33,20 +39,160 @@ class ApiRequestHandler(RequestHandler):
         except KeyError:
             self.send_error(401, reason='API token missing')
         else:
-            rows = list(self.db.view('user/api_token')[api_token])
-            if len(rows) != 1:
+            user = self.get_api_token_user(api_token)
+            if user is None:
                 self.send_error(401, reason='invalid API token')
+            elif user.get('status') == constants.ACTIVE:
+                self._user = user
+                logging.debug("API token user '%s'", user['email'])
             else:
-                try:
-                    user = self.get_user(rows[0].value)
-                except KeyError:
-                    self.send_error(401, reason='invalid user email')
+                self.send_error(401, reason='user not active')
+
+    def is_ndjson(self):
+        """Did the client ask for NDJSON, by the 'Accept' header
+        or by the 'format' query argument?"""
+        if self.get_argument('format', None) == 'ndjson': return True
+        accept = self.request.headers.get('Accept', '')
+        return constants.NDJSON_MIME in accept
+
+    async def write_stream(self, docs, key=None, add_links=None):
+        """Write the documents from the asynchronous iterable as they
+        arrive, flushing every constants.STREAM_FLUSH_ROWS documents.
+        As NDJSON, one document per line, if the client asked for it.
+        Otherwise as JSON; a list in a dictionary under the key, if given,
+        else a bare list. Add the links to each document, if given.
+        If an error occurs after the first flush, the connection is
+        closed, so that the truncated response is not complete."""
+        ndjson = self.is_ndjson()
+        if ndjson:
+            self.set_header('Content-Type', constants.NDJSON_MIME)
+        else:
+            self.set_header('Content-Type',
+                            constants.JSON_MIME + '; charset=UTF-8')
+            self.write(key and '{{"{0}": ['.format(key) or '[')
+        count = 0
+        try:
+            async for doc in docs:
+                if add_links:
+                    add_links(doc)
+                with metrics.timer('serialize'):
+                    doc = json.dumps(doc)
+                if ndjson:
+                    self.write(doc + '\n')
+                elif count:
+                    self.write(', ' + doc)
                 else:
-                    if user.get('status') == constants.ACTIVE:
-                        self._user = user
-                        logging.debug("API token user '%s'", user['email'])
-                    else:
-                        self.send_error(401, reason='user not active')
+                    self.write(doc)
+                count += 1
+                if count % constants.STREAM_FLUSH_ROWS == 0:
+                    await self.flush()
+        except Exception as msg:
+            if not self._headers_written: raise
+            # Part of the response has been sent; close the connection
+            # without ending it, so the client cannot take it as complete.
+            logging.error("stream %s aborted after %s items: %s",
+                          self.request.uri, count, msg)
+            self.request.connection.close()
+            raise tornado.web.Finish()
+        if not ndjson:
+            self.write(key and ']}' or ']')
+
+    def get_cursor_options(self, options, cursor):
+        """Return the view query options for the range starting at the
+        position given by the cursor, if any. For an array key range,
+        the cursor must lie within the part of the key common to the
+        startkey and endkey. Raise ValueError if the cursor is invalid."""
+        if not cursor: return options
+        key, docid = utils.decode_cursor(cursor)
+        startkey = options.get('startkey')
+        endkey = options.get('endkey')
+        if isinstance(startkey, (list, tuple)):
+            prefix = []
+            for low, high in zip(startkey, endkey):
+                if low != high: break
+                prefix.append(low)
+            if not isinstance(key, list) or key[:len(prefix)] != prefix:
+                raise ValueError('cursor does not belong to this list')
+        options = options.copy()
+        options['startkey'] = key
+        options['startkey_docid'] = docid
+        return options
+
+    async def get_page(self, viewname, options, limit, prepare=None):
+        """Return the documents of at most 'limit' rows from the view range,
+        and the cursor for the first row of the next page, or None if no
+        more rows. The documents are passed to the coroutine 'prepare',
+        if given, to add any data to them."""
+        rows = await self.async_db.view(viewname, include_docs=True,
+                                        limit=limit + 1, **options)
+        docs = [row.doc for row in rows[:limit]]
+        if prepare:
+            await prepare(docs)
+        if len(rows) > limit:
+            cursor = utils.encode_cursor(rows[limit].key, rows[limit].id)
+        else:
+            cursor = None
+        return docs, cursor
+
+    async def iter_pages(self, viewname, options, prepare=None):
+        """Yield all documents from the view range, read page by page.
+        The documents of each page are passed to the coroutine 'prepare'."""
+        cursor = None
+        while True:
+            docs, cursor = await self.get_page(
+                viewname, self.get_cursor_options(options, cursor),
+                constants.MAX_PAGE_LIMIT, prepare=prepare)
+            for doc in docs:
+                yield doc
+            if not cursor: return
+
+    def get_next_url(self, cursor):
+        "Return the URL of this request with the cursor for the next page."
+        args = dict([(name, self.get_argument(name))
+                     for name in self.request.query_arguments])
+        args['cursor'] = cursor
+        return settings['BASE_URL'].rstrip('/') + self.request.path + \
+            '?' + urllib.parse.urlencode(args)
+
+    async def write_page(self, viewname, options, key, add_links=None,
+                         prepare=None):
+        """Write the documents from the view range given by the options.
+        If the query argument 'limit' or 'cursor' is given, then write one
+        page of documents, from the position given by the cursor; the
+        cursor and the link for the next page are included in the response,
+        or in the 'Link' header for NDJSON. Otherwise stream all documents.
+        Raise HTTP 400 if the limit or cursor is invalid."""
+        cursor = self.get_argument('cursor', None)
+        if cursor is None and self.get_argument('limit', None) is None:
+            if prepare:
+                docs = self.iter_pages(viewname, options, prepare=prepare)
+            else:
+                docs = (row.doc async for row in
+                        self.async_db.iterview(viewname, include_docs=True,
+                                               **options))
+            await self.write_stream(docs, key=key, add_links=add_links)
+            return
+        try:
+            limit = self.get_limit()
+            options = self.get_cursor_options(options, cursor)
+        except ValueError as msg:
+            raise tornado.web.HTTPError(400, reason=str(msg))
+        docs, cursor = await self.get_page(viewname, options, limit,
+                                           prepare=prepare)
+        if add_links:
+            for doc in docs:
+                add_links(doc)
+        links = []
+        if cursor:
+            links.append(dict(rel='next', href=self.get_next_url(cursor)))
+        if self.is_ndjson():
+            self.set_header('Content-Type', constants.NDJSON_MIME)
+            for link in links:
+                self.add_header('Link', '<{href}>; rel="{rel}"'.format(**link))
+            for doc in docs:
+                self.write(json.dumps(doc) + '\n')
+        else:
+            self.write({key: docs, 'cursor': cursor, 'links': links})
 
     def add_link(self, doc, rel, name, *args):
         """Add a link to JSON representation of an entity.
@@ -106,20 +252,125 @@ class ApiRequestHandler(RequestHandler):
 class ApiDocument(ApiRequestHandler):
     "Access a database document as is."
 
-    def get(self, id):
+    async def get(self, id):
         "Return a database document as is."
         try:
-            self.write(self.db[id])
+            self.write(await self.async_db.get(id))
         except couchdb.http.ResourceNotFound:
             self.send_error(404, reason='no such item')
 
 
+class ApiChanges(ApiRequestHandler):
+    """Access the changes of project, sample, libprep and seqrun documents,
+    for synchronizing incrementally instead of fetching all entities."""
+
+    DOCTYPES = [constants.PROJECT, constants.SAMPLE,
+                constants.LIBPREP, constants.SEQRUN]
+
+    async def get(self):
+        """Return the documents changed since the position given by the
+        opaque token in the query argument 'since'; from the beginning
+        if none, or from the present if 'now'. The query argument
+        'doctype' selects one type of entity. At most 'limit' changes
+        are returned; default 100, max 1000.
+        The 'feed' query argument is one of:
+        'normal' (default): a dictionary with the list of changes, and
+        the token 'since' to use for the next call.
+        'longpoll': the same, waiting up to 'timeout' seconds (default 60,
+        max 3600) for a change if there is none.
+        'continuous': NDJSON, one change per line as it occurs, an empty
+        line every 30 seconds without any, and a last line with the token
+        'since' after 'timeout' seconds.
+        Each change has the 'id' and the token 'seq' for its position, and
+        the 'doc', or 'deleted' true for a deleted document of any type.
+        Return HTTP 400 if any argument is invalid."""
+        try:
+            since = self.get_argument('since', None)
+            if since is None:
+                since = 0
+            elif since != 'now':
+                since = utils.decode_token(since)
+                if isinstance(since, bool) or \
+                   not isinstance(since, (str, int)):
+                    raise ValueError('invalid token')
+            feed = self.get_argument('feed', 'normal')
+            if feed not in ('normal', 'longpoll', 'continuous'):
+                raise ValueError("invalid feed '{0}'".format(feed))
+            doctype = self.get_argument('doctype', None)
+            if doctype is not None and doctype not in self.DOCTYPES:
+                raise ValueError("invalid doctype '{0}'".format(doctype))
+            timeout = float(self.get_argument('timeout',
+                                              constants.CHANGES_TIMEOUT))
+            if not math.isfinite(timeout) or timeout < 0:
+                raise ValueError('timeout must be a non-negative number')
+            timeout = min(timeout, constants.CHANGES_MAX_TIMEOUT)
+            limit = self.get_limit()
+        except ValueError as msg:
+            raise tornado.web.HTTPError(400, reason=str(msg))
+        options = dict(filter='internal/entities',
+                       include_docs=True,
+                       since=since,
+                       limit=limit)
+        if doctype:
+            options['doctype'] = doctype
+        if feed == 'continuous':
+            await self.write_continuous(options, timeout)
+            return
+        if feed == 'longpoll':
+            options['feed'] = 'longpoll'
+            options['timeout'] = int(timeout * 1000)
+        data = await self.async_db.changes(**options)
+        self.write(dict(changes=[self.get_change(r) for r in data['results']],
+                        since=utils.encode_token(data['last_seq'])))
+
+    async def write_continuous(self, options, timeout):
+        """Write each change as a line of NDJSON, and an empty line when
+        there has been none for constants.CHANGES_HEARTBEAT seconds,
+        by long-polling the database, until the timeout has passed or
+        the client has closed the connection."""
+        self.set_header('Content-Type', constants.NDJSON_MIME)
+        options['feed'] = 'longpoll'
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            options['timeout'] = int(min(constants.CHANGES_HEARTBEAT,
+                                         remaining) * 1000)
+            data = await self.async_db.changes(**options)
+            for row in data['results']:
+                self.write(json.dumps(self.get_change(row)) + '\n')
+            if not data['results']:
+                self.write('\n')
+            options['since'] = data['last_seq']
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+        self.write(json.dumps(dict(since=utils.encode_token(options['since'])))
+                   + '\n')
+
+    def get_change(self, row):
+        "Return the change for the row of the changes feed."
+        change = dict(id=row['id'], seq=utils.encode_token(row['seq']))
+        if row.get('deleted'):
+            change['deleted'] = True
+        else:
+            doc = row['doc']
+            add_links = {constants.PROJECT: self.add_project_links,
+                         constants.SAMPLE: self.add_sample_links,
+                         constants.LIBPREP: self.add_libprep_links,
+                         constants.SEQRUN: self.add_seqrun_links}
+            add_links[doc[constants.DB_DOCTYPE]](doc)
+            change['doc'] = doc
+        return change
+
+
 class ApiLogs(ApiRequestHandler):
     "Access log event documents for a given document."
 
-    def get(self, id):
+    async def get(self, id):
         "Return all log event documents for a given document."
-        self.write(dict(logs=self.get_logs(id)))
+        self.write(dict(logs=await self.get_logs(id)))
 
 
 class ApiNotify(ApiRequestHandler):
@@ -130,7 +381,7 @@ class ApiNotify(ApiRequestHandler):
     def check_api_access(self):
         pass
 
-    def post(self):
+    async def post(self):
         """Handle 'user' event; fetch new data.
         Userman is the authentication server."""
         logging.debug('API notify')
@@ -160,7 +411,8 @@ class ApiNotify(ApiRequestHandler):
                 data = response.json()
                 user = self.get_user(data['email'])
                 user.update(data)
-                with UserSaver(doc=user, rqh=self):
+                async with UserSaver(doc=user, rqh=self):
                     pass            # Changes already made.
+                cache.tokens.evict_user(user['_id'])
             except Exception as msg:
                 logging.debug("API notify request error: %s", msg)
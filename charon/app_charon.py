@@ -7,7 +7,11 @@ import tornado.web
 import couchdb
 
 from charon import constants
+from charon import settings
 from charon import utils
+from charon import cache
+from charon import summary
+from charon import search
 from charon import uimodules
 from charon.requesthandler import RequestHandler
 
@@ -18,6 +22,7 @@ from charon.sample import *
 from charon.libprep import *
 from charon.seqrun import *
 from charon.api import *
+from charon.bulk import *
 
 
 class Dummy(RequestHandler):
@@ -67,6 +72,8 @@ handlers = \
      URL(r'/api/v1/project', ApiProjectCreate, name='api_project_create'),
      URL(r'/api/v1/project/(?P<projectid>[^/]+)',
          ApiProject, name='api_project'),
+     URL(r'/api/v1/project/(?P<projectid>[^/]+)/update',
+         ApiProjectSamplesUpdate, name='api_project_update'),
      URL(r'/api/v1/projects', ApiProjects, name='api_projects'),
      URL(r'/api/v1/projectidsfromsampleid/(?P<sampleid>[^/]+)', ApiProjectsFromSampleIds, name='api_projectidsfromsampleid'),
      URL(r'/api/v1/sample/(?P<projectid>[^/]+)',
@@ -94,6 +101,10 @@ handlers = \
      URL(r'/api/v1/seqruns/(?P<projectid>[^/]+)/(?P<sampleid>[^/]+)/(?P<libprepid>[^/]+)',
          ApiLibprepSeqruns, name='api_libprep_seqruns'),
      URL(r'/api/v1/version', ApiVersion, name='api_version'),
+     URL(r'/api/v1/stats', ApiStatistics, name='api_stats'),
+     URL(r'/api/v1/metrics', ApiMetrics, name='api_metrics'),
+     URL(r'/api/v1/bulk', ApiBulk, name='api_bulk'),
+     URL(r'/api/v1/changes', ApiChanges, name='api_changes'),
      URL(r'/api/v1/doc/([a-f0-9]{32})', ApiDocument, name='api_doc'),
      URL(r'/api/v1/logs/([a-f0-9]{32})', ApiLogs, name='api_logs'),
      URL(r'/api/v1/notify', ApiNotify, name='api_notify'),
@@ -105,18 +116,14 @@ handlers = \
      URL(r'/api/v1/samplesnotdone', ApiSamplesNotDone, name='api_samples_not_done'),
      URL(r'/api/v1/samplesnotdone/(?P<projectid>[^/]+)', ApiSamplesNotDonePerProject, name='api_samples_not_done_per_project'),
      URL(r'/api/v1/seqrunsdone', ApiSeqrunsDone, name='api_seqruns_done'),
+     URL(r'/api/v1/samplesearch', ApiSampleSearch, name='api_sample_search'),
      URL(r'/api/v1/customquery', ApiSamplesCustomQuery, name='api_custom_query'),
      ]
 
 
-if __name__ == "__main__":
-    import sys
-    import tornado.ioloop
-    try:
-        settings = utils.load_settings(filepath=sys.argv[1])
-    except IndexError:
-        settings = utils.load_settings()
-    application = tornado.web.Application(
+def get_application():
+    "Return the web application, configured from the loaded settings."
+    return tornado.web.Application(
         handlers=handlers,
         debug=settings.get('TORNADO_DEBUG', False),
         cookie_secret=settings['COOKIE_SECRET'],
@@ -125,6 +132,19 @@ if __name__ == "__main__":
         static_path=constants.STATIC_PATH,
         static_url_prefix=constants.STATIC_URL,
         login_url=constants.LOGIN_URL)
+
+
+if __name__ == "__main__":
+    import sys
+    import tornado.ioloop
+    try:
+        settings = utils.load_settings(filepath=sys.argv[1])
+    except IndexError:
+        settings = utils.load_settings()
+    application = get_application()
+    cache.start(utils.get_db())
+    summary.start(utils.get_db())
+    search.start(utils.get_db())
     application.listen(settings['PORT'])
     logging.info("Charon web server on port %s", settings['PORT'])
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,206 @@
+" Charon: Non-blocking CouchDB client, for use within request handlers. "
+
+import json
+import urllib.parse
+import time
+
+import tornado.httpclient
+import couchdb
+
+from . import settings
+from . import utils
+from . import metrics
+
+
+def configure():
+    """Configure the Tornado HTTP client used for CouchDB requests.
+    The curl-based client, which keeps connections alive, is used if
+    pycurl is available. The max number of concurrent requests is
+    settings['DB_POOL_SIZE']; any further requests are queued."""
+    try:
+        import pycurl
+    except ImportError:
+        impl = None
+    else:
+        impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+    tornado.httpclient.AsyncHTTPClient.configure(
+        impl, max_clients=settings.get('DB_POOL_SIZE', 10))
+
+
+class Database(object):
+    """Non-blocking interface to a CouchDB database.
+    Errors are raised as the couchdb.http exceptions used by the
+    couchdb module, and view rows are couchdb.client.Row instances."""
+
+    def __init__(self, server_url, name):
+        url, credentials = couchdb.http.extract_credentials(server_url)
+        self.url = "{0}/{1}".format(url.rstrip('/'),
+                                    urllib.parse.quote(name, safe=''))
+        self.credentials = credentials or (None, None)
+        self.requests = 0
+
+    async def request(self, method, path, body=None, params=None,
+                      timeout=None):
+        """Send a request to the database and return the decoded JSON
+        response. Raise the corresponding couchdb.http exception on error.
+        The timeout in seconds defaults to settings['DB_TIMEOUT']."""
+        url = self.url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        if body is not None:
+            body = json.dumps(body)
+        elif method in ('POST', 'PUT'):
+            body = ''
+        request = tornado.httpclient.HTTPRequest(
+            url,
+            method=method,
+            body=body,
+            headers={'Accept': 'application/json',
+                     'Content-Type': 'application/json'},
+            auth_username=self.credentials[0],
+            auth_password=self.credentials[1],
+            request_timeout=timeout or settings.get('DB_TIMEOUT') or 60.0)
+        client = tornado.httpclient.AsyncHTTPClient()
+        self.requests += 1
+        start = time.monotonic()
+        try:
+            response = await client.fetch(request)
+        except tornado.httpclient.HTTPClientError as error:
+            raise get_exception(error.code, error.response)
+        finally:
+            metrics.record_db_call(url, time.monotonic() - start)
+        return json.loads(response.body)
+
+    async def get(self, id):
+        """Return the document with the given id.
+        Raise couchdb.http.ResourceNotFound if no such document."""
+        return couchdb.client.Document(
+            await self.request('GET', '/' + quote_id(id)))
+
+    async def save(self, doc):
+        """Create or update the document, and set its new revision.
+        Return the id and revision.
+        Raise couchdb.http.ResourceConflict if revision update conflict."""
+        doc.setdefault('_id', utils.get_iuid())
+        data = await self.request('PUT', '/' + quote_id(doc['_id']), body=doc)
+        doc['_rev'] = data['rev']
+        return data['id'], data['rev']
+
+    async def view(self, name, **options):
+        """Return the list of rows for the view given as 'design/view'.
+        The options are the usual CouchDB view query parameters."""
+        design, view = name.split('/')
+        path = "/_design/{0}/_view/{1}".format(design, view)
+        keys = options.pop('keys', None)
+        params = encode_view_options(options)
+        if keys is None:
+            data = await self.request('GET', path, params=params)
+        else:
+            data = await self.request('POST', path, body=dict(keys=keys),
+                                      params=params)
+        return [couchdb.client.Row(r) for r in data['rows']]
+
+    async def iterview(self, name, batch=1000, **options):
+        """Yield the rows for the map view given as 'design/view',
+        reading them in pages of 'batch' rows, so that at most one page
+        is held in memory. Each page starts at the key and doc id of the
+        first row not yet yielded. Nothing is left running if the caller
+        stops iterating. The options are the usual CouchDB view query
+        parameters, except 'keys' and 'skip'."""
+        options = options.copy()
+        limit = options.pop('limit', None)
+        if 'key' in options:
+            options['startkey'] = options['endkey'] = options.pop('key')
+        count = 0
+        while True:
+            if limit is not None:
+                batch = min(batch, limit - count)
+                if batch <= 0: return
+            rows = await self.view(name, limit=batch + 1, **options)
+            for row in rows[:batch]:
+                yield row
+            count += len(rows[:batch])
+            if len(rows) <= batch: return
+            options['startkey'] = rows[batch].key
+            options['startkey_docid'] = rows[batch].id
+
+    async def changes(self, **options):
+        """Return the changes feed response; a dictionary with 'results',
+        the list of changes, and 'last_seq'. The options are the usual
+        CouchDB _changes query parameters. For a longpoll feed, the
+        request timeout allows for the feed 'timeout' in milliseconds."""
+        timeout = options.get('timeout')
+        if timeout is not None:
+            timeout = timeout / 1000.0 + (settings.get('DB_TIMEOUT') or 60.0)
+        return await self.request('GET', '/_changes',
+                                  params=encode_view_options(options),
+                                  timeout=timeout)
+
+    async def bulk_docs(self, docs):
+        """Save the documents in one request, and set the new revisions.
+        Return the list of results, one for each document; a dictionary
+        containing either 'rev', or 'error' and 'reason'."""
+        results = await self.request('POST', '/_bulk_docs',
+                                     body=dict(docs=docs))
+        for doc, result in zip(docs, results):
+            if 'error' not in result:
+                doc['_id'] = result['id']
+                doc['_rev'] = result['rev']
+        return results
+
+    def get_stats(self):
+        "Return the request count, and the max number of concurrent requests."
+        return dict(requests=self.requests,
+                    max_clients=settings.get('DB_POOL_SIZE', 10))
+
+
+def quote_id(id):
+    "Quote the document id for use in a URL; design documents excepted."
+    if id.startswith('_design/'):
+        return '_design/' + urllib.parse.quote(id[len('_design/'):], safe='')
+    return urllib.parse.quote(id, safe='')
+
+def encode_view_options(options):
+    "Encode the view query parameters as CouchDB wants them."
+    result = dict()
+    for key, value in options.items():
+        if key in ('key', 'startkey', 'start_key', 'endkey', 'end_key'):
+            value = json.dumps(value)
+        elif isinstance(value, bool):
+            value = value and 'true' or 'false'
+        elif isinstance(value, (list, tuple, dict)):
+            value = json.dumps(value)
+        result[key] = value
+    return result
+
+def get_exception(code, response):
+    "Return the couchdb.http exception corresponding to the HTTP error."
+    try:
+        data = json.loads(response.body)
+        error = (data.get('error'), data.get('reason'))
+    except (AttributeError, TypeError, ValueError):
+        error = (code, response and response.reason)
+    if code == 401:
+        return couchdb.http.Unauthorized(error)
+    elif code == 404:
+        return couchdb.http.ResourceNotFound(error)
+    elif code == 409:
+        return couchdb.http.ResourceConflict(error)
+    elif code == 412:
+        return couchdb.http.PreconditionFailed(error)
+    else:
+        return couchdb.http.ServerError((code, error))
+
+
+_dbs = dict()
+
+def get_db():
+    """Return the non-blocking handle for the CouchDB database.
+    The handle is created once per process, and then reused."""
+    key = (settings['DB_SERVER'], settings['DB_DATABASE'])
+    try:
+        return _dbs[key]
+    except KeyError:
+        if not _dbs:
+            configure()
+        return _dbs.setdefault(key, Database(*key))
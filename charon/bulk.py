@@ -0,0 +1,230 @@
+" Charon: Bulk create and update of entities. "
+
+import logging
+import json
+import copy
+
+import tornado.web
+import couchdb
+
+from . import cache
+from . import constants
+from .api import ApiRequestHandler
+from .project import ProjectSaver
+from .sample import SampleSaver
+from .libprep import LibprepSaver
+from .seqrun import SeqrunSaver, UpdateSampleCovMixin
+from .saver import fetch_unique
+
+
+class ApiBulk(UpdateSampleCovMixin, ApiRequestHandler):
+    """Create and update many entities in one call.
+    The JSON body is a dictionary with the list of items under 'items'.
+    Each item is a dictionary with 'action' ('create' or 'update'),
+    'entity' ('project', 'sample', 'libprep' or 'seqrun'), the identifiers
+    of the entity (for update) or of its parent (for create) as
+    'projectid', 'sampleid', 'libprepid' and 'seqrunid', and the
+    entity data under 'data', as for the single-entity calls.
+    The items are processed in order; an item may refer to an entity
+    created by a previous item in the same call."""
+
+    # Entities in hierarchy order; the parent of each is the previous one.
+    order = ('project', 'sample', 'libprep', 'seqrun')
+    # Entity name -> (saver class, identifier keys, API URL name)
+    entities = dict(project=(ProjectSaver,
+                             ('projectid',),
+                             'api_project'),
+                    sample=(SampleSaver,
+                            ('projectid', 'sampleid'),
+                            'api_sample'),
+                    libprep=(LibprepSaver,
+                             ('projectid', 'sampleid', 'libprepid'),
+                             'api_libprep'),
+                    seqrun=(SeqrunSaver,
+                            ('projectid', 'sampleid', 'libprepid', 'seqrunid'),
+                            'api_seqrun'))
+
+    def prepare(self):
+        super(ApiBulk, self).prepare()
+        self.created = dict()           # (entity, key) -> new doc
+        self.savers = dict()            # doc id -> saver
+
+    async def post(self):
+        """Create or update the entities given by the items.
+        All valid items are saved, with their log entries,
+        in a single database request.
+        Return HTTP 200 and a list 'results' with one dictionary per item,
+        containing 'status' (201 created, 200 updated, 400 invalid,
+        404 not found, 409 revision conflict), and 'reason' or 'href'.
+        Return HTTP 400 if the body is not a dictionary with a list 'items'."""
+        try:
+            items = json.loads(self.request.body)['items']
+            if not isinstance(items, list): raise ValueError
+        except Exception:
+            self.send_error(400, reason="body must be JSON with list 'items'")
+            return
+        self.unique_found = await fetch_unique(self.async_db,
+                                               self.get_unique_keys(items))
+        results = []
+        logs = []
+        for item in items:
+            try:
+                saver, result = await self.process(item)
+            except tornado.web.HTTPError as error:
+                results.append(dict(status=error.status_code,
+                                    reason=error.reason))
+            except (KeyError, TypeError, ValueError) as msg:
+                results.append(dict(status=400, reason=str(msg)))
+            else:
+                results.append(result)
+                if saver.changed:
+                    logs.append(saver.get_log_entry())
+        if self.savers:
+            await self.save(results, logs)
+            await self.update_samples_cov(results)
+        self.write(dict(results=results))
+
+    async def process(self, item):
+        """Check and store the data for the item in its entity document.
+        Return the saver and the result for the item.
+        Raise HTTP 400 or 404, KeyError or ValueError if invalid."""
+        try:
+            saver_class, keys, name = self.entities[item['entity']]
+        except KeyError:
+            raise ValueError("invalid or missing 'entity'")
+        action = item.get('action')
+        if action == 'create':
+            saver = saver_class(rqh=self,
+                                **(await self.get_parent(item, keys[:-1])))
+            await saver.setup()
+            status = 201
+        elif action == 'update':
+            doc = await self.get_entity(item, keys)
+            try:
+                saver = self.savers[doc['_id']]
+            except KeyError:
+                saver = saver_class(doc=doc, rqh=self)
+                await saver.setup()
+            status = 200
+        else:
+            raise ValueError("invalid or missing 'action'")
+        data = item.get('data') or dict()
+        backup = copy.deepcopy(saver.doc)
+        saver.changed = dict()
+        try:
+            saver.store(data=data)
+            key = tuple([saver.doc[k] for k in keys])
+            if action == 'create':
+                if (item['entity'], key) in self.created:
+                    raise ValueError('not unique')
+                self.created[(item['entity'], key)] = saver.doc
+        except Exception:
+            saver.doc.clear()
+            saver.doc.update(backup)
+            raise
+        self.savers[saver.doc['_id']] = saver
+        return saver, dict(status=status,
+                           id=saver.doc['_id'],
+                           href=self.get_absolute_url(name, *key))
+
+    def get_unique_keys(self, items):
+        """Return the (viewname, key) pairs for checking the uniqueness
+        of the identifiers and names in the items, so that they are
+        fetched in one query per view instead of one per item."""
+        result = []
+        for item in items:
+            try:
+                saver_class = self.entities[item['entity']][0]
+                data = item.get('data') or dict()
+                result.extend(saver_class.get_unique_keys(item, data))
+            except (KeyError, TypeError, AttributeError):
+                pass
+        return result
+
+    async def update_samples_cov(self, results):
+        """Update the coverage and reads totals of each sample
+        having a seqrun that was saved."""
+        saved = set([r['id'] for r in results if r['status'] in (200, 201)])
+        samples = set()
+        for saver in self.savers.values():
+            if saver.doctype == constants.SEQRUN and saver.doc['_id'] in saved:
+                samples.add((saver.doc['projectid'], saver.doc['sampleid']))
+        for projectid, sampleid in sorted(samples):
+            await self.update_sample_cov(projectid, sampleid)
+
+    async def get_parent(self, item, keys):
+        "Return the parent keyword argument for the saver of a new entity."
+        if not keys:
+            return dict()
+        parent = self.order[len(keys) - 1]
+        return {parent: await self.get_entity(item, keys)}
+
+    async def get_entity(self, item, keys):
+        """Get the entity given by the identifiers in the item;
+        it may have been created by a previous item.
+        Raise HTTP 404 if no such entity."""
+        key = tuple([item[k] for k in keys])
+        entity = self.order[len(keys) - 1]
+        try:
+            return self.created[(entity, key)]
+        except KeyError:
+            getter = getattr(self, "get_{0}".format(entity))
+            return await getter(*key)
+
+    async def get_project(self, projectid):
+        try:
+            return self.created[('project', (projectid,))]
+        except KeyError:
+            return await super(ApiBulk, self).get_project(projectid)
+
+    async def get_sample(self, projectid, sampleid):
+        try:
+            return self.created[('sample', (projectid, sampleid))]
+        except KeyError:
+            return await super(ApiBulk, self).get_sample(projectid, sampleid)
+
+    async def get_libprep(self, projectid, sampleid, libprepid):
+        try:
+            return self.created[('libprep', (projectid, sampleid, libprepid))]
+        except KeyError:
+            return await super(ApiBulk, self).get_libprep(projectid,
+                                                          sampleid,
+                                                          libprepid)
+
+    async def save(self, results, logs):
+        """Save all entity documents and log entries in one request.
+        Update the results for items whose document could not be saved,
+        and delete the log entries for those."""
+        docs = []
+        for saver in self.savers.values():
+            saver.finalize()
+            docs.append(saver.doc)
+        try:
+            outcome = await self.async_db.bulk_docs(docs + logs)
+        finally:
+            for doc in docs:
+                cache.documents.evict(doc['_id'])
+        failed = dict([(r['id'], r) for r in outcome[:len(docs)]
+                       if 'error' in r])
+        if not failed: return
+        for result in results:
+            try:
+                error = failed[result['id']]
+            except KeyError:
+                continue
+            if error['error'] == 'conflict':
+                result['status'] = 409
+                result['reason'] = 'document revision update conflict'
+            else:
+                result['status'] = 400
+                result['reason'] = error.get('reason') or error['error']
+            result.pop('href', None)
+        orphans = [dict(_id=entry['_id'], _rev=entry['_rev'], _deleted=True)
+                   for entry in logs
+                   if entry['doc'] in failed and '_rev' in entry]
+        if orphans:
+            try:
+                await self.async_db.bulk_docs(orphans)
+            except couchdb.http.HTTPError as msg:
+                logging.warning("could not delete orphaned log entries: %s",
+                                msg)
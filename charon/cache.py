@@ -0,0 +1,222 @@
+" Charon: Process-wide cache of entity documents. "
+
+import collections
+import copy
+import logging
+import threading
+import time
+
+from . import settings
+from .changes import ChangesFollower
+
+
+class DocumentCache(object):
+    """Bounded least-recently-used cache of documents, keyed by
+    the view name and the key used to look up the document.
+    Documents are copied in and out, so that modifications made while
+    handling a request never leak into the cache.
+    The cache is inactive until enabled, which should be done only
+    when some mechanism, such as the changes feed, evicts stale items.
+    Each eviction increments the generation. A document read from the
+    database is put only if its id has not been evicted since the
+    generation obtained before the read, unless it has the revision
+    then given; otherwise a read in flight could put a stale document
+    after the eviction for a newer revision."""
+
+    def __init__(self, maxsize=10000, maxevicted=1000):
+        self.maxsize = maxsize
+        self.enabled = False
+        self.items = collections.OrderedDict()  # (viewname, key) -> doc
+        self.ids = dict()                       # doc id -> set of item keys
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.evicted = collections.OrderedDict() # doc id -> (generation, rev)
+        self.maxevicted = maxevicted
+        self.horizon = 0        # Evictions up to this are not recorded.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    def get_generation(self):
+        "Return the current generation, to be given to put."
+        with self.lock:
+            return self.generation
+
+    def get(self, viewname, key):
+        "Return a copy of the cached document, or None if not cached."
+        if not self.enabled: return None
+        with self.lock:
+            try:
+                doc = self.items[(viewname, key)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.items.move_to_end((viewname, key))
+            self.hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, viewname, key, doc, generation=None):
+        """Store a copy of the document. If the generation obtained before
+        reading it is given, do not store it if it may be stale."""
+        if not self.enabled: return
+        doc = copy.deepcopy(doc)
+        with self.lock:
+            if generation is not None and self.is_stale(doc, generation):
+                self.stale += 1
+                return
+            self._remove((viewname, key))
+            self.items[(viewname, key)] = doc
+            self.ids.setdefault(doc['_id'], set()).add((viewname, key))
+            while len(self.items) > self.maxsize:
+                self._remove(next(iter(self.items)))
+                self.evictions += 1
+
+    def evict(self, id, rev=None):
+        """Remove all items for the given document id.
+        If the revision is given, keep the items if they have that revision."""
+        with self.lock:
+            self.generation += 1
+            self.evicted.pop(id, None)
+            self.evicted[id] = (self.generation, rev)
+            while len(self.evicted) > self.maxevicted:
+                self.horizon = self.evicted.popitem(last=False)[1][0]
+            for item_key in list(self.ids.get(id, [])):
+                if rev is not None and self.items[item_key].get('_rev') == rev:
+                    continue
+                self._remove(item_key)
+                self.evictions += 1
+
+    def clear(self):
+        "Remove all items."
+        with self.lock:
+            self.generation += 1
+            self.horizon = self.generation
+            self.evicted.clear()
+            self.items.clear()
+            self.ids.clear()
+
+    def is_stale(self, doc, generation):
+        """May the document, read after the given generation, be stale?
+        The lock must be held by the caller."""
+        if generation < self.horizon: return True
+        try:
+            evicted, rev = self.evicted[doc['_id']]
+        except KeyError:
+            return False
+        return evicted > generation and doc.get('_rev') != rev
+
+    def _remove(self, item_key):
+        "Remove the item. The lock must be held by the caller."
+        try:
+            doc = self.items.pop(item_key)
+        except KeyError:
+            return
+        keys = self.ids.get(doc['_id'])
+        if keys is not None:
+            keys.discard(item_key)
+            if not keys:
+                del self.ids[doc['_id']]
+
+    def changed(self, change):
+        "Callback for the changes feed; evict any stale document."
+        self.evict(change['id'], rev=change['changes'][-1]['rev'])
+
+    def get_stats(self):
+        "Return the cache statistics as a dictionary."
+        with self.lock:
+            return dict(enabled=self.enabled,
+                        maxsize=self.maxsize,
+                        size=len(self.items),
+                        hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        stale=self.stale)
+
+
+class TokenCache(object):
+    """Cache of user documents keyed by API token, each entry expiring
+    after a time-to-live. Entries are also removed explicitly when
+    the API token is changed, or when the user document changes."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.enabled = False
+        self.items = dict()                     # api_token -> (expires, user)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api_token):
+        "Return a copy of the user for the API token, or None if not cached."
+        if not self.enabled: return None
+        with self.lock:
+            try:
+                expires, user = self.items[api_token]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.monotonic():
+                del self.items[api_token]
+                self.misses += 1
+                return None
+            self.hits += 1
+        return copy.deepcopy(user)
+
+    def put(self, api_token, user):
+        "Store a copy of the user for the API token."
+        if not self.enabled: return
+        user = copy.deepcopy(user)
+        with self.lock:
+            self.items[api_token] = (time.monotonic() + self.ttl, user)
+
+    def evict(self, api_token):
+        "Remove the entry for the API token, if any."
+        with self.lock:
+            self.items.pop(api_token, None)
+
+    def evict_user(self, id):
+        "Remove all entries for the user given by document id."
+        with self.lock:
+            for api_token, (expires, user) in list(self.items.items()):
+                if user['_id'] == id:
+                    del self.items[api_token]
+
+    def changed(self, change):
+        "Callback for the changes feed; evict the user if changed."
+        self.evict_user(change['id'])
+
+    def get_stats(self):
+        "Return the cache statistics as a dictionary."
+        with self.lock:
+            return dict(enabled=self.enabled,
+                        ttl=self.ttl,
+                        size=len(self.items),
+                        hits=self.hits,
+                        misses=self.misses)
+
+
+documents = DocumentCache()
+tokens = TokenCache()
+
+def changed(change):
+    "Callback for the changes feed; evict stale items from the caches."
+    documents.changed(change)
+    tokens.changed(change)
+
+def start(db):
+    """Enable the process-wide document cache, if settings['CACHE_SIZE']
+    is non-zero, and the API token cache, if settings['API_TOKEN_TTL']
+    is non-zero. Start following the changes feed to keep them fresh."""
+    documents.maxsize = settings.get('CACHE_SIZE', 10000)
+    tokens.ttl = settings.get('API_TOKEN_TTL', 300)
+    if not (documents.maxsize or tokens.ttl): return
+    follower = ChangesFollower(changed, since=db.info()['update_seq'])
+    follower.start()
+    if documents.maxsize:
+        documents.enabled = True
+        logging.info("document cache enabled, max size %s", documents.maxsize)
+    if tokens.ttl:
+        tokens.enabled = True
+        logging.info("API token cache enabled, TTL %s s", tokens.ttl)
+    return follower
@@ -0,0 +1,59 @@
+" Charon: Follow the CouchDB changes feed in a background thread. "
+
+import logging
+import threading
+
+import couchdb
+
+from . import settings
+
+
+class ChangesFollower(threading.Thread):
+    """Background thread following the continuous CouchDB changes feed.
+    The callback is called with each change dictionary, in this thread.
+    Reconnects after a delay if the feed is broken."""
+
+    def __init__(self, callback, since='now', include_docs=False,
+                 heartbeat=30000, retry_delay=10.0):
+        super(ChangesFollower, self).__init__(name='ChangesFollower')
+        self.daemon = True
+        self.callback = callback
+        self.since = since
+        self.include_docs = include_docs
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self._stop_event = threading.Event()
+
+    def get_db(self):
+        """Return a database handle with a session of its own;
+        the continuous feed keeps its connection open indefinitely."""
+        session = couchdb.http.Session()
+        server = couchdb.Server(settings['DB_SERVER'], session=session)
+        return server[settings['DB_DATABASE']]
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                db = self.get_db()
+                kwargs = dict(feed='continuous',
+                              since=self.since,
+                              heartbeat=self.heartbeat)
+                if self.include_docs:
+                    kwargs['include_docs'] = True
+                for change in db.changes(**kwargs):
+                    if self._stop_event.is_set(): return
+                    if 'last_seq' in change:
+                        self.since = change['last_seq']
+                        continue
+                    try:
+                        self.callback(change)
+                    except Exception as msg:
+                        logging.error("changes callback error: %s", msg)
+                    self.since = change['seq']
+            except Exception as msg:
+                logging.warning("changes feed error: %s", msg)
+                self._stop_event.wait(self.retry_delay)
+
+    def stop(self):
+        "Stop following the feed, at the latest when the next change arrives."
+        self._stop_event.set()
@@ -18,6 +18,16 @@ TEMPLATE_PATH    = 'templates'
 STATIC_PATH      = 'static'
 STATIC_URL       = r'/static/'
 LOGIN_URL        = r'/login'
+JSON_MIME        = 'application/json'
+NDJSON_MIME      = 'application/x-ndjson'
+STREAM_FLUSH_ROWS = 100         # Flush streamed response every N items.
+PAGE_LIMIT       = 100          # Default number of items in a page.
+MAX_PAGE_LIMIT   = 1000         # Max number of items in a page.
+SEARCH_MAX_ROWS  = 10000        # Max view rows examined per sample search.
+CHANGES_TIMEOUT  = 60           # Default seconds to wait for changes.
+CHANGES_HEARTBEAT = 30          # Seconds between continuous feed heartbeats.
+CHANGES_MAX_TIMEOUT = 3600      # Max seconds to wait for changes.
+SAMPLE_COV_RETRIES = 3          # Attempts at updating the sample totals.
 
 # Database
 DB_DOCTYPE = 'charon_doctype'
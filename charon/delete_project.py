@@ -1,21 +1,32 @@
 """Development script for deleting explicitly a project and all its stuff.
-WARNING: Destructive! Must not be used in the production instance."""
+WARNING: Destructive! Must not be used in the production instance.
 
+Usage: delete_project.py [--dry-run] projectid
+With --dry-run, only report the number of documents that would be deleted."""
+
+from charon import constants
 from charon import utils
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 2:
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    dry_run = '--dry-run' in sys.argv[1:]
+    if len(args) != 1:
         sys.exit('give project identifier')
     utils.load_settings()
     db = utils.get_db()
-    view = db.view('project/projectid', include_docs=True, key=sys.argv[1])
+    view = db.view('project/projectid', include_docs=True, key=args[0])
     rows = list(view)
     if len(rows) != 1:
         sys.exit('no such project')
     project = rows[0].doc
     print('Project', project['projectid'], project.get('title', '[no title]'))
+    plan = utils.plan_delete(db, project)
+    for doctype in [constants.PROJECT, constants.SAMPLE, constants.LIBPREP,
+                    constants.SEQRUN, constants.LOG]:
+        print("{0:10s} {1:8d}".format(doctype, len(plan.get(doctype, []))))
+    if dry_run: sys.exit(0)
     answer = input('really delete? (y/n) > ')
     if utils.to_bool(answer):
-        utils.delete_project(db, project)
-        print('deleted')
+        count = utils.delete_planned(db, plan)
+        print('deleted', count, 'documents')
@@ -0,0 +1,11 @@
+/* Charon
+   Pass the changes of project, sample, libprep and seqrun documents,
+   only of the type given by the query parameter 'doctype', if any.
+   Deleted entities are passed by the doctype kept in their deletion stub.
+*/
+function(doc, req) {
+    var doctype = doc.charon_doctype;
+    if (req.query.doctype) return doctype === req.query.doctype;
+    return doctype === 'project' || doctype === 'sample' ||
+        doctype === 'libprep' || doctype === 'seqrun';
+}
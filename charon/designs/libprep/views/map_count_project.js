@@ -0,0 +1,8 @@
+/* Charon
+   Index libprep documents by projectid.
+   Value: 1.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'libprep') return;
+    emit(doc.projectid, 1);
+}
@@ -0,0 +1 @@
+_count
\ No newline at end of file
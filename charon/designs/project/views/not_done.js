@@ -1,6 +1,9 @@
-/*emits only not done projects*/
+/* Charon
+   Index project documents that are not closed by projectid.
+   Value: null; use include_docs to get the documents.
+*/
 function(doc) {
-    if (doc.charon_doctype === 'project' && doc.status !== 'CLOSED'){
-          emit(doc.projectid, doc);
-    }
+    if (doc.charon_doctype !== 'project') return;
+    if (doc.status === 'CLOSED') return;
+    emit(doc.projectid, null);
 }
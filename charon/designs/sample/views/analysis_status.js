@@ -0,0 +1,8 @@
+/* Charon
+   Index sample documents by [analysis_status, projectid, sampleid].
+   Value: null; use include_docs to get the documents.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'sample') return;
+    emit([doc.analysis_status || null, doc.projectid, doc.sampleid], null);
+}
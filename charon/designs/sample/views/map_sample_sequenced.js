@@ -1,5 +0,0 @@
-function(doc) {
-  if (doc.charon_doctype === 'seqrun'){
-	 emit([doc.projectid, doc.sampleid], 1);
-  }
-}
\ No newline at end of file
@@ -1,7 +1,9 @@
-/*Returns all samples that have a 'not done' status*/
-
+/* Charon
+   Index sample documents that are not done by [projectid, sampleid].
+   Value: null; use include_docs to get the documents.
+*/
 function(doc) {
-        if (doc.charon_doctype === 'sample' && doc.status !== 'DONE'){ 
-            emit([doc.projectid, doc.sampleid], doc);
-        }
+    if (doc.charon_doctype !== 'sample') return;
+    if (doc.status === 'DONE') return;
+    emit([doc.projectid, doc.sampleid], null);
 }
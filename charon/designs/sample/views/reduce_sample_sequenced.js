@@ -1,3 +0,0 @@
-function(map, value, rereduce){
-  return 1;
-}
\ No newline at end of file
@@ -0,0 +1,16 @@
+/* Charon
+   Index sample documents for searching across all projects.
+   One row for each searchable field, keyed by
+   [field, value, projectid, sampleid]; the value is null if undefined.
+   Value: null; use include_docs to get the documents.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'sample') return;
+    var fields = ['analysis_status', 'delivery_status', 'type',
+                  'total_autosomal_coverage', 'modified'];
+    for (var i = 0; i < fields.length; i++) {
+        var value = doc[fields[i]];
+        if (value === undefined) value = null;
+        emit([fields[i], value, doc.projectid, doc.sampleid], null);
+    }
+}
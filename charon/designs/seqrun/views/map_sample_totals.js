@@ -0,0 +1,12 @@
+/* Charon
+   Index seqrun documents by [projectid, sampleid], excluding those
+   with failed alignment.
+   Value: [mean_autosomal_coverage, total_reads].
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'seqrun') return;
+    if (doc.alignment_status === 'FAILED') return;
+    emit([doc.projectid, doc.sampleid],
+         [Number(doc.mean_autosomal_coverage) || 0,
+          Number(doc.total_reads) || 0]);
+}
@@ -1,15 +1,22 @@
 " Charon: Dump the database into a JSON file."
 
+import os
+import io
 import json
 import tarfile
-from io import StringIO
+import concurrent.futures
+
+import couchdb
 
 from charon import utils
 from charon import constants
 
 
-def dump(db, filename):
+def dump(db, filename, page_size=1000, workers=4):
     """Dump contents of the database to a tar file, optionally compressed.
+    The documents are read in pages from '_all_docs', and written as they
+    arrive, so memory use does not grow with the size of the database.
+    The attachments of each page are fetched concurrently by the workers.
     Return the number of items, and the number of attachment files dumped."""
     count_items = 0
     count_files = 0
@@ -19,58 +26,170 @@ def dump(db, filename):
         mode = 'w:bz2'
     else:
         mode = 'w'
-    outfile = tarfile.open(filename, mode=mode)
-    for key in db:
-        if not constants.IUID_RX.match(key): continue
-        doc = db[key]
-        del doc['_rev']
-        info = tarfile.TarInfo(doc['_id'])
-        data = json.dumps(doc)
-        info.size = len(data)
-        outfile.addfile(info, StringIO(data))
-        count_items += 1
-        for attname in doc.get('_attachments', dict()):
-            info = tarfile.TarInfo("{0}_att/{1}".format(doc['_id'], attname))
-            attfile = db.get_attachment(doc, attname)
-            data = attfile.read()
-            attfile.close()
-            info.size = len(data)
-            outfile.addfile(info, StringIO(data))
-            count_files += 1
-    outfile.close()
+    with tarfile.open(filename, mode=mode) as outfile, \
+         concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for docs in get_pages(db, page_size):
+            attachments = dict()
+            for doc in docs:
+                for attname in doc.get('_attachments', dict()):
+                    attachments[(doc['_id'], attname)] = executor.submit(
+                        get_attachment, db, doc, attname)
+            for doc in docs:
+                del doc['_rev']
+                add_file(outfile, doc['_id'], json.dumps(doc).encode('utf-8'))
+                count_items += 1
+                # The attachments must follow their item; see undump.
+                for attname in doc.get('_attachments', dict()):
+                    add_file(outfile,
+                             "{0}_att/{1}".format(doc['_id'], attname),
+                             attachments[(doc['_id'], attname)].result())
+                    count_files += 1
     return count_items, count_files
 
-def undump(db, filename):
+def get_pages(db, page_size):
+    """Yield the documents in the database, except design documents,
+    in lists of at most the given size."""
+    docs = []
+    for row in db.iterview('_all_docs', page_size, include_docs=True):
+        if not constants.IUID_RX.match(row.id): continue
+        docs.append(row.doc)
+        if len(docs) >= page_size:
+            yield docs
+            docs = []
+    if docs:
+        yield docs
+
+def get_attachment(db, doc, attname):
+    "Return the data of the attachment to the document."
+    attfile = db.get_attachment(doc, attname)
+    try:
+        return attfile.read()
+    finally:
+        attfile.close()
+
+def add_file(outfile, name, data):
+    "Add the data as a file with the given name to the tar file."
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    outfile.addfile(info, io.BytesIO(data))
+
+def undump(db, filename, batch_size=500, workers=4, checkpoint=None):
     """Reverse of dump; load all items from a tar file.
-    Items are just added to the database, ignoring existing items."""
+    Items are just added to the database, ignoring existing items.
+    The items are saved in batches using '_bulk_docs', and then the
+    attachments of the batch are uploaded concurrently by the workers.
+    If a checkpoint filepath is given, the position in the tar file
+    after each completed batch is written to it, and an existing
+    checkpoint file is used to continue from where it left off.
+    The checkpoint file is removed when all items have been loaded.
+    Return the number of items, and the number of attachment files loaded."""
     count_items = 0
     count_files = 0
+    skip = 0
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as infile:
+            data = json.load(infile)
+        if data['filename'] != os.path.abspath(filename):
+            raise ValueError("checkpoint {0} is not for {1}".format(
+                checkpoint, filename))
+        skip = data['position']
+        count_items = data['count_items']
+        count_files = data['count_files']
+    # If the user document already exists, do not load again.
+    emails = set([r.key for r in db.view('user/email')])
+    docs = []
     attachments = dict()
-    infile = tarfile.open(filename, mode='r')
-    for item in infile:
-        itemfile = infile.extractfile(item)
-        itemdata = itemfile.read()
-        itemfile.close()
-        if item.name in attachments:
+    position = 0
+    with tarfile.open(filename, mode='r') as infile, \
+         concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for item in infile:
+            position += 1
+            if position <= skip: continue
             # This relies on an attachment being after its item in the tarfile.
-            db.put_attachment(doc, itemdata, **attachments.pop(item.name))
-            count_files += 1
-        else:
-            doc = json.loads(itemdata)
-            # If the user document already exists, do not load again.
+            if item.name in attachments:
+                attachments[item.name]['data'] = read_file(infile, item)
+                continue
+            if len(docs) >= batch_size:
+                items, files = save_batch(db, docs, executor)
+                count_items += items
+                count_files += files
+                save_checkpoint(checkpoint, filename, position - 1,
+                                count_items, count_files)
+                docs = []
+                attachments = dict()
+            doc = json.loads(read_file(infile, item))
             if doc[constants.DB_DOCTYPE] == constants.USER:
-                rows = db.view('user/email', key=doc['email'])
-                if len(list(rows)) != 0: continue
-            atts = doc.pop('_attachments', dict())
-            db.save(doc)
-            count_items += 1
-            for attname, attinfo in list(atts.items()):
+                if doc['email'] in emails: continue
+                emails.add(doc['email'])
+            doc['_atts'] = []
+            for attname, attinfo in list(doc.pop('_attachments',
+                                                 dict()).items()):
                 key = "{0}_att/{1}".format(doc['_id'], attname)
                 attachments[key] = dict(filename=attname,
                                         content_type=attinfo['content_type'])
-    infile.close()
+                doc['_atts'].append(attachments[key])
+            docs.append(doc)
+        if docs:
+            items, files = save_batch(db, docs, executor)
+            count_items += items
+            count_files += files
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
     return count_items, count_files
 
+def read_file(infile, item):
+    "Return the data of the item in the tar file."
+    itemfile = infile.extractfile(item)
+    try:
+        return itemfile.read()
+    finally:
+        itemfile.close()
+
+def save_batch(db, docs, executor):
+    """Save the documents in one request, and then upload their attachments.
+    A document that already exists is not changed, but any of its
+    attachments which are missing are uploaded; this is the case when
+    continuing after an interruption during the upload of attachments.
+    Return the number of items, and the number of attachment files saved."""
+    atts = [doc.pop('_atts') for doc in docs]
+    count_items = 0
+    futures = []
+    for doc, docatts, result in zip(docs, atts, db.update(docs)):
+        if result[0]:
+            count_items += 1
+        elif isinstance(result[2], couchdb.http.ResourceConflict):
+            if not docatts: continue
+            doc = db[doc['_id']]
+            existing = doc.get('_attachments', dict())
+            docatts = [a for a in docatts if a['filename'] not in existing]
+        else:
+            raise IOError("could not save {0}: {1}".format(doc['_id'],
+                                                           result[2]))
+        if docatts:
+            futures.append(executor.submit(put_attachments, db, doc, docatts))
+    return count_items, sum([f.result() for f in futures])
+
+def put_attachments(db, doc, attachments):
+    """Upload the attachments to the document, one after the other,
+    since each changes the revision. Return the number uploaded."""
+    for attachment in attachments:
+        db.put_attachment(doc, attachment['data'],
+                          filename=attachment['filename'],
+                          content_type=attachment['content_type'])
+    return len(attachments)
+
+def save_checkpoint(checkpoint, filename, position, count_items, count_files):
+    "Record the position in the tar file up to which all items are loaded."
+    if not checkpoint: return
+    tmpname = checkpoint + '.tmp'
+    with open(tmpname, 'w') as outfile:
+        json.dump(dict(filename=os.path.abspath(filename),
+                       position=position,
+                       count_items=count_items,
+                       count_files=count_files),
+                  outfile)
+    os.replace(tmpname, checkpoint)
+
 
 if __name__ == '__main__':
     import sys
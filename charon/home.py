@@ -2,7 +2,6 @@
 
 import logging
 import json
-import functools
 
 import tornado.web
 import couchdb
@@ -10,12 +9,19 @@ import couchdb
 from . import constants
 from . import settings
 from . import utils
+from . import cache
+from . import metrics
+from . import logwriter
+from . import summary
+from . import search
 from .requesthandler import RequestHandler
 from .api import ApiRequestHandler
 
 import time
 
-def sampleStats(handler, projectid=None):
+async def sampleStats(handler, projectid=None):
+    if summary.service.enabled:
+        return summary.service.get(projectid)
     data={}
     if projectid:
         total=projectid+"_TOTAL"
@@ -25,6 +31,7 @@ def sampleStats(handler, projectid=None):
         failed=projectid+"_FAILED"
         running=projectid+"_UNDER_ANALYSIS"
         coverage=projectid+"_TOTAL_COV"
+        sequenced=projectid+"_SEQUENCED"
     else:
         total="TOTAL"
         aborted="ABORTED"
@@ -33,72 +40,71 @@ def sampleStats(handler, projectid=None):
         failed="FAILED"
         running="UNDER_ANALYSIS"
         coverage="TOTAL_COV"
+        sequenced="SEQUENCED"
 
-    view = handler.db.view('sample/summary_count')
-    pview = handler.db.view('project/projectid')
-    seqview = handler.db.view('sample/sequenced', group=True)
+    db = handler.async_db
+    counts = dict([(r.key, r.value)
+                   for r in await db.view('sample/summary_count', group=True,
+                                          keys=[total, aborted, passed,
+                                                passed_unab, failed,
+                                                running, coverage,
+                                                sequenced])])
     try:
-        data['tot'] = view[total].rows[0].value
+        data['tot'] = counts[total]
     except (KeyError, IndexError):
         data['tot']=0
     try:
-        data['ab'] = view[aborted].rows[0].value
+        data['ab'] = counts[aborted]
     except (KeyError, IndexError):
         data['ab']=0
     try:
-        data['passed'] = view[passed].rows[0].value
+        data['passed'] = counts[passed]
     except (KeyError, IndexError):
         data['passed']=0
     try:
-        data['passed_unab'] = view[passed_unab].rows[0].value
+        data['passed_unab'] = counts[passed_unab]
     except (KeyError, IndexError):
         data['passed_unab']=0
     try:
-        data['failed'] = view[failed].rows[0].value
+        data['failed'] = counts[failed]
     except (KeyError, IndexError):
         data['failed']=0
     data['ana'] = data['passed'] + data['failed']
     try:
-        data['runn'] = view[running].rows[0].value
+        data['runn'] = counts[running]
     except (KeyError, IndexError):
         data['runn']=0
     try:
-        seq=0
-        if projectid:
-            for row in seqview[[projectid, '']:[projectid, constants.HIGH_CHAR]]:
-                seq+=1
-        else:
-            for row in seqview:
-                seq+=1
-        data['seq'] = seq
+        data['seq'] = counts[sequenced]
     except (KeyError, IndexError):
         data['seq']=0
     try:
-        data['cov'] = view[coverage].rows[0].value
+        data['cov'] = counts[coverage]
     except (KeyError, IndexError):
         data['cov']=0
     data['hge'] = int(data['cov'] / 30)
     try:
-        data['gdp'] = handler.db.get(pview[projectid].rows[0].id)['delivery_projects']
-    except (KeyError, IndexError):
+        rows = await db.view('project/projectid', key=projectid)
+        data['gdp'] = (await db.get(rows[0].id))['delivery_projects']
+    except (KeyError, IndexError, couchdb.http.ResourceNotFound):
         data['gdp'] = []
 
     return data
 
 class SummaryAPI(ApiRequestHandler):
     """Summarizes data for the whole DB, or one project"""
-    def get(self):
+    async def get(self):
         """returns stats from the DB as JSON data  """
         project_id=self.get_argument("projectid", default=None)
-        self.write(json.dumps(sampleStats(self, project_id)))
+        self.write(json.dumps(await sampleStats(self, project_id)))
 
 
 class Summary(RequestHandler):
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         project_id=self.get_argument("projectid", default=None)
-        data=sampleStats(self, project_id)
+        data=await sampleStats(self, project_id)
         self.render('summary.html', data=data)
 
 
@@ -106,29 +112,30 @@ class Summary(RequestHandler):
 class Home(RequestHandler):
     "Home page: Form to login or link to create new account. Links to pages."
 
-    def get(self):
+    async def get(self):
+        db = self.async_db
         try:
-            samples_count = self.db.view('sample/count').rows[0].value
+            samples_count = (await db.view('sample/count'))[0].value
         except IndexError:
             samples_count = 0
         try:
-            libpreps_count = self.db.view('libprep/count').rows[0].value
+            libpreps_count = (await db.view('libprep/count'))[0].value
         except IndexError:
             libpreps_count = 0
-        view = self.db.view('project/modified', limit=10,
-                            descending=True,
-                            include_docs=True)
-        projects = [r.doc for r in view]
-        view = self.db.view('sample/modified', limit=10,
-                            descending=True,
-                            include_docs=True)
-        samples = [r.doc for r in view]
-        view = self.db.view('libprep/modified', limit=10,
-                            descending=True,
-                            include_docs=True)
-        libpreps = [r.doc for r in view]
+        rows = await db.view('project/modified', limit=10,
+                             descending=True,
+                             include_docs=True)
+        projects = [r.doc for r in rows]
+        rows = await db.view('sample/modified', limit=10,
+                             descending=True,
+                             include_docs=True)
+        samples = [r.doc for r in rows]
+        rows = await db.view('libprep/modified', limit=10,
+                             descending=True,
+                             include_docs=True)
+        libpreps = [r.doc for r in rows]
         self.render('home.html',
-                    projects_count=len(list(self.db.view('project/name'))),
+                    projects_count=len(await db.view('project/name')),
                     samples_count=samples_count,
                     libpreps_count=libpreps_count,
                     projects=projects,
@@ -141,32 +148,48 @@ class Search(RequestHandler):
     "Search page."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
+        """Search the in-memory index, if enabled, for at most
+        'limit' items, else the views."""
         term = self.get_argument('term', '')
+        if search.index.enabled:
+            try:
+                limit = self.get_limit()
+            except ValueError:
+                raise tornado.web.HTTPError(400, reason='invalid limit')
+            self.render('search.html',
+                        term=term,
+                        items=search.index.search(term, limit=limit))
+            return
         items = dict()
         if term:
-            view = self.db.view('project/projectid')
-            for row in view[term : term+constants.HIGH_CHAR]:
-                doc = self.get_project(row.key)
+            rows = await self.async_db.view('project/projectid', startkey=term,
+                                            endkey=term+constants.HIGH_CHAR)
+            for row in rows:
+                doc = await self.get_project(row.key)
                 items[doc['_id']] = doc
-            view = self.db.view('project/name')
-            for row in view[term : term+constants.HIGH_CHAR]:
-                doc = self.get_project(row.value)
+            rows = await self.async_db.view('project/name', startkey=term,
+                                            endkey=term+constants.HIGH_CHAR)
+            for row in rows:
+                doc = await self.get_project(row.value)
                 items[doc['_id']] = doc
-            view = self.db.view('project/splitname')
-            for row in view[term : term+constants.HIGH_CHAR]:
-                doc = self.get_project(row.value)
+            rows = await self.async_db.view('project/splitname', startkey=term,
+                                            endkey=term+constants.HIGH_CHAR)
+            for row in rows:
+                doc = await self.get_project(row.value)
                 items[doc['_id']] = doc
-            view = self.db.view('user/email')
-            for row in view[term : term+constants.HIGH_CHAR]:
+            rows = await self.async_db.view('user/email', startkey=term,
+                                            endkey=term+constants.HIGH_CHAR)
+            for row in rows:
                 doc = self.get_user(row.key)
                 items[doc['_id']] = doc
-            view = self.db.view('user/name')
-            for row in view[term : term+constants.HIGH_CHAR]:
+            rows = await self.async_db.view('user/name', startkey=term,
+                                            endkey=term+constants.HIGH_CHAR)
+            for row in rows:
                 doc = self.get_user(row.value)
                 items[doc['_id']] = doc
         items = sorted(list(items.values()),
-                       key=functools.cmp_to_key(lambda i,j: utils.cmp(i['modified'], j['modified'])),
+                       key=lambda i: i.get('modified') or '',
                        reverse=True)
         self.render('search.html',
                     term=term,
@@ -190,6 +213,8 @@ class ApiHome(ApiRequestHandler):
                              title='software versions'),
                 projects=dict(href=self.get_absolute_url('api_projects'),
                               title='all projects'),
+                changes=dict(href=self.get_absolute_url('api_changes'),
+                             title='changes of entities'),
                 ))
         self.write(data)
 
@@ -210,6 +235,48 @@ class ApiVersion(ApiRequestHandler):
         self.write(dict(utils.get_versions()))
 
 
+class ApiStatistics(ApiRequestHandler):
+    "Access to run-time statistics of this server process."
+
+    def get(self):
+        """Return the utilization statistics for the CouchDB connection pool,
+        the request count for the non-blocking CouchDB client,
+        the hit and miss counts for the document and API token caches,
+        the log writer mode and queue, and the summary service and
+        search index states."""
+        self.write(dict(db_pool=utils.get_db_pool_stats(),
+                        async_db=self.async_db.get_stats(),
+                        document_cache=cache.documents.get_stats(),
+                        token_cache=cache.tokens.get_stats(),
+                        log_writer=logwriter.get_stats(),
+                        summary=summary.service.get_stats(),
+                        search=search.index.get_stats()))
+
+
+class ApiMetrics(ApiRequestHandler):
+    "Access to performance metrics of this server process."
+
+    def get(self):
+        """Return the request counts, latencies, CouchDB calls and views,
+        and serialization, rendering and save times per URL name, and the
+        current connection pool and cache figures, in Prometheus format."""
+        pool = utils.get_db_pool_stats()
+        documents = cache.documents.get_stats()
+        tokens = cache.tokens.get_stats()
+        gauges = dict(
+            db_pool_in_use=('CouchDB connections in use.', pool['in_use']),
+            db_pool_idle=('Idle CouchDB connections.', pool['idle']),
+            document_cache_size=('Documents in the cache.',
+                                 documents['size']),
+            document_cache_hits_total=('Document cache hits.',
+                                       documents['hits']),
+            document_cache_misses_total=('Document cache misses.',
+                                         documents['misses']),
+            token_cache_size=('API tokens in the cache.', tokens['size']))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.registry.get_text(gauges))
+
+
 class ApiDocumentation(RequestHandler):
     "Documentation of the API generated by introspection."
 
@@ -3,6 +3,9 @@
 1) Wipeout the old database.
 2) Load the design documents.
 3) Load the dump file, if any.
+
+With --resume, an interrupted load of the dump file is continued
+from its checkpoint file, without wiping out the database.
 """
 
 import os
@@ -35,9 +38,16 @@ if __name__ == '__main__':
     parser.add_option("-f", "--force",
                       action="store_true", dest="force", default=True,
                       help='force action, rather than ask for confirmation')
+    parser.add_option("-r", "--resume",
+                      action="store_true", dest="resume", default=False,
+                      help='continue an interrupted load of the dump file,'
+                      ' without wiping out the database')
+    parser.add_option("-b", "--batch-size",
+                      type="int", dest="batch_size", default=500,
+                      help='number of items saved per request')
     (options, args) = parser.parse_args()
 
-    if not options.force:
+    if not options.force and not options.resume:
         response = input('about to delete everything; really sure? [n] > ')
         if not utils.to_bool(response):
             sys.exit('aborted')
@@ -50,8 +60,9 @@ if __name__ == '__main__':
     utils.load_settings(filepath=filepath)
 
     db = utils.get_db()
-    wipeout_database(db)
-    print('wiped out database')
+    if not options.resume:
+        wipeout_database(db)
+        print('wiped out database')
     load_designs(db)
     print('loaded designs')
     default = 'dump.tar.gz'
@@ -61,8 +72,13 @@ if __name__ == '__main__':
         filename = input("load data from file? [{0}] > ".format(default))
         if not filename:
             filename = default
+    checkpoint = filename + '.checkpoint'
+    if not options.resume and os.path.exists(checkpoint):
+        os.remove(checkpoint)
     if os.path.exists(filename):
-        count_items, count_files = undump(db, filename)
+        count_items, count_files = undump(db, filename,
+                                          batch_size=options.batch_size,
+                                          checkpoint=checkpoint)
         print('undumped', count_items, 'items and', count_files, 'files from', filename)
     else:
         print('no such file to undump')
@@ -17,13 +17,15 @@ from .saver import *
 class LibprepidField(IdField):
     "The unique identifier for the libprep within the sample."
 
+    unique_view = 'libprep/libprepid'
+    unique_parents = ('projectid', 'sampleid')
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         super(LibprepidField, self).check_valid(saver, value)
-        key = (saver.project['projectid'], saver.sample['sampleid'], value)
-        view = saver.db.view('libprep/libprepid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value,
+                          dict(projectid=saver.project['projectid'],
+                               sampleid=saver.sample['sampleid']))
 
 
 class LibprepSaver(Saver):
@@ -41,19 +43,19 @@ class LibprepSaver(Saver):
         if self.is_new():
             assert sample
             assert 'sampleid' not in self.doc
-            self.project = rqh.get_project(sample['projectid'])
-            self.sample = sample
             self.doc['projectid'] = sample['projectid']
             self.doc['sampleid'] = sample['sampleid']
-        else:
-            self.project = rqh.get_project(self.doc['projectid'])
-            if sample:
-                assert (self.doc['sampleid'] == sample['sampleid']) and \
-                    (self.doc['projectid'] == sample['projectid'])
-                self.sample = sample
-            else:
-                self.sample = rqh.get_sample(self.doc['projectid'],
-                                             self.doc['sampleid'])
+        elif sample:
+            assert (self.doc['sampleid'] == sample['sampleid']) and \
+                (self.doc['projectid'] == sample['projectid'])
+        self.sample = sample
+
+    async def setup(self):
+        "Get the project, and the sample unless given."
+        self.project = await self.rqh.get_project(self.doc['projectid'])
+        if self.sample is None:
+            self.sample = await self.rqh.get_sample(self.doc['projectid'],
+                                                    self.doc['sampleid'])
 
 class Libprep(RequestHandler):
     "Display the libprep data."
@@ -61,10 +63,10 @@ class Libprep(RequestHandler):
     saver = LibprepSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid, libprepid):
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
-        seqruns = self.get_seqruns(projectid, sampleid, libprepid)
-        logs = self.get_logs(libprep['_id']) # XXX limit?
+    async def get(self, projectid, sampleid, libprepid):
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
+        seqruns = await self.get_seqruns(projectid, sampleid, libprepid)
+        logs = await self.get_logs(libprep['_id']) # XXX limit?
         self.render('libprep.html',
                     libprep=libprep,
                     seqruns=seqruns,
@@ -78,23 +80,23 @@ class LibprepCreate(RequestHandler):
     saver = LibprepSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid):
-        sample = self.get_sample(projectid, sampleid)
+    async def get(self, projectid, sampleid):
+        sample = await self.get_sample(projectid, sampleid)
         self.render('libprep_create.html',
                     sample=sample,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid, sampleid):
+    async def post(self, projectid, sampleid):
         self.check_xsrf_cookie()
-        sample = self.get_sample(projectid, sampleid)
+        sample = await self.get_sample(projectid, sampleid)
         try:
-            with self.saver(rqh=self, sample=sample) as saver:
+            async with self.saver(rqh=self, sample=sample) as saver:
                 saver.store()
                 libprep = saver.doc
         except (IOError, ValueError) as msg:
             self.render('libprep_create.html',
-                        project=self.get_project(projectid),
+                        project=await self.get_project(projectid),
                         sample=sample,
                         fields=self.saver.fields,
                         error=str(msg))
@@ -112,18 +114,18 @@ class LibprepEdit(RequestHandler):
     saver = LibprepSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid, libprepid):
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+    async def get(self, projectid, sampleid, libprepid):
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         self.render('libprep_edit.html',
                     libprep=libprep,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid, sampleid, libprepid):
+    async def post(self, projectid, sampleid, libprepid):
         self.check_xsrf_cookie()
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         try:
-            with self.saver(doc=libprep, rqh=self) as saver:
+            async with self.saver(doc=libprep, rqh=self) as saver:
                 saver.store()
         except (IOError, ValueError) as msg:
             self.render('libprep_edit.html',
@@ -140,27 +142,27 @@ class ApiLibprep(ApiRequestHandler):
 
     saver = LibprepSaver
 
-    def get(self, projectid, sampleid, libprepid):
+    async def get(self, projectid, sampleid, libprepid):
         """Return the libprep data as JSON.
         Return HTTP 404 if no such libprep, sample or project."""
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         if not libprep: return
         self.add_libprep_links(libprep)
         self.write(libprep)
 
-    def put(self, projectid, sampleid, libprepid):
+    async def put(self, projectid, sampleid, libprepid):
         """Update the libprep with the given JSON data.
         Return HTTP 204 "No Content".
         Return HTTP 400 if the input data is invalid.
         Return HTTP 409 if there is a document revision conflict."""
         try:
-            libprep = self.get_libprep(projectid, sampleid, libprepid)
+            libprep = await self.get_libprep(projectid, sampleid, libprepid)
             data = json.loads(self.request.body)
         except Exception as msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=libprep, rqh=self) as saver:
+                async with self.saver(doc=libprep, rqh=self) as saver:
                     saver.store(data=data)
             except ValueError as msg:
                 self.send_error(400, reason=str(msg))
@@ -168,11 +170,11 @@ class ApiLibprep(ApiRequestHandler):
                 self.send_error(409, reason=str(msg))
             else:
                 self.set_status(204)
-    def delete(self, projectid, sampleid, libprepid):
+    async def delete(self, projectid, sampleid, libprepid):
         """NOTE: This is for unit test purposes only!
         Delete the libprepand all of its dependent entities.
         Returns HTTP 204 "No Content"."""
-        libprep= self.get_libprep(projectid, sampleid, libprepid)
+        libprep= await self.get_libprep(projectid, sampleid, libprepid)
         if not libprep: return
         utils.delete_libprep(self.db, libprep)
         logging.debug("deleted libprep {0}, {1}, {2}",
@@ -185,15 +187,15 @@ class ApiLibprepCreate(ApiRequestHandler):
 
     saver = LibprepSaver
 
-    def post(self, projectid, sampleid):
+    async def post(self, projectid, sampleid):
         """Create a libprep within a sample.
         Return HTTP 201, libprep URL in header "Location", and libprep data.
         Return HTTP 400 if something is wrong with the input data.
         Return HTTP 404 if no such project or sample.
         Return HTTP 409 if there is a document revision conflict."""
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         if not project: return
-        sample = self.get_sample(projectid, sampleid)
+        sample = await self.get_sample(projectid, sampleid)
         if not sample: return
         try:
             data = json.loads(self.request.body)
@@ -201,7 +203,7 @@ class ApiLibprepCreate(ApiRequestHandler):
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(rqh=self, sample=sample) as saver:
+                async with self.saver(rqh=self, sample=sample) as saver:
                     saver.store(data=data)
                     libprep = saver.doc
             except (KeyError, ValueError) as msg:
@@ -222,20 +224,24 @@ class ApiLibprepCreate(ApiRequestHandler):
 class ApiProjectLibpreps(ApiRequestHandler):
     "Access to all libpreps for a project."
 
-    def get(self, projectid):
-        "Return a list of all libpreps for the given project."
-        libpreps = self.get_libpreps(projectid)
-        for libprep in libpreps:
-            self.add_libprep_links(libprep)
-        self.write(dict(libpreps=libpreps))
+    async def get(self, projectid):
+        """Return a list of all libpreps for the given project.
+        The libpreps are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'.
+        One page of libpreps if the query argument 'limit' or 'cursor'
+        is given, with the cursor and link for the next page."""
+        await self.write_page('libprep/libprepid',
+                              self.get_libpreps_range(projectid),
+                              key='libpreps',
+                              add_links=self.add_libprep_links)
 
 
 class ApiSampleLibpreps(ApiRequestHandler):
     "Access to all libpreps for a sample."
 
-    def get(self, projectid, sampleid):
+    async def get(self, projectid, sampleid):
         "Return a list of all libpreps for the given sample and project."
-        libpreps = self.get_libpreps(projectid, sampleid)
+        libpreps = await self.get_libpreps(projectid, sampleid)
         for libprep in libpreps:
             self.add_libprep_links(libprep)
         self.write(dict(libpreps=libpreps))
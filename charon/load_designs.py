@@ -8,15 +8,10 @@ import couchdb
 
 def load_designs(db, root='designs'):
     for design in os.listdir(root):
-        views = dict()
         path = os.path.join(root, design)
         if not os.path.isdir(path): continue
-        path = os.path.join(root, design, 'views')
-        for filename in os.listdir(path):
-            name, ext = os.path.splitext(filename)
-            if ext != '.js': continue
-            with open(os.path.join(path, filename)) as codefile:
-                code = codefile.read()
+        views = dict()
+        for name, code in read_functions(os.path.join(path, 'views')):
             if name.startswith('map_'):
                 name = name[len('map_'):]
                 key = 'map'
@@ -26,20 +21,44 @@ def load_designs(db, root='designs'):
             else:
                 key = 'map'
             views.setdefault(name, dict())[key] = code
+        functions = dict()
+        for key in ('lists', 'filters'):
+            functions[key] = dict(read_functions(os.path.join(path, key)))
         id = "_design/%s" % design
         try:
             doc = db[id]
         except couchdb.http.ResourceNotFound:
             logging.debug("loading %s", id)
-            db.save(dict(_id=id, views=views))
+            doc = dict(_id=id, views=views)
+            for key, value in functions.items():
+                if value:
+                    doc[key] = value
+            db.save(doc)
         else:
-            if doc['views'] != views:
+            if doc['views'] != views or \
+               any([doc.get(k, dict()) != v for k, v in functions.items()]):
                 doc['views'] = views
+                for key, value in functions.items():
+                    if value:
+                        doc[key] = value
+                    else:
+                        doc.pop(key, None)
                 logging.debug("updating %s", id)
                 db.save(doc)
             else:
                 logging.debug("no change %s", id)
 
+def read_functions(path):
+    "Return a list of (name, code) for the JavaScript files in the directory."
+    result = []
+    if not os.path.isdir(path): return result
+    for filename in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(filename)
+        if ext != '.js': continue
+        with open(os.path.join(path, filename)) as codefile:
+            result.append((name, codefile.read()))
+    return result
+
 
 if __name__ == '__main__':
     import sys
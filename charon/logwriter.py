@@ -0,0 +1,183 @@
+" Charon: Writing entity documents together with their log entries. "
+
+import logging
+import asyncio
+
+import tornado.queues
+import couchdb
+
+from . import settings
+from . import cache
+
+
+def get_error(result):
+    "Return the couchdb.http exception for a failed '_bulk_docs' result."
+    if result['error'] == 'conflict':
+        return couchdb.http.ResourceConflict(
+            (result['error'], result.get('reason')))
+    return couchdb.http.ServerError((result['error'], result.get('reason')))
+
+async def save(async_db, doc, entry=None):
+    """Save the document and its log entry, if any.
+    Both are saved in one '_bulk_docs' request, unless the background
+    mode is set by settings['LOG_WRITE_MODE'], in which case the log
+    entry is queued for writing later.
+    Raise couchdb.http.ResourceConflict if revision update conflict."""
+    if entry is None:
+        await async_db.save(doc)
+    elif settings.get('LOG_WRITE_MODE') == 'background':
+        await async_db.save(doc)
+        await get_background(async_db).put(entry)
+    else:
+        results = await async_db.bulk_docs([doc, entry])
+        if 'error' in results[0]:
+            await delete_orphans(async_db, [entry])
+            raise get_error(results[0])
+
+def save_sync(db, doc, entry=None):
+    """Save the document and its log entry, if any, in one '_bulk_docs'
+    request, using the blocking database connection.
+    Raise couchdb.http.ResourceConflict if revision update conflict."""
+    if entry is None:
+        db.save(doc)
+        return
+    results = db.update([doc, entry])
+    if not results[0][0]:
+        if results[1][0]:
+            db.update([dict(_id=entry['_id'], _rev=entry['_rev'],
+                            _deleted=True)])
+        raise results[0][2]
+
+async def delete_orphans(async_db, entries):
+    "Delete the saved log entries for documents which could not be saved."
+    orphans = [dict(_id=e['_id'], _rev=e['_rev'], _deleted=True)
+               for e in entries if '_rev' in e]
+    if not orphans: return
+    try:
+        await async_db.bulk_docs(orphans)
+    except couchdb.http.HTTPError as msg:
+        logging.warning("could not delete orphaned log entries: %s", msg)
+
+
+class Batch(object):
+    """Buffer of entity documents and their log entries, all of which
+    are saved by flush in as few '_bulk_docs' requests as possible.
+    Use for operations that update many entities at once."""
+
+    def __init__(self, async_db, size=500):
+        self.async_db = async_db
+        self.size = size
+        self.docs = dict()              # doc id -> doc, in order added
+        self.entries = dict()           # doc id -> list of log entries
+
+    def add(self, doc, entry=None):
+        """Add the document, and its log entry, if any.
+        A document added again is saved once, in its latest state."""
+        self.docs[doc['_id']] = doc
+        if entry is not None:
+            self.entries.setdefault(doc['_id'], []).append(entry)
+
+    async def flush(self):
+        """Save the buffered documents and log entries.
+        Return a list of (doc, exception) for documents not saved;
+        the log entries for those are deleted."""
+        failed = []
+        docs = self.docs
+        self.docs = dict()
+        entries = self.entries
+        self.entries = dict()
+        # Each entity document is followed by its log entries, if any.
+        items = []
+        for docid, doc in docs.items():
+            items.append(doc)
+            items.extend(entries.get(docid, []))
+        for pos in range(0, len(items), self.size):
+            chunk = items[pos:pos+self.size]
+            try:
+                results = await self.async_db.bulk_docs(chunk)
+            finally:
+                for doc in chunk:
+                    if doc['_id'] in docs:
+                        cache.documents.evict(doc['_id'])
+            for doc, result in zip(chunk, results):
+                if 'error' in result and doc['_id'] in docs:
+                    failed.append((doc, get_error(result)))
+        await delete_orphans(self.async_db,
+                             sum([entries.get(doc['_id'], [])
+                                  for doc, error in failed], []))
+        return failed
+
+
+class BackgroundWriter(object):
+    """Log entries are put into a bounded queue, from which a task
+    writes them in '_bulk_docs' requests. When the queue is full,
+    putting an entry waits until there is room."""
+
+    def __init__(self, async_db, maxsize=1000, batch_size=100):
+        self.async_db = async_db
+        self.queue = tornado.queues.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.task = None
+        self.written = 0
+        self.failed = 0
+
+    async def put(self, entry):
+        "Put the log entry in the queue; start the writer task if needed."
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        await self.queue.put(entry)
+
+    async def run(self):
+        "Write the entries in the queue, in batches, as they arrive."
+        while True:
+            entries = [await self.queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except tornado.queues.QueueEmpty:
+                    break
+            try:
+                results = await self.async_db.bulk_docs(entries)
+            except Exception as msg:
+                logging.error("could not write %s log entries: %s",
+                              len(entries), msg)
+                self.failed += len(entries)
+            else:
+                failed = len([r for r in results if 'error' in r])
+                if failed:
+                    logging.error("could not write %s log entries", failed)
+                self.written += len(entries) - failed
+                self.failed += failed
+            for entry in entries:
+                self.queue.task_done()
+
+    async def join(self):
+        "Wait until all entries put into the queue have been written."
+        await self.queue.join()
+
+    def get_stats(self):
+        "Return the queue statistics as a dictionary."
+        return dict(queued=self.queue.qsize(),
+                    maxsize=self.queue.maxsize,
+                    written=self.written,
+                    failed=self.failed)
+
+
+_background = None
+
+def get_background(async_db):
+    """Return the process-wide background log writer, with the queue
+    size given by settings['LOG_QUEUE_SIZE']."""
+    global _background
+    if _background is None:
+        _background = BackgroundWriter(
+            async_db, maxsize=settings.get('LOG_QUEUE_SIZE', 1000))
+    return _background
+
+def get_stats():
+    "Return the statistics for the background log writer, if in use."
+    if _background is None:
+        return dict(mode=settings.get('LOG_WRITE_MODE') or 'bulk')
+    result = _background.get_stats()
+    result['mode'] = settings.get('LOG_WRITE_MODE') or 'bulk'
+    return result
@@ -0,0 +1,210 @@
+" Charon: Performance metrics per request, aggregated per URL name. "
+
+import re
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+from . import settings
+
+
+# Upper bounds of the request latency histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+VIEW_RX = re.compile(r'/_design/([^/]+)/_view/([^/?]+)')
+
+# The metrics of the request currently being handled, if any.
+current = contextvars.ContextVar('charon_request_metrics', default=None)
+
+
+class RequestMetrics(object):
+    "Performance data for one request."
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.views = dict()             # view name -> [calls, seconds]
+        self.seconds = dict(serialize=0.0, render=0.0, save=0.0)
+
+    def elapsed(self):
+        "Return the number of seconds since the start of the request."
+        return time.monotonic() - self.start
+
+    def db_call(self, seconds, view=None):
+        "Record a CouchDB call, and the view it was for, if any."
+        self.db_calls += 1
+        self.db_seconds += seconds
+        if view:
+            counts = self.views.setdefault(view, [0, 0.0])
+            counts[0] += 1
+            counts[1] += seconds
+
+
+def begin():
+    "Start recording the metrics for the current request, and return them."
+    metrics = RequestMetrics()
+    current.set(metrics)
+    return metrics
+
+def record_db_call(url, seconds):
+    "Record a CouchDB call for the URL in the current request, if any."
+    metrics = current.get()
+    if metrics is None: return
+    match = VIEW_RX.search(url)
+    metrics.db_call(seconds, view=match and "{0}/{1}".format(*match.groups()))
+
+@contextlib.contextmanager
+def timer(kind):
+    """Add the time spent within the context to the given kind
+    ('serialize', 'render' or 'save') for the current request, if any."""
+    metrics = current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        metrics.seconds[kind] += time.monotonic() - start
+
+
+class Registry(object):
+    "Metrics aggregated per URL name, for the life of the process."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = dict()          # URL name -> dict of totals
+        self.views = dict()             # view name -> [calls, seconds]
+
+    def add(self, name, status, metrics, latency):
+        "Add the metrics for a finished request to the totals."
+        with self.lock:
+            try:
+                totals = self.handlers[name]
+            except KeyError:
+                totals = self.handlers[name] = dict(
+                    statuses=dict(),
+                    buckets=[0] * len(BUCKETS),
+                    count=0,
+                    latency=0.0,
+                    db_calls=0,
+                    db_seconds=0.0,
+                    seconds=dict(serialize=0.0, render=0.0, save=0.0))
+            totals['statuses'][status] = totals['statuses'].get(status, 0) + 1
+            for pos, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    totals['buckets'][pos] += 1
+            totals['count'] += 1
+            totals['latency'] += latency
+            totals['db_calls'] += metrics.db_calls
+            totals['db_seconds'] += metrics.db_seconds
+            for kind, seconds in metrics.seconds.items():
+                totals['seconds'][kind] += seconds
+            for view, (calls, seconds) in metrics.views.items():
+                counts = self.views.setdefault(view, [0, 0.0])
+                counts[0] += calls
+                counts[1] += seconds
+
+    def clear(self):
+        "Discard all totals."
+        with self.lock:
+            self.handlers.clear()
+            self.views.clear()
+
+    def get_text(self, gauges=None):
+        """Return the totals in Prometheus text exposition format.
+        The gauges, if given, is a dictionary of metric name to
+        (help text, value) for additional current values; those
+        with a name ending in '_total' are given as counters."""
+        lines = []
+        def metric(name, type, help, samples):
+            lines.append("# HELP charon_{0} {1}".format(name, help))
+            lines.append("# TYPE charon_{0} {1}".format(name, type))
+            for labels, value in samples:
+                labels = ','.join(['{0}="{1}"'.format(k, v)
+                                   for k, v in labels])
+                lines.append("charon_{0}{1} {2}".format(
+                    name, labels and "{%s}" % labels or '', value))
+        with self.lock:
+            handlers = sorted(self.handlers.items())
+            metric('requests_total', 'counter',
+                   'Number of requests handled, by URL name and HTTP status.',
+                   [((('handler', n), ('status', s)), c)
+                    for n, t in handlers
+                    for s, c in sorted(t['statuses'].items())])
+            lines.append('# HELP charon_request_duration_seconds'
+                         ' Request latency, by URL name.')
+            lines.append('# TYPE charon_request_duration_seconds histogram')
+            for name, totals in handlers:
+                bounds = list(BUCKETS) + ['+Inf']
+                counts = totals['buckets'] + [totals['count']]
+                for bound, count in zip(bounds, counts):
+                    lines.append('charon_request_duration_seconds_bucket'
+                                 '{{handler="{0}",le="{1}"}} {2}'.format(
+                                     name, bound, count))
+                lines.append('charon_request_duration_seconds_sum'
+                             '{{handler="{0}"}} {1}'.format(
+                                 name, totals['latency']))
+                lines.append('charon_request_duration_seconds_count'
+                             '{{handler="{0}"}} {1}'.format(
+                                 name, totals['count']))
+            metric('db_calls_total', 'counter',
+                   'Number of CouchDB calls, by URL name.',
+                   [((('handler', n),), t['db_calls']) for n, t in handlers])
+            metric('db_seconds_total', 'counter',
+                   'Time spent in CouchDB calls, by URL name.',
+                   [((('handler', n),), t['db_seconds']) for n, t in handlers])
+            for kind, help in [('serialize', 'JSON serialization'),
+                               ('render', 'template rendering'),
+                               ('save', 'saving entities')]:
+                metric("{0}_seconds_total".format(kind), 'counter',
+                       "Time spent on {0}, by URL name.".format(help),
+                       [((('handler', n),), t['seconds'][kind])
+                        for n, t in handlers])
+            views = sorted(self.views.items())
+            metric('view_calls_total', 'counter',
+                   'Number of CouchDB view queries, by view.',
+                   [((('view', v),), c[0]) for v, c in views])
+            metric('view_seconds_total', 'counter',
+                   'Time spent in CouchDB view queries, by view.',
+                   [((('view', v),), c[1]) for v, c in views])
+        for name, (help, value) in sorted((gauges or dict()).items()):
+            type = name.endswith('_total') and 'counter' or 'gauge'
+            metric(name, type, help, [((), value)])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+def finish(handler, metrics):
+    """Add the metrics of the finished request to the totals of its
+    URL name. Log the request if slower than settings['SLOW_REQUEST_SECONDS'],
+    when set."""
+    latency = metrics.elapsed()
+    name = get_url_name(handler)
+    registry.add(name, handler.get_status(), metrics, latency)
+    threshold = settings.get('SLOW_REQUEST_SECONDS')
+    if threshold and latency >= threshold:
+        logging.warning("slow request %s %s (%s): %.3f s; %s CouchDB calls"
+                        " %.3f s; views %s; serialize %.3f s; render %.3f s;"
+                        " save %.3f s",
+                        handler.request.method, handler.request.uri, name,
+                        latency, metrics.db_calls, metrics.db_seconds,
+                        ', '.join(["{0} {1}x {2:.3f} s".format(v, c, s)
+                                   for v, (c, s) in metrics.views.items()])
+                        or '-',
+                        metrics.seconds['serialize'],
+                        metrics.seconds['render'],
+                        metrics.seconds['save'])
+
+def get_url_name(handler):
+    """Return the name of the URL spec in the application that matched
+    the request; the handler class name if the spec has no name."""
+    for rule in handler.application.wildcard_router.rules:
+        if rule.target is not type(handler): continue
+        if rule.matcher.match(handler.request) is not None:
+            return rule.name or rule.target.__name__
+    return type(handler).__name__
@@ -0,0 +1,297 @@
+"""Benchmark the Charon API with synthetic projects.
+
+Runs the Charon web application in-process, against either the fake
+CouchDB server in fakecouch.py (the default) or a local CouchDB server,
+such as one in a container. A new database is created and seeded with
+projects of the given shape, using the API itself. Each endpoint is
+then called repeatedly from a number of concurrent clients, and the
+p50, p95 and p99 latencies and requests per second are reported.
+The results can be saved to a JSON file, for comparison between releases.
+
+Usage: benchmark.py [options]; see --help.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import datetime
+import threading
+import concurrent.futures
+
+import couchdb
+import requests
+import tornado
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+import charon
+from charon import constants
+from charon import settings
+from charon import utils
+from charon import cache
+from charon import summary
+from charon import search
+from charon.load_designs import load_designs
+
+import fakecouch
+
+API_TOKEN = 'benchmark'
+SEED_CHUNK = 200
+
+
+def get_endpoints(shape):
+    """Return the list of endpoints to benchmark, as tuples
+    (name, method, function returning path and body given random state).
+    The entities referred to are picked at random from the seeded ones."""
+    def project(r):
+        return "{0}".format(pick_project(r, shape))
+    def sample(r):
+        return "{0}/{1}".format(project(r), pick_sample(r, shape))
+    def libprep(r):
+        return "{0}/{1}".format(sample(r), pick_libprep(r, shape))
+    def seqrun(r):
+        return "{0}/{1}".format(libprep(r), pick_seqrun(r, shape))
+    def update(r):
+        status = r.choice(['TO_ANALYZE', 'UNDER_ANALYSIS', 'ANALYZED'])
+        return dict(analysis_status=status)
+    return [('project', 'GET', lambda r: ('project/' + project(r), None)),
+            ('projects', 'GET', lambda r: ('projects', None)),
+            ('samples', 'GET', lambda r: ('samples/' + project(r), None)),
+            ('sample', 'GET', lambda r: ('sample/' + sample(r), None)),
+            ('libpreps', 'GET', lambda r: ('libpreps/' + project(r), None)),
+            ('libprep', 'GET', lambda r: ('libprep/' + libprep(r), None)),
+            ('seqruns', 'GET', lambda r: ('seqruns/' + project(r), None)),
+            ('seqrun', 'GET', lambda r: ('seqrun/' + seqrun(r), None)),
+            ('samplesnotdone', 'GET',
+             lambda r: ('samplesnotdone/' + project(r), None)),
+            ('summary', 'GET',
+             lambda r: ('summary?projectid=' + project(r), None)),
+            ('sample_update', 'PUT',
+             lambda r: ('sample/' + sample(r), update(r)))]
+
+def pick_project(r, shape):
+    return "BENCH_{0}".format(r.randrange(shape['projects']))
+
+def pick_sample(r, shape):
+    return "S{0}".format(r.randrange(shape['samples']))
+
+def pick_libprep(r, shape):
+    return chr(ord('A') + r.randrange(shape['libpreps']))
+
+def pick_seqrun(r, shape):
+    return "R{0}".format(r.randrange(shape['seqruns']))
+
+def get_seed_items(shape):
+    "Yield the bulk API items for creating the synthetic projects."
+    for p in range(shape['projects']):
+        projectid = "BENCH_{0}".format(p)
+        yield dict(action='create', entity='project',
+                   data=dict(projectid=projectid,
+                             name="B.Bench_{0}".format(p),
+                             status='OPEN',
+                             best_practice_analysis='whole_genome_reseq',
+                             sequencing_facility='NGI-S'))
+        for s in range(shape['samples']):
+            sampleid = "S{0}".format(s)
+            yield dict(action='create', entity='sample', projectid=projectid,
+                       data=dict(sampleid=sampleid,
+                                 analysis_status='TO_ANALYZE'))
+            for l in range(shape['libpreps']):
+                libprepid = chr(ord('A') + l)
+                yield dict(action='create', entity='libprep',
+                           projectid=projectid, sampleid=sampleid,
+                           data=dict(libprepid=libprepid))
+                for q in range(shape['seqruns']):
+                    yield dict(action='create', entity='seqrun',
+                               projectid=projectid, sampleid=sampleid,
+                               libprepid=libprepid,
+                               data=dict(seqrunid="R{0}".format(q),
+                                         total_reads=1000000,
+                                         mean_autosomal_coverage=1.5,
+                                         alignment_status='DONE'))
+
+
+class Server(threading.Thread):
+    "Run the Charon web application in a thread of its own."
+
+    def __init__(self):
+        super(Server, self).__init__(name='Charon')
+        self.daemon = True
+        self.ready = threading.Event()
+
+    def run(self):
+        from charon import app_charon
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        server = tornado.httpserver.HTTPServer(app_charon.get_application())
+        server.add_sockets(sockets)
+        settings['BASE_URL'] = "http://127.0.0.1:{0}/".format(
+            sockets[0].getsockname()[1])
+        cache.start(utils.get_db())
+        summary.start(utils.get_db())
+        search.start(utils.get_db())
+        self.ready.set()
+        self.ioloop.start()
+
+    def start(self):
+        "Start the server thread, and wait until it is listening."
+        super(Server, self).start()
+        self.ready.wait()
+
+
+def setup(couchdb_url=None, database='charon_benchmark', cache_size=10000):
+    """Start the CouchDB server, unless given, create the database and
+    the benchmark user, configure the settings, and start the web server.
+    Return the base URL of the web server."""
+    if not couchdb_url:
+        fake = fakecouch.FakeCouchDB()
+        fake.start()
+        couchdb_url = fake.url
+    server = couchdb.Server(couchdb_url)
+    if database in server:
+        sys.exit("database '{0}' exists; remove it first".format(database))
+    db = server.create(database)
+    load_designs(db, root=os.path.join(os.path.dirname(charon.__file__),
+                                       'designs'))
+    db.save({'_id': utils.get_iuid(),
+             constants.DB_DOCTYPE: constants.USER,
+             'email': 'benchmark@localhost',
+             'name': 'Benchmark',
+             'role': 'admin',
+             'status': constants.ACTIVE,
+             'api_token': API_TOKEN})
+    settings.update(BASE_URL='http://127.0.0.1/',
+                    DB_SERVER=couchdb_url,
+                    DB_DATABASE=database,
+                    DB_SERVER_VERSION=server.version(),
+                    COOKIE_SECRET=utils.get_iuid(),
+                    CACHE_SIZE=cache_size,
+                    AUTH=dict(SERVICE='Userman'))
+    Server().start()
+    return settings['BASE_URL']
+
+def seed(base_url, shape):
+    "Create the synthetic projects using the bulk API."
+    session = requests.Session()
+    session.headers['X-Charon-API-token'] = API_TOKEN
+    items = list(get_seed_items(shape))
+    for pos in range(0, len(items), SEED_CHUNK):
+        response = session.post(base_url + 'api/v1/bulk',
+                                data=json.dumps(dict(
+                                    items=items[pos:pos+SEED_CHUNK])))
+        response.raise_for_status()
+        for result in response.json()['results']:
+            if result['status'] != 201:
+                raise ValueError("could not seed: {0}".format(result))
+    return len(items)
+
+def run(base_url, shape, count=200, concurrency=4, seed_value=0):
+    """Call each endpoint 'count' times from 'concurrency' clients.
+    Return the statistics for each endpoint."""
+    local = threading.local()
+    def call(method, path, body):
+        try:
+            session = local.session
+        except AttributeError:
+            session = local.session = requests.Session()
+            session.headers['X-Charon-API-token'] = API_TOKEN
+        start = time.perf_counter()
+        response = session.request(method, base_url + 'api/v1/' + path,
+                                   data=body and json.dumps(body))
+        response.content
+        return time.perf_counter() - start, response.status_code
+    result = dict()
+    rnd = random.Random(seed_value)
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for name, method, get_call in get_endpoints(shape):
+            calls = [get_call(rnd) for i in range(count)]
+            start = time.perf_counter()
+            outcomes = list(executor.map(lambda c: call(method, *c), calls))
+            elapsed = time.perf_counter() - start
+            latencies = sorted([o[0] for o in outcomes])
+            statuses = dict()
+            for latency, status in outcomes:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            result[name] = dict(
+                count=count,
+                errors=len([o for o in outcomes if o[1] >= 400]),
+                statuses=statuses,
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99),
+                requests_per_second=count / elapsed)
+    return result
+
+def percentile(values, p):
+    "Return the nearest-rank percentile of the sorted values, in ms."
+    if not values: return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return 1000.0 * values[min(rank, len(values) - 1)]
+
+def report(results):
+    "Print the results as a table."
+    print("{0:16s} {1:>6s} {2:>9s} {3:>9s} {4:>9s} {5:>9s}".format(
+        'endpoint', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for name, r in results.items():
+        print("{0:16s} {1:6d} {2:9.2f} {3:9.2f} {4:9.2f} {5:9.1f}".format(
+            name, r['errors'], r['p50'], r['p95'], r['p99'],
+            r['requests_per_second']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Charon API with synthetic projects.')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=20,
+                        help='samples per project')
+    parser.add_argument('--libpreps', type=int, default=1,
+                        help='libpreps per sample')
+    parser.add_argument('--seqruns', type=int, default=2,
+                        help='seqruns per libprep')
+    parser.add_argument('--count', type=int, default=200,
+                        help='calls per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of concurrent clients')
+    parser.add_argument('--couchdb', metavar='URL',
+                        help='local CouchDB server to use, instead of the'
+                        ' in-process fake; the database must not exist')
+    parser.add_argument('--database', default='charon_benchmark')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='document cache size; 0 disables it')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for picking the entities')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the results as JSON to the file')
+    args = parser.parse_args()
+    shape = dict(projects=args.projects, samples=args.samples,
+                 libpreps=args.libpreps, seqruns=args.seqruns)
+    base_url = setup(couchdb_url=args.couchdb, database=args.database,
+                     cache_size=args.cache_size)
+    start = time.perf_counter()
+    total = seed(base_url, shape)
+    print("seeded {0} entities in {1:.1f} s".format(
+        total, time.perf_counter() - start))
+    results = run(base_url, shape, count=args.count,
+                  concurrency=args.concurrency, seed_value=args.seed)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(dict(version=charon.__version__,
+                           tornado=tornado.version,
+                           couchdb=settings['DB_SERVER_VERSION'],
+                           timestamp=datetime.datetime.utcnow().isoformat(),
+                           shape=shape,
+                           count=args.count,
+                           concurrency=args.concurrency,
+                           cache_size=args.cache_size,
+                           results=results),
+                      outfile, indent=2)
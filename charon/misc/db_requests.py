@@ -0,0 +1,100 @@
+"""Count the CouchDB requests made by the Charon server for API endpoints.
+
+Uses the connection pool statistics at /api/v1/stats, so the server
+must be a single process, and should not be serving other clients.
+The counts can be saved to a JSON file, and compared with a previously
+saved file; any endpoint using more requests than before is reported,
+and the exit status is then non-zero.
+
+Usage: db_requests.py projectid [sampleid] [--save=file] [--compare=file]
+Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
+"""
+
+import os
+import sys
+import json
+
+import requests
+
+API_TOKEN = os.getenv('CHARON_API_TOKEN')
+BASE_URL = os.getenv('CHARON_BASE_URL')
+
+
+def url(*segments):
+    "Synthesize absolute URL from path segments."
+    return "{0}api/v1/{1}".format(BASE_URL,'/'.join([str(s) for s in segments]))
+
+def get_db_requests(session):
+    "Return the total number of CouchDB requests made by the server."
+    response = session.get(url('stats'))
+    response.raise_for_status()
+    data = response.json()
+    return data['db_pool']['requests'] + data['async_db']['requests']
+
+def count(session, path, overhead):
+    "Return the number of CouchDB requests made for the given API path."
+    before = get_db_requests(session)
+    response = session.get(url(*path))
+    response.raise_for_status()
+    return get_db_requests(session) - before - overhead
+
+def get_endpoints(projectid, sampleid=None):
+    "Return the API paths to count, keyed by a descriptive name."
+    result = dict(project=('project', projectid),
+                  projects=('projects',),
+                  samples=('samples', projectid),
+                  project_libpreps=('libpreps', projectid),
+                  project_seqruns=('seqruns', projectid),
+                  samples_not_done=('samplesnotdone', projectid),
+                  summary=('summary',))
+    if sampleid:
+        result['sample'] = ('sample', projectid, sampleid)
+        result['sample_libpreps'] = ('libpreps', projectid, sampleid)
+        result['sample_seqruns'] = ('seqruns', projectid, sampleid)
+    return result
+
+def run(projectid, sampleid=None):
+    "Return the CouchDB request counts for each endpoint."
+    session = requests.Session()
+    session.headers['X-Charon-API-token'] = API_TOKEN
+    # The cost of the stats call itself, including API token check.
+    get_db_requests(session)
+    first = get_db_requests(session)
+    overhead = get_db_requests(session) - first
+    result = dict()
+    for name, path in sorted(get_endpoints(projectid, sampleid).items()):
+        result[name] = count(session, path, overhead)
+        print("{0:20s} {1:6d}".format(name, result[name]))
+    return result
+
+def compare(result, baseline):
+    "Return the list of endpoints using more requests than in the baseline."
+    regressions = []
+    for name, value in sorted(result.items()):
+        try:
+            if value > baseline[name]:
+                regressions.append((name, baseline[name], value))
+        except KeyError:
+            pass
+    return regressions
+
+
+if __name__ == '__main__':
+    if not API_TOKEN: sys.exit('no API token')
+    if not BASE_URL: sys.exit('no base URL')
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict([a[2:].split('=', 1) for a in sys.argv[1:]
+                    if a.startswith('--')])
+    if not args:
+        sys.exit('give project identifier, and optionally sample identifier')
+    result = run(*args[:2])
+    if 'save' in options:
+        with open(options['save'], 'w') as outfile:
+            json.dump(result, outfile, indent=2, sort_keys=True)
+    if 'compare' in options:
+        with open(options['compare']) as infile:
+            regressions = compare(result, json.load(infile))
+        for name, old, new in regressions:
+            print("regression: {0} {1} -> {2}".format(name, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,957 @@
+"""In-process CouchDB stand-in, for benchmarks and local testing.
+
+Implements the subset of the CouchDB 1.x/2.x HTTP API used by Charon:
+documents, _local documents, attachments, _all_docs, _bulk_docs,
+_changes (normal, longpoll and continuous), and the views, list
+functions and filters of the Charon design documents.
+
+The design documents are stored as given, but since there is no
+JavaScript engine, each view is computed by the Python equivalent
+registered in VIEWS, LISTS and FILTERS below. These must be kept in
+step with the JavaScript code in charon/designs.
+
+View indexes are maintained incrementally on each write, and the
+key collation approximates the CouchDB (ICU) collation.
+
+Usage: fakecouch.py [port]
+"""
+
+import bisect
+import json
+import threading
+import uuid
+
+import tornado.ioloop
+import tornado.locks
+import tornado.web
+import tornado.httpserver
+import tornado.iostream
+import tornado.netutil
+
+
+# Python equivalents of the Charon design document views.
+# Each map function takes a document and returns a list of (key, value).
+
+def _doctype(doc):
+    return doc.get('charon_doctype')
+
+def map_libprep_libprepid(doc):
+    if _doctype(doc) != 'libprep': return []
+    return [([doc.get('projectid'), doc.get('sampleid'), doc.get('libprepid')], None)]
+
+def map_libprep_count(doc):
+    if _doctype(doc) != 'libprep': return []
+    return [([doc.get('projectid'), doc.get('sampleid')], 1)]
+
+def map_libprep_count_project(doc):
+    if _doctype(doc) != 'libprep': return []
+    return [(doc.get('projectid'), 1)]
+
+def map_libprep_modified(doc):
+    if _doctype(doc) != 'libprep' or not doc.get('modified'): return []
+    return [(doc['modified'],
+             [doc.get('projectid'), doc.get('sampleid'), doc.get('libprepid')])]
+
+def map_log_doc(doc):
+    if _doctype(doc) != 'log': return []
+    return [(doc.get('doc'), doc.get('timestamp'))]
+
+def map_project_modified(doc):
+    if _doctype(doc) != 'project' or not doc.get('modified'): return []
+    return [(doc['modified'], doc.get('projectid'))]
+
+def map_project_name(doc):
+    if _doctype(doc) != 'project' or not doc.get('name'): return []
+    return [(doc['name'], doc.get('projectid'))]
+
+def map_project_not_done(doc):
+    if _doctype(doc) != 'project' or doc.get('status') == 'CLOSED': return []
+    return [(doc.get('projectid'), None)]
+
+def map_project_projectid(doc):
+    if _doctype(doc) != 'project': return []
+    return [(doc.get('projectid'), doc.get('projectname'))]
+
+def map_project_splitname(doc):
+    if _doctype(doc) != 'project' or not doc.get('name'): return []
+    result = [(doc['name'], doc.get('projectid'))]
+    parts = doc['name'].split('.')
+    if len(parts) >= 2:
+        result.append((parts[1], doc.get('projectid')))
+    return result
+
+def map_sample_count(doc):
+    if _doctype(doc) != 'sample': return []
+    return [(doc.get('projectid'), 1)]
+
+def map_sample_count_done(doc):
+    if _doctype(doc) != 'sample' or doc.get('status') != 'DONE': return []
+    return [(doc.get('projectid'), 1)]
+
+def map_sample_count_delivered(doc):
+    if _doctype(doc) != 'sample' or \
+       doc.get('delivery_status') != 'DELIVERED': return []
+    return [(doc.get('projectid'), 1)]
+
+def map_sample_summary_count(doc):
+    result = []
+    if _doctype(doc) == 'sample':
+        pid = doc.get('projectid')
+        cov = doc.get('total_autosomal_coverage')
+        result.extend([('TOTAL', 1), (pid + '_TOTAL', 1),
+                       ('TOTAL_COV', cov), (pid + '_TOTAL_COV', cov)])
+        if (doc.get('total_sequenced_reads') or 0) > 0:
+            result.extend([('SEQUENCED', 1), (pid + '_SEQUENCED', 1)])
+        status = doc.get('analysis_status')
+        if status in ('ANALYZED', 'UNDER_ANALYSIS', 'FAILED'):
+            result.extend([(status, 1), (pid + '_' + status, 1)])
+    return result
+
+def map_sample_modified(doc):
+    if _doctype(doc) != 'sample' or not doc.get('modified'): return []
+    return [(doc['modified'], [doc.get('projectid'), doc.get('sampleid')])]
+
+def map_sample_not_done(doc):
+    if _doctype(doc) != 'sample' or doc.get('status') == 'DONE': return []
+    return [([doc.get('projectid'), doc.get('sampleid')], None)]
+
+def map_sample_status(doc):
+    if _doctype(doc) != 'sample': return []
+    return [([doc.get('status') or None, doc.get('projectid'),
+              doc.get('sampleid')], None)]
+
+def map_sample_analysis_status(doc):
+    if _doctype(doc) != 'sample': return []
+    return [([doc.get('analysis_status') or None, doc.get('projectid'),
+              doc.get('sampleid')], None)]
+
+def map_sample_search(doc):
+    if _doctype(doc) != 'sample': return []
+    return [([field, doc.get(field), doc.get('projectid'), doc.get('sampleid')],
+             None)
+            for field in ['analysis_status', 'delivery_status', 'type',
+                          'total_autosomal_coverage', 'modified']]
+
+def map_internal_sampleids_to_projectids(doc):
+    if _doctype(doc) != 'sample': return []
+    return [(doc.get('sampleid'), doc.get('projectid'))]
+
+def map_sample_sampleid(doc):
+    if _doctype(doc) != 'sample': return []
+    return [([doc.get('projectid'), doc.get('sampleid')], None)]
+
+def map_seqrun_count(doc):
+    if _doctype(doc) != 'seqrun': return []
+    return [([doc.get('projectid'), doc.get('sampleid'), doc.get('libprepid')], 1)]
+
+def map_seqrun_sample_totals(doc):
+    if _doctype(doc) != 'seqrun' or \
+       doc.get('alignment_status') == 'FAILED': return []
+    def number(value):
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0
+    return [([doc.get('projectid'), doc.get('sampleid')],
+             [number(doc.get('mean_autosomal_coverage')),
+              number(doc.get('total_reads'))])]
+
+def map_seqrun_seqrunid(doc):
+    if _doctype(doc) != 'seqrun': return []
+    return [([doc.get('projectid'), doc.get('sampleid'),
+              doc.get('libprepid'), doc.get('seqrunid')], None)]
+
+def map_user_api_token(doc):
+    if _doctype(doc) != 'user': return []
+    return [(doc.get('api_token'), doc.get('email'))]
+
+def map_user_email(doc):
+    if _doctype(doc) != 'user': return []
+    return [(doc.get('email'), None)]
+
+def map_user_name(doc):
+    if _doctype(doc) != 'user' or not doc.get('name'): return []
+    result = [(doc['name'], doc.get('email'))]
+    parts = doc['name'].split(' ')
+    if len(parts) > 1:
+        result.extend([(p, doc.get('email')) for p in parts])
+    return result
+
+def reduce_count(keys, values, rereduce):
+    if rereduce: return sum(values)
+    return len(values)
+
+def reduce_sum(keys, values, rereduce):
+    if values and isinstance(values[0], list):
+        return [sum([v[i] or 0 for v in values])
+                for i in range(len(values[0]))]
+    return sum([v or 0 for v in values])
+
+VIEWS = {'internal/sampleids_to_projectids':
+             (map_internal_sampleids_to_projectids, None),
+         'libprep/libprepid': (map_libprep_libprepid, None),
+         'libprep/count': (map_libprep_count, reduce_count),
+         'libprep/count_project': (map_libprep_count_project, reduce_count),
+         'libprep/modified': (map_libprep_modified, None),
+         'log/doc': (map_log_doc, None),
+         'project/modified': (map_project_modified, None),
+         'project/name': (map_project_name, None),
+         'project/not_done': (map_project_not_done, None),
+         'project/projectid': (map_project_projectid, None),
+         'project/splitname': (map_project_splitname, None),
+         'sample/analysis_status': (map_sample_analysis_status, None),
+         'sample/count': (map_sample_count, reduce_count),
+         'sample/count_done': (map_sample_count_done, reduce_count),
+         'sample/count_delivered': (map_sample_count_delivered, reduce_count),
+         'sample/summary_count': (map_sample_summary_count, reduce_sum),
+         'sample/modified': (map_sample_modified, None),
+         'sample/not_done': (map_sample_not_done, None),
+         'sample/sampleid': (map_sample_sampleid, None),
+         'sample/search': (map_sample_search, None),
+         'sample/status': (map_sample_status, None),
+         'seqrun/count': (map_seqrun_count, reduce_count),
+         'seqrun/sample_totals': (map_seqrun_sample_totals, reduce_sum),
+         'seqrun/seqrunid': (map_seqrun_seqrunid, None),
+         'user/api_token': (map_user_api_token, None),
+         'user/email': (map_user_email, None),
+         'user/name': (map_user_name, None),
+         }
+
+# List functions: take the list of view rows, return the response body.
+LISTS = {}
+
+# Changes feed filters: take the document and the query parameters,
+# return True to include it.
+def filter_internal_entities(doc, query):
+    doctype = doc.get('charon_doctype')
+    if query.get('doctype'): return doctype == query['doctype']
+    return doctype in ('project', 'sample', 'libprep', 'seqrun')
+
+FILTERS = {'internal/entities': filter_internal_entities}
+
+
+def collation_key(value):
+    "Return a sort key approximating the CouchDB collation of JSON values."
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1, 0)
+    if value is True:
+        return (1, 1)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value.casefold(), value.swapcase())
+    if isinstance(value, (list, tuple)):
+        return (4, tuple([collation_key(v) for v in value]))
+    if isinstance(value, dict):
+        return (5, tuple([(collation_key(k), collation_key(v))
+                          for k, v in value.items()]))
+    raise ValueError("cannot collate {0!r}".format(value))
+
+
+class ViewIndex(object):
+    "Incrementally maintained index for one view."
+
+    def __init__(self, mapfunc, reducefunc):
+        self.mapfunc = mapfunc
+        self.reducefunc = reducefunc
+        self.entries = []               # Sorted (collation key, docid, n)
+        self.rows = dict()              # (docid, n) -> (key, value)
+        self.docentries = dict()        # docid -> list of entries
+
+    def update(self, docid, doc):
+        "Remove the previous entries for the doc, and add the new."
+        for entry in self.docentries.pop(docid, []):
+            pos = bisect.bisect_left(self.entries, entry)
+            del self.entries[pos]
+            del self.rows[entry[1:]]
+        if doc is None: return
+        try:
+            emitted = self.mapfunc(doc)
+        except Exception:               # Like CouchDB; skip the doc.
+            emitted = []
+        entries = []
+        for n, (key, value) in enumerate(emitted):
+            entry = (collation_key(key), collation_key(docid), n)
+            bisect.insort(self.entries, entry)
+            self.rows[(entry[1], n)] = (docid, key, value)
+            entries.append(entry)
+        if entries:
+            self.docentries[docid] = entries
+
+    def query(self, startkey=None, endkey=None, startkey_docid=None,
+              endkey_docid=None, inclusive_end=True, descending=False,
+              keys=None):
+        "Return the list of (docid, key, value) in the given range."
+        if keys is not None:
+            result = []
+            for key in keys:
+                result.extend(self.query(startkey=key, endkey=key,
+                                         descending=descending))
+            return result
+        low = high = None
+        if descending:
+            startkey, endkey = endkey, startkey
+            startkey_docid, endkey_docid = endkey_docid, startkey_docid
+        if startkey is not None:
+            low = (collation_key(startkey),)
+            if startkey_docid is not None:
+                low += (collation_key(startkey_docid),)
+        if endkey is not None:
+            high = (collation_key(endkey),)
+            if endkey_docid is not None:
+                high += (collation_key(endkey_docid),)
+        if low is None:
+            start = 0
+        else:
+            start = bisect.bisect_left(self.entries, low)
+        if high is None:
+            end = len(self.entries)
+        else:
+            # Inclusive end: all entries for the endkey (and docid).
+            if len(high) == 1:
+                high_inclusive = high + ((9,),)
+            else:
+                high_inclusive = high + (float('inf'),)
+            if descending or inclusive_end:
+                end = bisect.bisect_right(self.entries, high_inclusive)
+            else:
+                end = bisect.bisect_left(self.entries, high)
+        entries = self.entries[start:end]
+        if descending:
+            entries.reverse()
+        return [self.rows[(e[1], e[2])] for e in entries]
+
+
+class Database(object):
+    "In-memory database."
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = dict()              # docid -> doc (None if deleted)
+        self.attachments = dict()       # (docid, name) -> (type, bytes)
+        self.local = dict()
+        self.seq = 0
+        self.changes = dict()           # docid -> seq
+        self.deleted_revs = dict()      # docid -> rev
+        self.tombstones = dict()        # docid -> deletion stub
+        self.indexes = dict([(name, ViewIndex(*funcs))
+                             for name, funcs in VIEWS.items()])
+        self.changed = tornado.locks.Condition()
+
+    def info(self):
+        return dict(db_name=self.name,
+                    doc_count=len([d for d in self.docs.values() if d]),
+                    update_seq=self.seq)
+
+    def get(self, docid):
+        doc = self.docs.get(docid)
+        if doc is None:
+            raise KeyError(docid)
+        return doc
+
+    def put(self, doc):
+        """Store the document. Return the id and the new revision.
+        Raise KeyError if deleting a non-existent document.
+        Raise ValueError if revision conflict."""
+        docid = doc.get('_id') or uuid.uuid4().hex
+        current = self.docs.get(docid)
+        if current is not None:
+            if doc.get('_rev') != current['_rev']:
+                raise ValueError('conflict')
+            generation = int(current['_rev'].split('-')[0]) + 1
+        elif doc.get('_deleted'):
+            raise KeyError(docid)
+        else:
+            generation = 1
+        rev = "{0}-{1}".format(generation, uuid.uuid4().hex)
+        doc = json.loads(json.dumps(doc))
+        doc['_id'] = docid
+        doc['_rev'] = rev
+        # Keep the current attachments only if the stubs are given.
+        if doc.pop('_attachments', None) and current:
+            doc['_attachments'] = current.get('_attachments', {})
+        if doc.get('_deleted'):
+            self.docs[docid] = None
+            self.deleted_revs[docid] = rev
+            self.tombstones[docid] = doc
+            for key in [k for k in self.attachments if k[0] == docid]:
+                del self.attachments[key]
+            doc = None
+        else:
+            self.docs[docid] = doc
+        if not docid.startswith('_design/'):
+            for index in self.indexes.values():
+                index.update(docid, doc)
+        self.seq += 1
+        self.changes.pop(docid, None)
+        self.changes[docid] = self.seq
+        self.changed.notify_all()
+        return docid, rev
+
+    def changes_since(self, since, limit=None):
+        "Return list of (seq, docid) changed after the given seq."
+        result = [(seq, docid) for docid, seq in self.changes.items()
+                  if seq > since]
+        result.sort()
+        if limit:
+            result = result[:limit]
+        return result
+
+    def change_row(self, seq, docid, include_docs=False):
+        doc = self.docs.get(docid)
+        if doc is None:
+            rev = self.deleted_revs.get(docid)
+        else:
+            rev = doc['_rev']
+        row = dict(seq=seq, id=docid, changes=[dict(rev=rev)])
+        if doc is None:
+            row['deleted'] = True
+        if include_docs:
+            if doc is None:
+                row['doc'] = self.tombstones[docid]
+            else:
+                row['doc'] = doc
+        return row
+
+
+class Server(object):
+    "The collection of databases."
+
+    def __init__(self):
+        self.databases = dict()
+
+
+def loads(value):
+    "Decode a JSON query parameter."
+    return json.loads(value)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+
+    def initialize(self, server):
+        self.server = server
+
+    def get_database(self, name):
+        try:
+            return self.server.databases[name]
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='no_db_file')
+
+    def get_json_body(self):
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='bad_request')
+
+    def param(self, name, default=None):
+        value = self.get_argument(name, None)
+        if value is None: return default
+        return loads(value)
+
+    def flag(self, name, default=False):
+        value = self.get_argument(name, None)
+        if value is None: return default
+        return value == 'true'
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data) + '\n')
+
+    def write_error(self, status_code, **kwargs):
+        error = {404: 'not_found', 409: 'conflict',
+                 400: 'bad_request'}.get(status_code, 'error')
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(dict(error=error, reason=self._reason)) + '\n')
+
+
+class Root(BaseHandler):
+
+    def get(self):
+        self.write_json(dict(couchdb='Welcome', version='1.6.1',
+                             vendor=dict(name='Charon fake CouchDB')))
+
+
+class Db(BaseHandler):
+
+    def head(self, name):
+        self.get_database(name)
+        self.finish()
+
+    def get(self, name):
+        self.write_json(self.get_database(name).info())
+
+    def put(self, name):
+        if name in self.server.databases:
+            raise tornado.web.HTTPError(412, reason='file_exists')
+        self.server.databases[name] = Database(name)
+        self.write_json(dict(ok=True), status=201)
+
+    def delete(self, name):
+        self.get_database(name)
+        del self.server.databases[name]
+        self.write_json(dict(ok=True))
+
+    def post(self, name):
+        db = self.get_database(name)
+        doc = self.get_json_body()
+        docid, rev = db.put(doc)
+        self.write_json(dict(ok=True, id=docid, rev=rev), status=201)
+
+
+class Doc(BaseHandler):
+
+    def get_doc(self, name, docid):
+        try:
+            doc = self.get_database(name).get(docid)
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing')
+        self.set_header('ETag', '"{0}"'.format(doc['_rev']))
+        return doc
+
+    def head(self, name, docid):
+        self.get_doc(name, docid)
+        self.set_header('Content-Type', 'application/json')
+        self.finish()
+
+    def get(self, name, docid):
+        self.write_json(self.get_doc(name, docid))
+
+    def put(self, name, docid):
+        db = self.get_database(name)
+        doc = self.get_json_body()
+        doc['_id'] = docid
+        if 'rev' in self.request.arguments:
+            doc['_rev'] = self.get_argument('rev')
+        try:
+            docid, rev = db.put(doc)
+        except ValueError:
+            raise tornado.web.HTTPError(409, reason='Document update conflict.')
+        self.set_header('ETag', '"{0}"'.format(rev))
+        self.write_json(dict(ok=True, id=docid, rev=rev), status=201)
+
+    def delete(self, name, docid):
+        db = self.get_database(name)
+        rev = self.get_argument('rev', None) or \
+              self.request.headers.get('If-Match', '').strip('"')
+        try:
+            docid, rev = db.put(dict(_id=docid, _rev=rev, _deleted=True))
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing')
+        except ValueError:
+            raise tornado.web.HTTPError(409, reason='Document update conflict.')
+        self.write_json(dict(ok=True, id=docid, rev=rev))
+
+
+class LocalDoc(BaseHandler):
+
+    def get(self, name, docid):
+        db = self.get_database(name)
+        try:
+            self.write_json(db.local[docid])
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing')
+
+    def put(self, name, docid):
+        db = self.get_database(name)
+        doc = self.get_json_body()
+        current = db.local.get(docid)
+        if current and doc.get('_rev') != current['_rev']:
+            raise tornado.web.HTTPError(409, reason='Document update conflict.')
+        generation = int(current['_rev'].split('-')[1]) + 1 if current else 1
+        doc['_id'] = '_local/' + docid
+        doc['_rev'] = "0-{0}".format(generation)
+        db.local[docid] = doc
+        self.write_json(dict(ok=True, id=doc['_id'], rev=doc['_rev']),
+                        status=201)
+
+
+class Attachment(BaseHandler):
+
+    def get(self, name, docid, attname):
+        db = self.get_database(name)
+        try:
+            content_type, data = db.attachments[(docid, attname)]
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing')
+        self.set_header('Content-Type', content_type)
+        self.finish(data)
+
+    def put(self, name, docid, attname):
+        db = self.get_database(name)
+        try:
+            doc = dict(db.get(docid))
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing')
+        if self.get_argument('rev', None) != doc['_rev']:
+            raise tornado.web.HTTPError(409, reason='Document update conflict.')
+        content_type = self.request.headers.get('Content-Type',
+                                                'application/octet-stream')
+        atts = dict(doc.get('_attachments', {}))
+        atts[attname] = dict(content_type=content_type,
+                             length=len(self.request.body),
+                             stub=True)
+        doc.pop('_attachments', None)
+        docid, rev = db.put(doc)
+        db.docs[docid]['_attachments'] = atts
+        db.attachments[(docid, attname)] = (content_type, self.request.body)
+        self.write_json(dict(ok=True, id=docid, rev=rev), status=201)
+
+
+class BulkDocs(BaseHandler):
+
+    def post(self, name):
+        db = self.get_database(name)
+        data = self.get_json_body()
+        result = []
+        for doc in data.get('docs', []):
+            try:
+                docid, rev = db.put(doc)
+            except KeyError:
+                result.append(dict(id=doc.get('_id'), error='not_found',
+                                   reason='missing'))
+            except ValueError:
+                result.append(dict(id=doc.get('_id'), error='conflict',
+                                   reason='Document update conflict.'))
+            else:
+                result.append(dict(ok=True, id=docid, rev=rev))
+        self.write_json(result, status=201)
+
+
+class ViewMixin(object):
+    "Common handling of view query parameters and results."
+
+    def get_view_rows(self, db, index, keys=None):
+        """Return the rows for the query parameters, and the total count
+        before limit and skip."""
+        if keys is None:
+            keys = self.param('keys')
+        key = self.param('key')
+        descending = self.flag('descending')
+        if key is not None:
+            rows = index.query(startkey=key, endkey=key,
+                               descending=descending)
+        else:
+            rows = index.query(startkey=self.param('startkey',
+                                                   self.param('start_key')),
+                               endkey=self.param('endkey',
+                                                 self.param('end_key')),
+                               startkey_docid=self.param_str('startkey_docid'),
+                               endkey_docid=self.param_str('endkey_docid'),
+                               inclusive_end=self.flag('inclusive_end', True),
+                               descending=descending,
+                               keys=keys)
+        return rows
+
+    def param_str(self, name):
+        "Document ids are given as JSON strings in CouchDB, but be lenient."
+        value = self.get_argument(name, None)
+        if value is None: return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    def reduce_rows(self, index, rows):
+        "Apply the reduce function, grouping as specified."
+        group = self.flag('group')
+        group_level = self.get_argument('group_level', None)
+        if group_level is not None:
+            group_level = int(group_level)
+        elif group:
+            group_level = -1
+        if group_level is None:
+            if not rows: return []
+            return [dict(key=None, value=index.reducefunc(
+                [[r[1], r[0]] for r in rows],
+                [r[2] for r in rows], False))]
+        result = []
+        current = None
+        values = []
+        for docid, key, value in rows:
+            if group_level == -1 or not isinstance(key, list):
+                group_key = key
+            else:
+                group_key = key[:group_level]
+            if values and group_key != current:
+                result.append(dict(key=current,
+                                   value=index.reducefunc(None, values, False)))
+                values = []
+            current = group_key
+            values.append(value)
+        if values:
+            result.append(dict(key=current,
+                               value=index.reducefunc(None, values, False)))
+        return result
+
+    def query_view(self, db, viewname, keys=None):
+        """Return the view result as a dictionary.
+        The view must be defined in the stored design document."""
+        design, view = viewname.split('/')
+        ddoc = db.docs.get('_design/' + design) or dict()
+        try:
+            if view not in ddoc.get('views', {}): raise KeyError
+            index = db.indexes[viewname]
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing_named_view')
+        rows = self.get_view_rows(db, index, keys=keys)
+        reduce = self.flag('reduce', True) and index.reducefunc is not None
+        if reduce:
+            rows = self.reduce_rows(index, rows)
+        skip = int(self.get_argument('skip', 0))
+        limit = self.get_argument('limit', None)
+        rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:int(limit)]
+        if reduce:
+            return dict(rows=rows)
+        include_docs = self.flag('include_docs')
+        result = []
+        for docid, key, value in rows:
+            row = dict(id=docid, key=key, value=value)
+            if include_docs:
+                row['doc'] = db.docs.get(docid)
+            result.append(row)
+        return dict(total_rows=len(index.entries), offset=skip, rows=result)
+
+
+class View(ViewMixin, BaseHandler):
+
+    def get(self, name, design, view):
+        db = self.get_database(name)
+        self.write_view(self.query_view(db, "{0}/{1}".format(design, view)))
+
+    def post(self, name, design, view):
+        db = self.get_database(name)
+        keys = self.get_json_body().get('keys')
+        self.write_view(self.query_view(db, "{0}/{1}".format(design, view),
+                                        keys=keys))
+
+    def write_view(self, data):
+        "Write one row per line, like CouchDB does."
+        self.set_header('Content-Type', 'application/json')
+        lines = [json.dumps(r) for r in data['rows']]
+        head = dict([(k, v) for k, v in data.items() if k != 'rows'])
+        head = json.dumps(head)[:-1]
+        if len(head) > 1:
+            head += ','
+        self.finish(head + '"rows":[\r\n' + ',\r\n'.join(lines) + '\r\n]}\n')
+
+
+class List(ViewMixin, BaseHandler):
+
+    def get(self, name, design, listname, view):
+        db = self.get_database(name)
+        try:
+            listfunc = LISTS["{0}/{1}".format(design, listname)]
+        except KeyError:
+            raise tornado.web.HTTPError(404, reason='missing list function')
+        data = self.query_view(db, "{0}/{1}".format(design, view))
+        self.set_header('Content-Type', 'application/json')
+        self.finish(listfunc(data['rows']))
+
+
+class AllDocs(ViewMixin, BaseHandler):
+
+    def get(self, name):
+        self.write_json(self.all_docs(self.get_database(name)))
+
+    def post(self, name):
+        keys = self.get_json_body().get('keys')
+        self.write_json(self.all_docs(self.get_database(name), keys=keys))
+
+    def all_docs(self, db, keys=None):
+        if keys is None:
+            keys = self.param('keys')
+        include_docs = self.flag('include_docs')
+        if keys is not None:
+            rows = []
+            for key in keys:
+                doc = db.docs.get(key)
+                if doc is None:
+                    if key in db.docs:
+                        rows.append(dict(id=key, key=key, value=dict(
+                            rev=db.deleted_revs.get(key), deleted=True),
+                                         doc=None))
+                    else:
+                        rows.append(dict(key=key, error='not_found'))
+                    continue
+                row = dict(id=key, key=key, value=dict(rev=doc['_rev']))
+                if include_docs:
+                    row['doc'] = doc
+                rows.append(row)
+            return dict(total_rows=len(db.docs), offset=0, rows=rows)
+        ids = sorted([k for k, v in db.docs.items() if v is not None])
+        descending = self.flag('descending')
+        startkey = self.param('startkey', self.param('start_key'))
+        endkey = self.param('endkey', self.param('end_key'))
+        if descending:
+            ids.reverse()
+            if startkey is not None:
+                ids = [i for i in ids if i <= startkey]
+            if endkey is not None:
+                ids = [i for i in ids if i >= endkey]
+        else:
+            if startkey is not None:
+                ids = ids[bisect.bisect_left(ids, startkey):]
+            if endkey is not None:
+                ids = ids[:bisect.bisect_right(ids, endkey)]
+        skip = int(self.get_argument('skip', 0))
+        ids = ids[skip:]
+        limit = self.get_argument('limit', None)
+        if limit is not None:
+            ids = ids[:int(limit)]
+        rows = []
+        for docid in ids:
+            doc = db.docs[docid]
+            row = dict(id=docid, key=docid, value=dict(rev=doc['_rev']))
+            if include_docs:
+                row['doc'] = doc
+            rows.append(row)
+        return dict(total_rows=len(db.docs), offset=skip, rows=rows)
+
+
+class Changes(BaseHandler):
+
+    async def get(self, name):
+        db = self.get_database(name)
+        feed = self.get_argument('feed', 'normal')
+        since = self.get_argument('since', '0')
+        if since == 'now':
+            since = db.seq
+        else:
+            since = int(since)
+        limit = self.get_argument('limit', None)
+        limit = limit and int(limit)
+        include_docs = self.flag('include_docs')
+        timeout = int(self.get_argument('timeout', 60000)) / 1000.0
+        heartbeat = self.get_argument('heartbeat', None)
+        heartbeat = heartbeat and int(heartbeat) / 1000.0
+        filtername = self.get_argument('filter', None)
+        if filtername:
+            try:
+                filterfunc = FILTERS[filtername]
+            except KeyError:
+                raise tornado.web.HTTPError(404, reason='missing filter')
+        else:
+            filterfunc = None
+        query = dict([(key, self.get_argument(key))
+                      for key in self.request.query_arguments])
+        loop = tornado.ioloop.IOLoop.current()
+
+        def get_rows(since):
+            rows = []
+            last_seq = since
+            for seq, docid in db.changes_since(since):
+                last_seq = seq
+                row = db.change_row(seq, docid, include_docs=include_docs)
+                if filterfunc:
+                    doc = db.docs.get(docid) or db.tombstones[docid]
+                    if not filterfunc(doc, query): continue
+                rows.append(row)
+                if limit and len(rows) >= limit: break
+            return rows, last_seq
+
+        if feed == 'continuous':
+            self.set_header('Content-Type', 'application/json')
+            deadline = loop.time() + timeout
+            count = 0
+            try:
+                while True:
+                    rows, since = get_rows(since)
+                    for row in rows:
+                        self.write(json.dumps(row) + '\n')
+                        count += 1
+                    await self.flush()
+                    if limit and count >= limit: break
+                    if heartbeat:
+                        notified = await db.changed.wait(
+                            timeout=loop.time() + heartbeat)
+                        if not notified:
+                            self.write('\n')
+                            await self.flush()
+                    else:
+                        if loop.time() >= deadline: break
+                        await db.changed.wait(timeout=deadline)
+            except tornado.iostream.StreamClosedError:
+                return
+            self.finish(json.dumps(dict(last_seq=since)) + '\n')
+            return
+        rows, last_seq = get_rows(since)
+        if feed == 'longpoll' and not rows:
+            deadline = loop.time() + timeout
+            while not rows and loop.time() < deadline:
+                await db.changed.wait(timeout=deadline)
+                rows, last_seq = get_rows(since)
+        self.write_json(dict(results=rows, last_seq=last_seq))
+
+
+def make_application(server=None):
+    "Return the Tornado application for the fake CouchDB server."
+    if server is None:
+        server = Server()
+    kwargs = dict(server=server)
+    DB = r'/([a-zA-Z0-9_%$()+-]+)'
+    return tornado.web.Application([
+        (r'/', Root, kwargs),
+        (DB + r'/?', Db, kwargs),
+        (DB + r'/_all_docs', AllDocs, kwargs),
+        (DB + r'/_bulk_docs', BulkDocs, kwargs),
+        (DB + r'/_changes', Changes, kwargs),
+        (DB + r'/_local/([^/]+)', LocalDoc, kwargs),
+        (DB + r'/_design/([^/]+)/_view/([^/]+)', View, kwargs),
+        (DB + r'/_design/([^/]+)/_list/([^/]+)/([^/]+)', List, kwargs),
+        (DB + r'/(_design/[^/]+)', Doc, kwargs),
+        (DB + r'/(_design%2F[^/]+)', Doc, kwargs),
+        (DB + r'/([^/_][^/]*)', Doc, kwargs),
+        (DB + r'/([^/_][^/]*)/(.+)', Attachment, kwargs),
+        ])
+
+
+class FakeCouchDB(threading.Thread):
+    """Run the fake CouchDB server in a thread of its own.
+    The 'url' attribute is set when the server is listening."""
+
+    def __init__(self, port=0, address='127.0.0.1'):
+        super(FakeCouchDB, self).__init__(name='FakeCouchDB')
+        self.daemon = True
+        self.port = port
+        self.address = address
+        self.server = Server()
+        self.url = None
+        self.ready = threading.Event()
+
+    def run(self):
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        http_server = tornado.httpserver.HTTPServer(
+            make_application(self.server))
+        sockets = tornado.netutil.bind_sockets(self.port, self.address)
+        http_server.add_sockets(sockets)
+        self.port = sockets[0].getsockname()[1]
+        self.url = "http://{0}:{1}/".format(self.address, self.port)
+        self.ready.set()
+        self.ioloop.start()
+
+    def start(self):
+        "Start the server thread, and wait until it is listening."
+        super(FakeCouchDB, self).start()
+        self.ready.wait()
+
+    def stop(self):
+        self.ioloop.add_callback(self.ioloop.stop)
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        port = int(sys.argv[1])
+    except IndexError:
+        port = 5984
+    application = make_application()
+    application.listen(port)
+    print('fake CouchDB server on port', port)
+    tornado.ioloop.IOLoop.current().start()
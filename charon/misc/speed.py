@@ -44,7 +44,7 @@ def do_delete(db):
 class Timer(object):
 
     def __init__(self):
-        self.start_cpu = time.clock()
+        self.start_cpu = time.process_time()
         self.start_wall = time.time()
 
     def __str__(self):
@@ -52,7 +52,7 @@ class Timer(object):
 
     @property
     def cpu(self):
-        return time.clock() - self.start_cpu
+        return time.process_time() - self.start_cpu
 
     @property
     def wall(self):
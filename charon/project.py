@@ -10,6 +10,7 @@ import tornado.web
 import charon.constants as cst
 import charon.utils as utls
 import charon.saver as sav
+import charon.logwriter as logwriter
 from charon.requesthandler import RequestHandler
 from charon.api import ApiRequestHandler
 from charon.sample import SampleSaver
@@ -18,25 +19,25 @@ from charon.sample import SampleSaver
 class ProjectidField(sav.IdField):
     "The unique identifier for the project, e.g. 'P1234'."
 
+    unique_view = 'project/projectid'
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         super(ProjectidField, self).check_valid(saver, value)
-        view = saver.db.view('project/projectid')
-        if len(list(view[value])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value)
 
 
 class ProjectnameField(sav.NameField):
     """The name of the project, e.g. 'P.Kraulis_14_01'.
     Optional; must be unique if given."""
 
+    unique_view = 'project/name'
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         super(ProjectnameField, self).check_valid(saver, value)
         if saver.get(self.key) == value: return
-        view = saver.db.view('project/name')
-        if len(list(view[value])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value)
 
 
 class ProjectSaver(sav.Saver):
@@ -75,7 +76,7 @@ class UploadSamplesMixin(object):
     The input is sample identifiers only.
     """
 
-    def upload_samples(self, project):
+    async def upload_samples(self, project):
         "Upload samples from file provided via HTML form field."
         samples = []
         try:
@@ -85,17 +86,18 @@ class UploadSamplesMixin(object):
         self.messages = ["Data from file {0}".format(data['filename'])]
         self.errors = []
         samples_set = set()
-        view = self.db.view('sample/sampleid',
-                            startkey=[project['projectid'], ''],
-                            endkey=[project['projectid'], cst.HIGH_CHAR])
-        for row in view:
+        rows = await self.async_db.view('sample/sampleid',
+                                        startkey=[project['projectid'], ''],
+                                        endkey=[project['projectid'],
+                                                cst.HIGH_CHAR])
+        for row in rows:
             sampleid = row.key[1]
             if sampleid in samples_set:
                 self.errors.append("sampleid '{0}' defined multiple times?".
                                    format(sampleid))
             else:
                 samples_set.add(sampleid)
-        reader = csv.reader(io.StringIO(data['body']))
+        reader = csv.reader(io.StringIO(data['body'].decode('utf-8')))
         # First get all new sampleids, and check uniqueness
         for pos, record in enumerate(reader):
             try:
@@ -117,15 +119,34 @@ class UploadSamplesMixin(object):
         if self.errors:
             self.messages.append('No samples added.')
         else:
-            # Add samples when no previous errors
-            for pos, sampleid in enumerate(samples):
-                try:
-                    with SampleSaver(rqh=self, project=project) as saver:
-                        data = dict(sampleid=sampleid)
-                        saver.store(data=data)
-                except (IOError, ValueError) as msg:
-                    self.errors.append("line {0}: {1}".format(pos+1, str(msg)))
-            self.messages.append("{0} samples added".format(len(samples)))
+            # Add samples when no previous errors, saving all at once.
+            keys = []
+            for sampleid in samples:
+                keys.extend(SampleSaver.get_unique_keys(
+                    project, dict(sampleid=sampleid)))
+            self.unique_found = await sav.fetch_unique(self.async_db, keys)
+            self.save_batch = logwriter.Batch(self.async_db)
+            positions = dict()
+            try:
+                for pos, sampleid in enumerate(samples):
+                    try:
+                        async with SampleSaver(rqh=self,
+                                               project=project) as saver:
+                            data = dict(sampleid=sampleid)
+                            saver.store(data=data)
+                    except (IOError, ValueError) as msg:
+                        self.errors.append("line {0}: {1}".format(pos+1,
+                                                                  str(msg)))
+                    else:
+                        positions[saver.doc['_id']] = pos
+            finally:
+                batch, self.save_batch = self.save_batch, None
+            failed = await batch.flush()
+            for doc, error in failed:
+                self.errors.append("line {0}: {1}".format(
+                    positions[doc['_id']]+1, str(error)))
+            self.messages.append("{0} samples added".format(
+                len(positions) - len(failed)))
 
 
 class UpdateSamplesMixin(object):
@@ -135,7 +156,7 @@ class UpdateSamplesMixin(object):
     All other columns (fields) are optional.
     """
 
-    def update_samples(self, project):
+    async def update_samples(self, project):
         "Update samples from a file provided via HTML form field."
         try:
             data = self.request.files['csvfile'][0]
@@ -143,7 +164,7 @@ class UpdateSamplesMixin(object):
             raise tornado.web.HTTPError(400, reason='no CSV file uploaded')
         self.messages = ["Data from file {0}".format(data['filename'])]
         self.errors = []
-        reader = csv.reader(io.StringIO(data['body']))
+        reader = csv.reader(io.StringIO(data['body'].decode('utf-8')))
         # Header: get positions of fields
         header = next(reader)
         lookup = dict()
@@ -155,6 +176,7 @@ class UpdateSamplesMixin(object):
                     self.errors.append("column 'sampleid' is missing")
         rows = list(reader)
         if 'sampleid' in lookup:
+            samples_set = set()
             # First just check
             for pos, row in enumerate(rows):
                 # Check that the sample identifiers match existing samples
@@ -164,8 +186,14 @@ class UpdateSamplesMixin(object):
                 except (IndexError, ValueError):
                     self.errors.append("line {0}; no sampleid".format(pos+1))
                     continue
+                # A sample given twice would be saved only once.
+                if sampleid in samples_set:
+                    self.errors.append("line {0}; non-unique sampleid '{1}'".
+                                       format(pos+1, sampleid))
+                    continue
+                samples_set.add(sampleid)
                 try:
-                    sample = self.get_sample(project['projectid'], sampleid)
+                    sample = await self.get_sample(project['projectid'], sampleid)
                 except tornado.web.HTTPError:
                     self.errors.append("line {0}; no such sample '{1}'".
                                        format(pos+1, sampleid))
@@ -177,30 +205,41 @@ class UpdateSamplesMixin(object):
                     value = row[slot].strip()
                     if not value: continue
                     data[key] = value
-                # Check that update of sample is valid
+                # Check that update of sample is valid; do not save
                 try:
-                    with SampleSaver(rqh=self, doc=sample) as saver:
-                        saver.store(data=data, check_only=True)
+                    saver = SampleSaver(rqh=self, doc=sample)
+                    await saver.setup()
+                    saver.store(data=data, check_only=True)
                 except ValueError as msg:
                     self.errors.append("row {0}; {1}".format(pos+1, str(msg)))
         if self.errors:
             self.messages.append('No samples added.')
         else:
-            # And now actually do it...
-            for row in rows:
-                sampleid = row[lookup['sampleid']].strip()
-                sample = self.get_sample(project['projectid'], sampleid)
-                # Collect update data for sample
-                data = dict()
-                for key, slot in lookup.items():
-                    if key == 'sampleid': continue
-                    value = row[slot].strip()
-                    if not value: continue
-                    data[key] = value
-                # Store it
-                with SampleSaver(rqh=self, doc=sample) as saver:
-                    saver.store(data=data)
-            self.messages.append("{0} samples updated.".format(len(rows)))
+            # And now actually do it, saving all samples and logs at once.
+            self.save_batch = logwriter.Batch(self.async_db)
+            try:
+                for row in rows:
+                    sampleid = row[lookup['sampleid']].strip()
+                    sample = await self.get_sample(project['projectid'],
+                                                   sampleid)
+                    # Collect update data for sample
+                    data = dict()
+                    for key, slot in lookup.items():
+                        if key == 'sampleid': continue
+                        value = row[slot].strip()
+                        if not value: continue
+                        data[key] = value
+                    # Store it
+                    async with SampleSaver(rqh=self, doc=sample) as saver:
+                        saver.store(data=data)
+            finally:
+                batch, self.save_batch = self.save_batch, None
+            failed = await batch.flush()
+            for doc, error in failed:
+                self.errors.append("sample '{0}': {1}".format(
+                    doc['sampleid'], str(error)))
+            self.messages.append("{0} samples updated.".format(
+                len(rows) - len(failed)))
 
 
 class Project(RequestHandler):
@@ -209,30 +248,24 @@ class Project(RequestHandler):
     saver = ProjectSaver
 
     @tornado.web.authenticated
-    def get(self, projectid):
+    async def get(self, projectid):
         "Display the project information."
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         projectid=project['projectid']
-        samples = self.get_samples(projectid)
-        view = self.db.view('libprep/count')
+        samples = await self.get_samples(projectid)
+        # Counts for all samples, keyed by [projectid, sampleid].
+        startkey = [projectid]
+        endkey = [projectid, cst.HIGH_CHAR]
+        rows = await self.async_db.view('libprep/count', group_level=2,
+                                        startkey=startkey, endkey=endkey)
+        libpreps_counts = dict([(r.key[1], r.value) for r in rows])
+        rows = await self.async_db.view('seqrun/count', group_level=2,
+                                        startkey=startkey, endkey=endkey)
+        seqruns_counts = dict([(r.key[1], r.value) for r in rows])
         for sample in samples:
-            try:
-                row = view[[projectid, sample['sampleid']]].rows[0]
-            except IndexError:
-                sample['libpreps_count'] = 0
-            else:
-                sample['libpreps_count'] = row.value
-        view = self.db.view('seqrun/count')
-        for sample in samples:
-            try:
-                startkey = [projectid, sample['sampleid']]
-                endkey = [projectid, sample['sampleid'], cst.HIGH_CHAR]
-                row = view[startkey:endkey].rows[0]
-            except IndexError:
-                sample['seqruns_count'] = 0
-            else:
-                sample['seqruns_count'] = row.value
-        logs = self.get_logs(project['_id']) # XXX limit?
+            sample['libpreps_count'] = libpreps_counts.get(sample['sampleid'], 0)
+            sample['seqruns_count'] = seqruns_counts.get(sample['sampleid'], 0)
+        logs = await self.get_logs(project['_id']) # XXX limit?
         self.render('project.html',
                     project=project,
                     samples=samples,
@@ -251,12 +284,12 @@ class ProjectCreate(RequestHandler):
         self.render('project_create.html', fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         """Create the project given the form data.
         Redirect to the project page."""
         self.check_xsrf_cookie()
         try:
-            with self.saver(rqh=self) as saver:
+            async with self.saver(rqh=self) as saver:
                 saver.store()
                 project = saver.doc
         except (IOError, ValueError) as msg:
@@ -274,20 +307,20 @@ class ProjectEdit(RequestHandler):
     saver = ProjectSaver
 
     @tornado.web.authenticated
-    def get(self, projectid):
+    async def get(self, projectid):
         "Display the project edit form."
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         self.render('project_edit.html',
                     project=project,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid):
+    async def post(self, projectid):
         "Edit the project with the given form data."
         self.check_xsrf_cookie()
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         try:
-            with self.saver(doc=project, rqh=self) as saver:
+            async with self.saver(doc=project, rqh=self) as saver:
                 saver.store()
         except (IOError, ValueError) as msg:
             self.render('project_edit.html',
@@ -303,20 +336,20 @@ class ProjectUpload(UploadSamplesMixin, RequestHandler):
     "Upload samples into the project."
 
     @tornado.web.authenticated
-    def get(self, projectid):
+    async def get(self, projectid):
         "Display the project samples upload form."
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         self.render('project_upload.html',
                     project=project,
                     message=self.get_argument('message', None),
                     error=self.get_argument('error', None))
 
     @tornado.web.authenticated
-    def post(self, projectid):
+    async def post(self, projectid):
         "Edit the project with the given form data."
         self.check_xsrf_cookie()
-        project = self.get_project(projectid)
-        self.upload_samples(project)
+        project = await self.get_project(projectid)
+        await self.upload_samples(project)
         url = self.get_absolute_url('project_upload', project['projectid'],
                                     message='\n'.join(self.messages),
                                     error='\n'.join(self.errors))
@@ -329,9 +362,9 @@ class ProjectUpdate(UpdateSamplesMixin, RequestHandler):
     """
 
     @tornado.web.authenticated
-    def get(self, projectid):
+    async def get(self, projectid):
         "Display the project samples update form."
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         self.render('project_samples_update.html',
                     project=project,
                     samplesaver=SampleSaver,
@@ -339,11 +372,11 @@ class ProjectUpdate(UpdateSamplesMixin, RequestHandler):
                     error=self.get_argument('error', None))
 
     @tornado.web.authenticated
-    def post(self, projectid):
+    async def post(self, projectid):
         "Edit the project with the given form data."
         self.check_xsrf_cookie()
-        project = self.get_project(projectid)
-        self.update_samples(project)
+        project = await self.get_project(projectid)
+        await self.update_samples(project)
         url = self.get_absolute_url('project_update',
                                     project['projectid'],
                                     message='\n'.join(self.messages),
@@ -356,13 +389,13 @@ class Projects(RequestHandler):
     "List all projects."
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         page = int(self.get_argument('page', 1))
         limit = 50
         from_key = self.get_argument('from', None)
         to_key = self.get_argument('to', None)
 
-        projects, has_more, curr_startkey, next_startkey = self.get_projects(from_key=from_key, to_key=to_key, limit=limit)
+        projects, has_more, curr_startkey, next_startkey = await self.get_projects(from_key=from_key, to_key=to_key, limit=limit)
 
         self.render('projects.html', projects=projects, page=page, has_more=has_more, from_key=curr_startkey, to_key=next_startkey)
 
@@ -373,31 +406,31 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
     saver = ProjectSaver
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def get(self, projectid):
+    async def get(self, projectid):
         """Return the project data as JSON.
         Return HTTP 404 if no such project."""
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         if not project: return
         self.add_project_links(project)
         self.write(project)
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def post(self, projectid):
+    async def post(self, projectid):
         "Upload a CSV file containing identifiers of samples to create."
-        project = self.get_project(projectid)
-        self.upload_samples(project)
+        project = await self.get_project(projectid)
+        await self.upload_samples(project)
         self.write(dict(errors=self.errors, messages=self.messages))
         if self.errors:
             self.set_status(400)
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def put(self, projectid):
+    async def put(self, projectid):
         """Update the project with the given JSON data.
         Return HTTP 204 "No Content" when successful.
         Return HTTP 400 if the input data is invalid.
         Return HTTP 404 if no such project.
         Return HTTP 409 if there is a document revision update conflict."""
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         if not project: return
         try:
             data = json.loads(self.request.body)
@@ -406,7 +439,7 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=project, rqh=self) as saver:
+                async with self.saver(doc=project, rqh=self) as saver:
                     saver.store(data=data)
             except ValueError as msg:
                 logging.debug("ValueError: %s", msg)
@@ -418,11 +451,11 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
                 self.set_status(204)
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def delete(self, projectid):
+    async def delete(self, projectid):
         """NOTE: This is for unit test purposes only!
         Delete the project and all of its dependent entities.
         Returns HTTP 204 "No Content"."""
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         if not project: return
         utls.delete_project(self.db, project)
         logging.debug("deleted project %s", projectid)
@@ -435,10 +468,12 @@ class ApiProjectSamplesUpdate(UpdateSamplesMixin, ApiRequestHandler):
     saver = ProjectSaver
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def post(self, projectid):
-        "Upload a CSV file containing identifiers of samples to create."
-        project = self.get_project(projectid)
-        self.update_samples(project)
+    async def post(self, projectid):
+        """Upload a CSV file with a header row, containing the identifiers
+        of samples to update, and the values of their fields.
+        Return HTTP 400 if any row is invalid; no sample is then updated."""
+        project = await self.get_project(projectid)
+        await self.update_samples(project)
         self.write(dict(errors=self.errors, messages=self.messages))
         if self.errors:
             self.set_status(400)
@@ -450,7 +485,7 @@ class ApiProjectCreate(ApiRequestHandler):
     saver = ProjectSaver
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def post(self):
+    async def post(self):
         """Create a project.
         Return HTTP 201, project URL in header "Location", and project data.
         Return HTTP 400 if something is wrong with the input data.
@@ -461,7 +496,7 @@ class ApiProjectCreate(ApiRequestHandler):
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(rqh=self) as saver:
+                async with self.saver(rqh=self) as saver:
                     saver.store(data=data)
                     project = saver.doc
             except (KeyError, ValueError) as msg:
@@ -480,21 +515,26 @@ class ApiProjects(ApiRequestHandler):
     "Access to all projects."
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def get(self):
-        "Return a list of all projects."
-        projects = self.get_projects()
-        for project in projects:
-            self.add_project_links(project)
-        self.write(dict(projects=projects))
+    async def get(self):
+        """Return a list of all projects, with their sample and libprep
+        counts, ordered by projectid. The projects are streamed; as NDJSON
+        if the 'Accept' header is 'application/x-ndjson' or the query
+        argument 'format=ndjson'. One page of projects if the query
+        argument 'limit' or 'cursor' is given, with the cursor and link
+        for the next page."""
+        await self.write_page('project/projectid', dict(),
+                              key='projects',
+                              add_links=self.add_project_links,
+                              prepare=self.add_project_counts)
 
 
 class ApiProjectsNotDone(ApiRequestHandler):
     "Access to all projects that are not done."
 
     # Do not use authentication decorator; do not send to login page, but fail.
-    def get(self):
+    async def get(self):
         "Return a list of all undone projects."
-        projects = self.get_not_done_projects()
+        projects = await self.get_not_done_projects()
         for project in projects:
             self.add_project_links(project)
         self.write(dict(projects=projects))
@@ -0,0 +1,248 @@
+""" Charon: Compile JSON filter trees into predicates over sample documents.
+
+A filter tree is a JSON object, one of:
+  {"and": [tree, ...]}
+  {"or": [tree, ...]}
+  {"not": tree}
+  {"field": name, "op": op, "value": value}
+
+where op is one of '==', '!=', '<', '<=', '>', '>=', 'in' (value is
+a list), 'range' (value is [low, high], inclusive; either may be null
+for no bound) or 'exists' (value is true or false).
+A comparison with a field that is undefined, or whose value cannot be
+compared with the given value, is false.
+
+Clauses on fields having a view index are used to select the documents
+to read from the database; the whole tree is then applied to each.
+"""
+
+import operator
+
+from . import constants
+from . import utils
+
+
+COMPARISONS = {'==': operator.eq,
+               '!=': operator.ne,
+               '<': operator.lt,
+               '<=': operator.le,
+               '>': operator.gt,
+               '>=': operator.ge,
+               'is': operator.eq}   # For the legacy query format.
+
+# Sample fields having a view keyed by [value, projectid, sampleid].
+INDEXED_FIELDS = {'status': 'sample/status',
+                  'analysis_status': 'sample/analysis_status'}
+
+# Sample fields searchable by value across all projects, in the view
+# 'sample/search' keyed by [field, value, projectid, sampleid].
+SEARCH_FIELDS = ['analysis_status', 'delivery_status', 'type']
+
+# Value types for the legacy query format.
+TYPES = {'int': int, 'float': float, 'str': str, 'unicode': str, 'text': str}
+
+
+def compile_tree(tree):
+    """Return a function taking a document and returning True if it
+    matches the filter tree. Raise ValueError if the tree is invalid."""
+    if not isinstance(tree, dict):
+        raise ValueError('filter must be an object')
+    if 'and' in tree:
+        predicates = [compile_tree(t) for t in get_list(tree, 'and')]
+        return lambda doc: all([p(doc) for p in predicates])
+    if 'or' in tree:
+        predicates = [compile_tree(t) for t in get_list(tree, 'or')]
+        return lambda doc: any([p(doc) for p in predicates])
+    if 'not' in tree:
+        predicate = compile_tree(tree['not'])
+        return lambda doc: not predicate(doc)
+    try:
+        field = tree['field']
+        op = tree['op']
+        value = tree.get('value')
+    except KeyError as msg:
+        raise ValueError("filter lacks {0}".format(msg))
+    if not isinstance(field, str):
+        raise ValueError('field name must be a string')
+    if not isinstance(op, str):
+        raise ValueError('operator must be a string')
+    if op in COMPARISONS:
+        return get_comparison(field, COMPARISONS[op], value)
+    elif op == 'in':
+        if not isinstance(value, list) or \
+           not all([is_scalar(v) for v in value]):
+            raise ValueError("value for 'in' must be a list of scalars")
+        return lambda doc: doc.get(field) is not None and \
+            doc.get(field) in value
+    elif op == 'range':
+        if not (isinstance(value, list) and len(value) == 2):
+            raise ValueError("value for 'range' must be [low, high]")
+        low, high = value
+        checks = []
+        if low is not None:
+            checks.append(get_comparison(field, operator.ge, low))
+        if high is not None:
+            checks.append(get_comparison(field, operator.le, high))
+        return lambda doc: doc.get(field) is not None and \
+            all([c(doc) for c in checks])
+    elif op == 'exists':
+        if value or value is None:
+            return lambda doc: doc.get(field) is not None
+        else:
+            return lambda doc: doc.get(field) is None
+    else:
+        raise ValueError("unknown operator '{0}'".format(op))
+
+def get_list(tree, key):
+    "Return the non-empty list of subtrees for the key."
+    value = tree[key]
+    if not isinstance(value, list) or not value:
+        raise ValueError("value for '{0}' must be a non-empty list".format(key))
+    return value
+
+def is_scalar(value):
+    "Is the value a JSON string, number, boolean or null?"
+    return value is None or isinstance(value, (str, int, float))
+
+def get_comparison(field, op, value):
+    "Return a predicate comparing the field value with the given value."
+    def predicate(doc):
+        current = doc.get(field)
+        if current is None: return False
+        try:
+            return op(current, value)
+        except TypeError:
+            return False
+    return predicate
+
+def get_scans(tree, projectid=None):
+    """Return a list of (viewname, options) for view range queries
+    which together include all documents that may match the tree,
+    or None if the tree has no clause that a view can answer."""
+    if 'and' in tree:
+        candidates = [get_scans(t, projectid) for t in tree['and']]
+        candidates = [c for c in candidates if c is not None]
+        if not candidates: return None
+        return min(candidates, key=len)
+    if 'or' in tree:
+        result = []
+        for subtree in tree['or']:
+            scans = get_scans(subtree, projectid)
+            if scans is None: return None
+            result.extend(scans)
+        return result
+    field = tree.get('field')
+    op = tree.get('op')
+    if op in ('==', 'is'):
+        values = [tree.get('value')]
+    elif op == 'in':
+        values = tree.get('value')
+    else:
+        return None
+    if field in INDEXED_FIELDS:
+        return [(INDEXED_FIELDS[field], utils.get_range(value, projectid))
+                for value in values if value is not None]
+    if field == 'sampleid' and projectid:
+        return [('sample/sampleid', dict(key=[projectid, value]))
+                for value in values]
+    return None
+
+def from_legacy(data):
+    """Convert the legacy single-comparison query to a filter tree.
+    Raise KeyError or ValueError if it is invalid."""
+    for key in ('projectid', 'sampleField', 'operator', 'type', 'value'):
+        if key not in data:
+            raise KeyError("data given does not contain a {0}".format(key))
+    if data['operator'] not in ['==', '>', '<', '<=', '>=', 'is']:
+        raise ValueError("Unallowed operator : {0}".format(data['operator']))
+    try:
+        convert = TYPES[data['type']]
+    except (KeyError, TypeError):
+        raise ValueError("Unallowed type : {0}".format(data['type']))
+    try:
+        value = convert(data['value'])
+    except TypeError:
+        raise ValueError("Invalid {0} value : {1}".format(data['type'],
+                                                        data['value']))
+    return dict(field=data['sampleField'], op=data['operator'], value=value)
+
+
+class Query(object):
+    "A filter tree compiled into a predicate, and the view scans for it."
+
+    def __init__(self, tree, projectid=None):
+        self.predicate = compile_tree(tree)
+        self.projectid = projectid
+        self.scans = get_scans(tree, projectid)
+        if self.scans is None:
+            self.scans = [('sample/sampleid',
+                           dict(startkey=[projectid or '', ''],
+                                endkey=[projectid or constants.HIGH_CHAR,
+                                        constants.HIGH_CHAR]))]
+
+    def __call__(self, doc):
+        return self.predicate(doc)
+
+
+class Search(object):
+    """Search for samples across all projects by field values, coverage
+    range and modified timestamp. The documents are read from one range
+    of the 'sample/search' view, given by the first argument in the order
+    of SEARCH_FIELDS, modified_since and coverage, and any other arguments
+    are applied to each. The position in the range is given as an opaque
+    cursor, to continue from."""
+
+    def __init__(self, min_coverage=None, max_coverage=None,
+                 modified_since=None, **values):
+        clauses = []
+        ranges = []
+        for field in SEARCH_FIELDS:
+            value = values.get(field)
+            if value is None: continue
+            clauses.append(dict(field=field, op='==', value=value))
+            ranges.append(([field, value], [field, value, constants.HIGH_CHAR]))
+        if modified_since is not None:
+            clauses.append(dict(field='modified', op='>=',
+                                value=modified_since))
+            ranges.append((['modified', modified_since],
+                           ['modified', constants.HIGH_CHAR]))
+        if min_coverage is not None or max_coverage is not None:
+            clauses.append(dict(field='total_autosomal_coverage',
+                                op='range', value=[min_coverage, max_coverage]))
+            # false sorts after null and before all numbers.
+            if min_coverage is None:
+                startkey = ['total_autosomal_coverage', False]
+            else:
+                startkey = ['total_autosomal_coverage', min_coverage]
+            if max_coverage is None:
+                endkey = ['total_autosomal_coverage', constants.HIGH_CHAR]
+            else:
+                endkey = ['total_autosomal_coverage', max_coverage,
+                          constants.HIGH_CHAR]
+            ranges.append((startkey, endkey))
+        if not ranges:
+            ranges.append((['modified'], ['modified', constants.HIGH_CHAR]))
+        self.startkey, self.endkey = ranges[0]
+        if clauses:
+            self.predicate = compile_tree({'and': clauses})
+        else:
+            self.predicate = lambda doc: True
+
+    def get_options(self, cursor=None):
+        """Return the view query options for the range, starting after
+        the position given by the cursor, if any.
+        Raise ValueError if the cursor is invalid for this search."""
+        if not cursor:
+            return dict(startkey=self.startkey, endkey=self.endkey)
+        key, docid = utils.decode_cursor(cursor)
+        if not isinstance(key, list) or key[:1] != self.startkey[:1]:
+            raise ValueError('cursor does not belong to this search')
+        return dict(startkey=key, startkey_docid=docid, skip=1,
+                    endkey=self.endkey)
+
+    def get_cursor(self, row):
+        "Return the cursor for the position after the view row."
+        return utils.encode_cursor(row.key, row.id)
+
+    def __call__(self, doc):
+        return self.predicate(doc)
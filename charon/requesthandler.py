@@ -11,20 +11,48 @@ import charon
 from . import settings
 from . import constants
 from . import utils
+from . import asyncdb
+from . import metrics
+from .cache import documents as document_cache
+from .cache import tokens as token_cache
 
 
 class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
 
     def prepare(self):
-        "Get the database connection. Set up caches."
+        """Get the database connections; the blocking one, and the
+        non-blocking one used by the coroutine methods. Set up caches,
+        and start recording the performance metrics for the request."""
+        self._metrics = metrics.begin()
         self.db = utils.get_db()
+        self.async_db = asyncdb.get_db()
         self._cache = weakref.WeakValueDictionary()
         self._users = weakref.WeakValueDictionary()
         self._projects = weakref.WeakValueDictionary()
         self._samples = weakref.WeakValueDictionary()
         self._libpreps = weakref.WeakValueDictionary()
         self._seqruns = weakref.WeakValueDictionary()
+        self.save_batch = None
+        self.cache_generation = document_cache.get_generation()
+
+    def on_finish(self):
+        "Add the performance metrics of the request to the totals."
+        try:
+            metrics.finish(self, self._metrics)
+        except AttributeError:          # Failed before prepare.
+            pass
+
+    def write(self, chunk):
+        "Write the chunk, recording the time spent on JSON serialization."
+        with metrics.timer('serialize'):
+            super(RequestHandler, self).write(chunk)
+
+    def render_string(self, template_name, **kwargs):
+        "Render the template, recording the time spent."
+        with metrics.timer('render'):
+            return super(RequestHandler, self).render_string(template_name,
+                                                             **kwargs)
 
     def get_template_namespace(self):
         "Set the variables accessible within the template."
@@ -46,6 +74,14 @@ class RequestHandler(tornado.web.RequestHandler):
             url += '?' + urllib.parse.urlencode(kwargs)
         return url
 
+    def get_limit(self):
+        """Return the page size given by the query argument 'limit',
+        by default constants.PAGE_LIMIT, at most constants.MAX_PAGE_LIMIT.
+        Raise ValueError if it is not a positive integer."""
+        limit = int(self.get_argument('limit', constants.PAGE_LIMIT))
+        if limit < 1: raise ValueError('limit must be positive')
+        return min(limit, constants.MAX_PAGE_LIMIT)
+
     def get_current_user(self):
         """Get the currently logged-in user.
         Send to login page if none."""
@@ -65,9 +101,8 @@ class RequestHandler(tornado.web.RequestHandler):
             else:
                 try:
                     api_token = self.request.headers['X-Charon-API-token']
-                    rows = list(self.db.view('user/api_token')[api_token])
-                    if len(rows) != 1: raise KeyError
-                    user = self.get_user(rows[0].value)
+                    user = self.get_api_token_user(api_token)
+                    if user is None: raise KeyError
                     if user.get('status') != constants.ACTIVE: raise KeyError
                 except KeyError:
                     return None
@@ -89,99 +124,108 @@ class RequestHandler(tornado.web.RequestHandler):
         except KeyError:
             return self.get_and_cache('user/email', email, self._users)
 
-    def get_project(self, projectid):
+    def get_api_token_user(self, api_token):
+        """Get the user having the API token; from the token cache if there.
+        Return None if no such user."""
+        user = token_cache.get(api_token)
+        if user is None:
+            rows = list(self.db.view('user/api_token')[api_token])
+            if len(rows) != 1: return None
+            try:
+                user = self.get_user(rows[0].value)
+            except tornado.web.HTTPError:
+                return None
+            token_cache.put(api_token, user)
+        else:
+            self._users[user['email']] = user
+        return user
+
+    async def get_project(self, projectid):
         """Get the project by the projectid.
         Raise HTTP 404 if no such project."""
         try:
             return self._projects[projectid]
         except KeyError:
             try:
-                return self.get_and_cache('project/projectid',
-                                      projectid,
-                                      self._projects)
+                return await self.fetch_and_cache('project/projectid',
+                                                  projectid,
+                                                  self._projects)
             except tornado.web.HTTPError:
-                return self.get_and_cache('project/name',
-                                      projectid,
-                                      self._projects)
+                return await self.fetch_and_cache('project/name',
+                                                  projectid,
+                                                  self._projects)
 
-    def get_not_done_projects(self):
+    async def get_not_done_projects(self):
         "Get projects that are not done."
-        all = [r.value for r in
-               self.db.view('project/not_done')]
-        return all
-
-    def get_not_done_samples(self, projectid=None):
-        "Get samples that are not done."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/not_done') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/not_done')]
-
-        return all
-
-    def get_done_samples(self, projectid=None):
-        "Get samples that are not done."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/done') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/done')]
-
-        return all
-
-    def get_running_samples(self, projectid=None):
-        "Get samples that are running."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/running') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/running')]
-
-        return all
-
-    def get_failed_samples(self, projectid=None):
-        "Get samples that are failed."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/failed') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/failed')]
-
-        return all
-
-    def get_analyzed_failed_samples(self, projectid=None):
-        "Get samples that are failed or done."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/analyzed_failed') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/analyzed_failed')]
-
-        return all
-    def get_projectids_from_sampleid(self, sampleid):
-        pj_ids=[]
-        view1 = self.db.view('internal/sampleids_to_projectids')
-        rows=view1[sampleid]
-        for row in rows:
-            pj_ids.append(row.value)
-            return pj_ids
-
-    def get_projects(self, from_key=None, to_key=None, limit=20):
+        rows = await self.async_db.view('project/not_done', include_docs=True)
+        return [self.cache_item('project/projectid', r, self._projects,
+                                key=r.key)
+                for r in rows]
+
+    async def get_not_done_samples(self, projectid=None):
+        "Get samples that are not done, for the project if given."
+        rows = await self.async_db.view('sample/not_done', include_docs=True,
+                                        **utils.get_range(projectid))
+        return [self.cache_item('sample/sampleid', r, self._samples)
+                for r in rows]
+
+    async def get_samples_by_analysis_status(self, statuses, projectid=None):
+        """Get samples having any of the given analysis statuses,
+        for the project if given, by one range query per status.
+        The samples are ordered by projectid and sampleid."""
+        samples = []
+        for status in statuses:
+            rows = await self.async_db.view('sample/analysis_status',
+                                            include_docs=True,
+                                            **utils.get_range(status,
+                                                              projectid))
+            samples.extend([self.cache_item('sample/sampleid', r,
+                                            self._samples,
+                                            key=tuple(r.key[1:]))
+                            for r in rows])
+        if len(statuses) > 1:
+            samples.sort(key=lambda s: (s['projectid'], s['sampleid']))
+        return samples
+
+    async def get_done_samples(self, projectid=None):
+        "Get samples that are analyzed."
+        return await self.get_samples_by_analysis_status(
+            [constants.SAMPLE_ANALYSIS_STATUS['DONE']], projectid)
+
+    async def get_running_samples(self, projectid=None):
+        "Get samples that are under analysis."
+        return await self.get_samples_by_analysis_status(
+            [constants.SAMPLE_ANALYSIS_STATUS['ONGOING']], projectid)
+
+    async def get_failed_samples(self, projectid=None):
+        "Get samples whose analysis failed."
+        return await self.get_samples_by_analysis_status(
+            [constants.SAMPLE_ANALYSIS_STATUS['FAILED']], projectid)
+
+    async def get_analyzed_failed_samples(self, projectid=None):
+        "Get samples that are analyzed or whose analysis failed."
+        return await self.get_samples_by_analysis_status(
+            [constants.SAMPLE_ANALYSIS_STATUS['DONE'],
+             constants.SAMPLE_ANALYSIS_STATUS['FAILED']], projectid)
+
+    async def get_projectids_from_sampleid(self, sampleid):
+        "Get the projectids of all projects having a sample with the id."
+        rows = await self.async_db.view('internal/sampleids_to_projectids',
+                                        key=sampleid)
+        return [row.value for row in rows]
+
+    async def get_projects(self, from_key=None, to_key=None, limit=20):
         "Get all projects."
         if from_key:
-            view = self.db.view('project/modified', startkey=from_key, descending=True, limit=limit + 1)
+            rows = await self.async_db.view('project/modified', startkey=from_key, descending=True, limit=limit + 1, include_docs=True)
         elif to_key:
-            view = self.db.view('project/modified', startkey=to_key, limit=limit + 1)
+            rows = await self.async_db.view('project/modified', startkey=to_key, limit=limit + 1, include_docs=True)
         else:
-            view = self.db.view('project/modified', limit=limit + 1, descending=True)
+            rows = await self.async_db.view('project/modified', limit=limit + 1, descending=True, include_docs=True)
 
-        projects = [self.get_project(r.value) for r in view]
+        projects = [self.cache_item('project/projectid', r, self._projects,
+                                    key=r.value)
+                    for r in rows]
         has_more = len(projects) > limit
 
         # Sort the projects by the key desc if going backwards
@@ -192,115 +236,209 @@ class RequestHandler(tornado.web.RequestHandler):
         to_key = projects[-1]['modified'] if has_more else None
         if has_more:
             projects = projects[:limit]
-        
-
-        view1 = self.db.view('sample/count')
-        view2 = self.db.view('sample/count_done')
-        view3 = self.db.view('libprep/count', group_level=1)
-        view4 = self.db.view('sample/count_delivered')
-        for project in projects:
-            try:
-                row = view1[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count'] = 0
-            else:
-                project['sample_count'] = row.value
-            try:
-                row = view2[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count_done'] = 0
-            else:
-                project['sample_count_done'] = row.value
-            try:
-                row = view4[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count_delivered'] = 0
-            else:
-                project['sample_count_delivered'] = row.value
-            startkey = [project['projectid']]
-            endkey = [project['projectid'], constants.HIGH_CHAR]
-            try:
-                row = view3[startkey:endkey].rows[0]
-            except IndexError:
-                project['libprep_count'] = 0
-            else:
-                project['libprep_count'] = row.value
+        await self.add_project_counts(projects)
         return projects, has_more, from_key, to_key
 
-    def get_sample(self, projectid, sampleid):
+    async def add_project_counts(self, projects):
+        """Add the counts of samples and libpreps to the projects,
+        by one grouped query per count view for all of them."""
+        if not projects: return
+        keys = [p['projectid'] for p in projects]
+        counts = dict()
+        for name in ('sample/count', 'sample/count_done',
+                     'sample/count_delivered', 'libprep/count_project'):
+            rows = await self.async_db.view(name, group=True, keys=keys)
+            counts[name] = dict([(r.key, r.value) for r in rows])
+        for project in projects:
+            key = project['projectid']
+            project['sample_count'] = counts['sample/count'].get(key, 0)
+            project['sample_count_done'] = \
+                counts['sample/count_done'].get(key, 0)
+            project['sample_count_delivered'] = \
+                counts['sample/count_delivered'].get(key, 0)
+            project['libprep_count'] = \
+                counts['libprep/count_project'].get(key, 0)
+
+    async def get_sample(self, projectid, sampleid):
         """Get the sample by the projectid and sampleid.
         Raise HTTP 404 if no such sample."""
         key = (projectid, sampleid)
         try:
             return self._samples[key]
         except KeyError:
-            return self.get_and_cache('sample/sampleid', key, self._samples)
+            return await self.fetch_and_cache('sample/sampleid', key,
+                                              self._samples)
 
-    def get_samples(self, projectid=None):
-        "Get all samples for the project."
+    async def get_samples(self, projectid=None):
+        """Get all samples for the project.
+        The documents are fetched in one view query, and cached."""
         startkey = (projectid or '', '')
         endkey = (projectid or constants.HIGH_CHAR, constants.HIGH_CHAR)
-        return [self.get_sample(*r.key) for r in
-                self.db.view('sample/sampleid')[startkey:endkey]]
-
-    def get_libprep(self, projectid, sampleid, libprepid):
+        rows = await self.async_db.view('sample/sampleid', include_docs=True,
+                                        startkey=startkey, endkey=endkey)
+        return [self.cache_item('sample/sampleid', r, self._samples)
+                for r in rows]
+
+    def get_samples_view(self, projectid=None, status=None):
+        """Return the view name and range options for all samples for
+        the project, having the status if given."""
+        if status:
+            return 'sample/status', utils.get_range(status, projectid)
+        else:
+            return 'sample/sampleid', dict(
+                startkey=(projectid or '', ''),
+                endkey=(projectid or constants.HIGH_CHAR, constants.HIGH_CHAR))
+
+    async def iter_samples(self, projectid=None, status=None):
+        """Yield all samples for the project, having the status if given,
+        as they arrive from the database. The documents are not cached."""
+        viewname, options = self.get_samples_view(projectid, status)
+        async for row in self.async_db.iterview(viewname, include_docs=True,
+                                                **options):
+            yield row.doc
+
+    async def iter_query_samples(self, query):
+        """Yield the samples matching the compiled query.query.Query,
+        reading only those in its view scans. The documents are not cached."""
+        seen = set()
+        for viewname, options in query.scans:
+            async for row in self.async_db.iterview(viewname,
+                                                    include_docs=True,
+                                                    **options):
+                if row.id in seen: continue
+                if len(query.scans) > 1:
+                    seen.add(row.id)
+                if query(row.doc):
+                    yield row.doc
+
+    async def get_libprep(self, projectid, sampleid, libprepid):
         """Get the libprep by the projectid, sampleid and libprepid.
         Raise HTTP 404 if no such libprep."""
         key = (projectid, sampleid, libprepid)
         try:
             return self._libpreps[key]
         except KeyError:
-            return self.get_and_cache('libprep/libprepid', key, self._libpreps)
-
-    def get_libpreps(self, projectid, sampleid=''):
+            return await self.fetch_and_cache('libprep/libprepid', key,
+                                              self._libpreps)
+
+    def get_libpreps_range(self, projectid, sampleid=''):
+        """Return the range options of the 'libprep/libprepid' view for the
+        libpreps of the sample if sampleid given, else of the project."""
+        return dict(startkey=(projectid, sampleid, ''),
+                    endkey=(projectid,
+                            sampleid or constants.HIGH_CHAR,
+                            constants.HIGH_CHAR))
+
+    async def get_libpreps(self, projectid, sampleid=''):
         """Get the libpreps for the sample if sampleid given.
         For the entire project if no sampleid."""
-        startkey = (projectid, sampleid, '')
-        endkey = (projectid,
-                  sampleid or constants.HIGH_CHAR,
-                  constants.HIGH_CHAR)
-        return [self.get_libprep(*r.key) for r in
-                self.db.view('libprep/libprepid')[startkey:endkey]]
-
-    def get_seqrun(self, projectid, sampleid, libprepid, seqrunid):
+        rows = await self.async_db.view('libprep/libprepid', include_docs=True,
+                                        **self.get_libpreps_range(projectid,
+                                                                  sampleid))
+        return [self.cache_item('libprep/libprepid', r, self._libpreps)
+                for r in rows]
+
+    async def get_seqrun(self, projectid, sampleid, libprepid, seqrunid):
         """Get the libprep by the projectid, sampleid, libprepid and seqrunid.
         Raise HTTP 404 if no such seqrun."""
         try:
             key = (projectid, sampleid, libprepid, seqrunid)
             return self._seqruns[key]
         except (ValueError, KeyError):
-            return self.get_and_cache('seqrun/seqrunid', key, self._seqruns)
-
-    def get_seqruns(self, projectid='', sampleid='', libprepid=''):
+            return await self.fetch_and_cache('seqrun/seqrunid', key,
+                                              self._seqruns)
+
+    def get_seqruns_range(self, projectid='', sampleid='', libprepid=''):
+        """Return the range options of the 'seqrun/seqrunid' view for the
+        seqruns of the libprep, sample or project, or all."""
+        return dict(startkey=(projectid  or '', sampleid or '',
+                              libprepid or '', ''),
+                    endkey=(projectid or constants.HIGH_CHAR,
+                            sampleid or constants.HIGH_CHAR,
+                            libprepid or constants.HIGH_CHAR,
+                            constants.HIGH_CHAR))
+
+    async def get_seqruns(self, projectid='', sampleid='', libprepid=''):
         """Get the seqruns for the libprep if libprepid given.
         For the entire sample if no libprepid.
         For the entire project if no sampleid."""
-        startkey = (projectid  or '', sampleid or '', libprepid or '', '')
-        endkey = (projectid or constants.HIGH_CHAR,
-                  sampleid or constants.HIGH_CHAR,
-                  libprepid or constants.HIGH_CHAR,
-                  constants.HIGH_CHAR)
-        return [self.get_seqrun(*r.key) for r in
-                self.db.view('seqrun/seqrunid')[startkey:endkey]]
+        rows = await self.async_db.view('seqrun/seqrunid', include_docs=True,
+                                        **self.get_seqruns_range(projectid,
+                                                                 sampleid,
+                                                                 libprepid))
+        return [self.cache_item('seqrun/seqrunid', r, self._seqruns)
+                for r in rows]
+
+    async def iter_seqruns(self, projectid='', sampleid='', libprepid=''):
+        """Yield the seqruns as they arrive from the database, for the
+        libprep, sample or project, or all. The documents are not cached."""
+        async for row in self.async_db.iterview(
+                'seqrun/seqrunid', include_docs=True,
+                **self.get_seqruns_range(projectid, sampleid, libprepid)):
+            yield row.doc
 
     def get_and_cache(self, viewname, key, cache):
         """Get the item by the view name and the key.
-        Try to get it from the cache, else from the database.
+        Try to get it from the process-wide document cache,
+        else from the database.
         Raise HTTP 404 if no such item."""
-        view = self.db.view(viewname, include_docs=True)
-        rows = list(view[key])
-        if len(rows) == 1:
-            item = cache[key] = rows[0].doc
-            self._cache[item['_id']] = item
-            return item
-        else:
+        item = document_cache.get(viewname, key)
+        if item is None:
+            generation = document_cache.get_generation()
+            view = self.db.view(viewname, include_docs=True)
+            item = self.cache_found(viewname, key, list(view[key]),
+                                    generation=generation)
+        cache[key] = item
+        self._cache[item['_id']] = item
+        return item
+
+    async def fetch_and_cache(self, viewname, key, cache):
+        """Get the item by the view name and the key, without blocking.
+        Try to get it from the process-wide document cache,
+        else from the database.
+        Raise HTTP 404 if no such item."""
+        item = document_cache.get(viewname, key)
+        if item is None:
+            generation = document_cache.get_generation()
+            rows = await self.async_db.view(viewname, key=key,
+                                            include_docs=True)
+            item = self.cache_found(viewname, key, rows,
+                                    generation=generation)
+        cache[key] = item
+        self._cache[item['_id']] = item
+        return item
+
+    def cache_found(self, viewname, key, rows, generation=None):
+        """Put the document of the single view row into the process-wide
+        document cache, unless it may be stale since the cache generation
+        obtained before the read, and return it.
+        Raise HTTP 404 if not exactly one row."""
+        if len(rows) != 1:
             logging.debug("{0} elements for key {1} ".format(len(rows), key))
             raise tornado.web.HTTPError(404, reason='{0} elements for key {1}'.format(len(rows), key))
+        item = rows[0].doc
+        document_cache.put(viewname, key, item, generation=generation)
+        return item
+
+    def cache_item(self, viewname, row, cache, key=None):
+        """Put the document of the view row into the caches, unless
+        already obtained during this request. Return the document.
+        The cache key is the row key, unless given. The view was read
+        after the cache generation obtained when the request began."""
+        if key is None:
+            key = tuple(row.key)
+        item = cache.get(key)
+        if item is None or item['_id'] != row.id:
+            item = cache[key] = row.doc
+            self._cache[item['_id']] = item
+            document_cache.put(viewname, key, item,
+                               generation=self.cache_generation)
+        return item
 
-    def get_logs(self, id):
+    async def get_logs(self, id):
         "Return the log documents for the given doc id."
-        view = self.db.view('log/doc', include_docs=True)
-        return sorted([r.doc for r in view[id]],
+        rows = await self.async_db.view('log/doc', key=id, include_docs=True)
+        return sorted([r.doc for r in rows],
                       key=functools.cmp_to_key(utils.cmp_timestamp),
                       reverse=True)
 
@@ -1,6 +1,7 @@
 " Charon: Sample entity interface. "
 
 import logging
+import math
 import json
 
 import tornado.web
@@ -9,6 +10,7 @@ import couchdb
 import charon.constants as cst
 import charon.utils as utls
 import charon.saver as sav
+import charon.query as query
 from charon.requesthandler import RequestHandler
 from charon.api import ApiRequestHandler
 
@@ -16,13 +18,14 @@ from charon.api import ApiRequestHandler
 class SampleidField(sav.IdField):
     "The unique identifier for the sample within the project."
 
+    unique_view = 'sample/sampleid'
+    unique_parents = ('projectid',)
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         super(SampleidField, self).check_valid(saver, value)
-        key = (saver.project['projectid'], value)
-        view = saver.db.view('sample/sampleid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value,
+                          dict(projectid=saver.project['projectid']))
 
 
 class SampleSaver(sav.Saver):
@@ -75,9 +78,12 @@ class SampleSaver(sav.Saver):
         else:
             if project:
                 assert self.doc['projectid'] == project['projectid']
-                self.project = project
-            else:
-                self.project = rqh.get_project(self.doc['projectid'])
+            self.project = project
+
+    async def setup(self):
+        "Get the project, unless given."
+        if self.project is None:
+            self.project = await self.rqh.get_project(self.doc['projectid'])
 
 
 class Sample(RequestHandler):
@@ -86,21 +92,18 @@ class Sample(RequestHandler):
     saver = SampleSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid):
-        sample = self.get_sample(projectid, sampleid)
-        libpreps = self.get_libpreps(projectid, sampleid)
-        view = self.db.view('seqrun/count')
+    async def get(self, projectid, sampleid):
+        sample = await self.get_sample(projectid, sampleid)
+        libpreps = await self.get_libpreps(projectid, sampleid)
+        # Counts for all libpreps, keyed by [projectid, sampleid, libprepid].
+        rows = await self.async_db.view('seqrun/count', group_level=3,
+                                        startkey=[projectid, sampleid],
+                                        endkey=[projectid, sampleid,
+                                                cst.HIGH_CHAR])
+        seqruns_counts = dict([(r.key[2], r.value) for r in rows])
         for libprep in libpreps:
-            try:
-                startkey = [projectid, sampleid, libprep['libprepid']]
-                endkey = [projectid, sampleid, libprep['libprepid'],
-                          cst.HIGH_CHAR]
-                row = view[startkey:endkey].rows[0]
-            except IndexError:
-                libprep['seqruns_count'] = 0
-            else:
-                libprep['seqruns_count'] = row.value
-        logs = self.get_logs(sample['_id']) # XXX limit?
+            libprep['seqruns_count'] = seqruns_counts.get(libprep['libprepid'], 0)
+        logs = await self.get_logs(sample['_id']) # XXX limit?
         self.render('sample.html',
                     sample=sample,
                     libpreps=libpreps,
@@ -114,17 +117,17 @@ class SampleCreate(RequestHandler):
     saver = SampleSaver
 
     @tornado.web.authenticated
-    def get(self, projectid):
+    async def get(self, projectid):
         self.render('sample_create.html',
-                    project=self.get_project(projectid),
+                    project=await self.get_project(projectid),
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid):
+    async def post(self, projectid):
         self.check_xsrf_cookie()
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         try:
-            with self.saver(rqh=self, project=project) as saver:
+            async with self.saver(rqh=self, project=project) as saver:
                 saver.store()
                 sample = saver.doc
         except (IOError, ValueError) as msg:
@@ -143,18 +146,18 @@ class SampleEdit(RequestHandler):
     saver = SampleSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid):
-        sample = self.get_sample(projectid, sampleid)
+    async def get(self, projectid, sampleid):
+        sample = await self.get_sample(projectid, sampleid)
         self.render('sample_edit.html',
                     sample=sample,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid, sampleid):
+    async def post(self, projectid, sampleid):
         self.check_xsrf_cookie()
-        sample = self.get_sample(projectid, sampleid)
+        sample = await self.get_sample(projectid, sampleid)
         try:
-            with self.saver(doc=sample, rqh=self) as saver:
+            async with self.saver(doc=sample, rqh=self) as saver:
                 saver.store()
         except (IOError, ValueError) as msg:
             self.render('sample_edit.html',
@@ -172,28 +175,28 @@ class ApiSample(ApiRequestHandler):
     saver = SampleSaver
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def get(self, projectid, sampleid):
+    async def get(self, projectid, sampleid):
         """Return the sample data as JSON.
         Return HTTP 404 if no such sample or project."""
-        sample = self.get_sample(projectid, sampleid)
+        sample = await self.get_sample(projectid, sampleid)
         if not sample: return
         self.add_sample_links(sample)
         self.write(sample)
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def put(self, projectid, sampleid):
+    async def put(self, projectid, sampleid):
         """Update the sample with the given JSON data.
         Return HTTP 204 "No Content".
         Return HTTP 400 if the input data is invalid.
         Return HTTP 409 if there is a document revision conflict."""
-        sample = self.get_sample(projectid, sampleid)
+        sample = await self.get_sample(projectid, sampleid)
         try:
             data = json.loads(self.request.body)
         except Exception as msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=sample, rqh=self) as saver:
+                async with self.saver(doc=sample, rqh=self) as saver:
                     saver.store(data=data)
             except ValueError as msg:
                 self.send_error(400, reason=str(msg))
@@ -203,11 +206,11 @@ class ApiSample(ApiRequestHandler):
                 self.set_status(204)
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def delete(self, projectid, sampleid):
+    async def delete(self, projectid, sampleid):
         """NOTE: This is for unit test purposes only!
         Delete the sample and all of its dependent entities.
         Returns HTTP 204 "No Content"."""
-        sample= self.get_sample(projectid, sampleid)
+        sample= await self.get_sample(projectid, sampleid)
         if not sample: return
         utls.delete_sample(self.db, sample)
         logging.debug("deleted sample {0}, {1}".format(projectid, sampleid))
@@ -220,13 +223,13 @@ class ApiSampleCreate(ApiRequestHandler):
     saver = SampleSaver
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def post(self, projectid):
+    async def post(self, projectid):
         """Create a sample within a project.
         Return HTTP 201, sample URL in header "Location", and sample data.
         Return HTTP 400 if something is wrong with the input data.
         Return HTTP 404 if no such project.
         Return HTTP 409 if there is a document revision conflict."""
-        project = self.get_project(projectid)
+        project = await self.get_project(projectid)
         if not project: return
         try:
             data = json.loads(self.request.body)
@@ -234,7 +237,7 @@ class ApiSampleCreate(ApiRequestHandler):
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(rqh=self, project=project) as saver:
+                async with self.saver(rqh=self, project=project) as saver:
                     saver.store(data=data)
                     sample = saver.doc
             except (KeyError, ValueError) as msg:
@@ -255,39 +258,48 @@ class ApiSamples(ApiRequestHandler):
     "Access to all samples in a project."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def get(self, projectid):
-        "Return a list of all samples."
-        samples = self.get_samples(projectid)
-        for sample in samples:
-            self.add_sample_links(sample)
-        self.write(dict(samples=samples))
+    async def get(self, projectid):
+        """Return a list of all samples, or those having the status
+        given by the query argument 'status'.
+        The samples are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'.
+        One page of samples if the query argument 'limit' or 'cursor'
+        is given, with the cursor and link for the next page."""
+        viewname, options = self.get_samples_view(
+            projectid, status=self.get_argument('status', None))
+        await self.write_page(viewname, options,
+                              key='samples',
+                              add_links=self.add_sample_links)
 
 
 class ApiSamplesNotDone(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def get(self):
-        "Return a list of all undone samples."
-        samples= self.get_not_done_samples()
-        for sample in samples:
-            self.add_sample_links(sample)
-        self.write(dict(samples=samples))
+    async def get(self):
+        """Return a list of all undone samples.
+        The samples are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'.
+        One page of samples if the query argument 'limit' or 'cursor'
+        is given, with the cursor and link for the next page."""
+        await self.write_page('sample/not_done', dict(),
+                              key='samples',
+                              add_links=self.add_sample_links)
 
 class ApiSamplesDone(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def get(self):
+    async def get(self):
         "Return a list of all done samples."
-        samples= self.get_done_samples()
+        samples= await self.get_done_samples()
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
 class SamplesDone(RequestHandler):
     "displays a list of currently Analyzed samples"
-    def get(self):
-        samples=self.get_done_samples(self.get_argument("projectid", None))
+    async def get(self):
+        samples=await self.get_done_samples(self.get_argument("projectid", None))
         self.render('samples_subset.html',
                     samples=samples,
                     identifier="Samples Analyzed successfully")
@@ -296,100 +308,143 @@ class ApiSamplesNotDonePerProject(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def get(self, projectid):
+    async def get(self, projectid):
         "Return a list of all undone samples."
-        samples= self.get_not_done_samples(projectid)
+        samples= await self.get_not_done_samples(projectid)
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
 
 class ApiSamplesRunning(ApiRequestHandler):
     "retuns a list of samples that are currently running"
-    def get(self):
-        self.write(json.dumps(self.get_running_samples(self.get_argument("projectid", None))))
+    async def get(self):
+        self.write(json.dumps(await self.get_running_samples(self.get_argument("projectid", None))))
 
 class SamplesRunning(RequestHandler):
     "displays a list of currently running samples"
-    def get(self):
-        samples=self.get_running_samples(self.get_argument("projectid", None))
+    async def get(self):
+        samples=await self.get_running_samples(self.get_argument("projectid", None))
         self.render('samples_subset.html',
                     samples=samples,
                     identifier="Samples Running")
 
 class ApiSamplesFailed(ApiRequestHandler):
     "retuns a list of samples that are currently failed"
-    def get(self):
-        self.write(json.dumps(self.get_failed_samples(self.get_argument("projectid", None))))
+    async def get(self):
+        self.write(json.dumps(await self.get_failed_samples(self.get_argument("projectid", None))))
 
 class SamplesFailed(RequestHandler):
     "displays a list of currently Failed samples"
-    def get(self):
-        samples=self.get_failed_samples(self.get_argument("projectid", None))
+    async def get(self):
+        samples=await self.get_failed_samples(self.get_argument("projectid", None))
         self.render('samples_subset.html',
                     samples=samples,
                     identifier="Samples with Failed Analysis")
 
 class ApiSamplesDoneFailed(ApiRequestHandler):
     "retuns a list of samples that are currently failed"
-    def get(self):
-        self.write(json.dumps(self.get_analyzed_failed_samples(self.get_argument("projectid", None))))
+    async def get(self):
+        self.write(json.dumps(await self.get_analyzed_failed_samples(self.get_argument("projectid", None))))
 
 class SamplesDoneFailed(RequestHandler):
     "displays a list of Done and Failed samples"
-    def get(self):
-        samples=self.get_analyzed_failed_samples(self.get_argument("projectid", None))
+    async def get(self):
+        samples=await self.get_analyzed_failed_samples(self.get_argument("projectid", None))
         self.render('samples_subset.html',
                     samples=samples,
                     identifier="Samples with Failed or Done Analysis")
 
+class ApiSampleSearch(ApiRequestHandler):
+    """Search for samples across all projects. The query arguments are
+    analysis_status, delivery_status, type, min_coverage, max_coverage
+    (total autosomal coverage), modified_since (timestamp), limit (max
+    number of samples, default 100) and cursor (from a previous result)."""
+
+    # Do not use authenticaton decorator; do not send to login page, but fail.
+    async def get(self):
+        """Return a dictionary with the list of matching samples, and the
+        cursor for getting the next page of samples, or null if none.
+        At most constants.SEARCH_MAX_ROWS view rows are examined per call,
+        so the page may have fewer samples than the limit although there
+        are more to come; continue while the cursor is not null."""
+        try:
+            limit = self.get_limit()
+            values = dict()
+            for key in query.SEARCH_FIELDS + ['modified_since']:
+                values[key] = self.get_argument(key, None)
+            for key in ['min_coverage', 'max_coverage']:
+                value = self.get_argument(key, None)
+                if value is not None:
+                    value = float(value)
+                    if not math.isfinite(value):
+                        raise ValueError("{0} must be finite".format(key))
+                values[key] = value
+            search = query.Search(**values)
+            options = search.get_options(self.get_argument('cursor', None))
+        except ValueError as msg:
+            raise tornado.web.HTTPError(400, reason=str(msg))
+        samples = []
+        cursor = None
+        batch = max(limit, 100)
+        scanned = 0
+        while len(samples) < limit:
+            if scanned >= cst.SEARCH_MAX_ROWS: break
+            rows = await self.async_db.view('sample/search',
+                                            include_docs=True,
+                                            limit=batch,
+                                            **options)
+            for row in rows:
+                scanned += 1
+                cursor = search.get_cursor(row)
+                if search(row.doc):
+                    samples.append(row.doc)
+                    if len(samples) == limit: break
+            if len(rows) < batch and len(samples) < limit:
+                cursor = None
+                break
+            options = search.get_options(cursor)
+        for sample in samples:
+            self.add_sample_links(sample)
+        self.write(dict(samples=samples, cursor=cursor))
+
+
 class ApiProjectsFromSampleIds(ApiRequestHandler):
     "returns a list of project ids for the given sampleid"
-    def get(self, sampleid):
-        project_ids=self.get_projectids_from_sampleid(sampleid)
+    async def get(self, sampleid):
+        project_ids=await self.get_projectids_from_sampleid(sampleid)
         self.write(json.dumps(project_ids))
 
 
 
 
 class ApiSamplesCustomQuery(ApiRequestHandler):
-    """Access to all samples that match the given query. The query MUST be a dictionnary with
-    the following keys : projectid, sampleField, operator, value, type.
+    """Access to all samples that match the given query. The query MUST be
+    a dictionary with the key 'filter', a filter tree as described in
+    charon/query.py, and optionally 'projectid':
+    ex : {'projectid': 'P567', 'filter': {'and': [
+            {'field': 'total_sequenced_reads', 'op': '>=', 'value': 10},
+            {'field': 'analysis_status', 'op': 'in',
+             'value': ['ANALYZED', 'FAILED']}]}}
+    The legacy form, a dictionary with the keys projectid, sampleField,
+    operator, value and type, is also accepted:
     ex : {'projectid':'P567', 'sampleField':'total_sequenced_reads', 'operator':'>=' , 'value':10, 'type':'float'}"""
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
-    def post(self):
-        "Return a list of all samples matching the query."
+    async def post(self):
+        """Return a list of all samples matching the query.
+        The samples are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'."""
         try:
             data = json.loads(self.request.body)
-            if 'projectid' not in data:
-                raise KeyError('data given does not contain a projectid')
-            if 'sampleField' not in data:
-                raise KeyError('data given does not contain a sampleField')
-            if 'operator' not in data:
-                raise KeyError('data given does not contain an operator ')
-            if 'type' not in data:
-                raise KeyError('data given does not contain a type')
-            if 'value' not in data:
-                raise KeyError('data given does not contain a value')
-            if  data['operator'] not in ['==', '>', '<', '<=', '>=', 'is']:
-                raise ValueError('Unallowed operator : {0}'.format(data['operator']))
-            allsamples= self.get_samples(data['projectid'])
-            samples=[]
-            query="sample.get('{0}') {1} {2}('{3}')".format(data['sampleField'], data['operator'], data['type'], data['value'])
-        except Exception as msg:
-            self.send_error(400, reason=str(msg))
-
-        for sample in allsamples:
-            try:
-                if not sample.get(data['sampleField']):
-                    #if the field is not in the db, just skip the doc
-                    continue
-                if type(sample.get(data['sampleField'])).__name__ != data['type']:
-                    raise TypeError('Given type does not match database type {0}'.format(type(sample.get(data['sampleField'])).__name__))
-                if eval(query, {"__builtins__":None}, {'sample':sample, 'int':int, 'str':str, 'float':float, 'unicode':str, 'text':str} ):
-                    samples.append(sample)
-            except Exception as msg:
-                self.send_error(400, reason=str(msg))
-        for sample in samples:
-            self.add_sample_links(sample)
-        self.write(dict(samples=samples))
+            if not isinstance(data, dict):
+                raise ValueError('query must be a dictionary')
+            if 'filter' in data:
+                tree = data['filter']
+            else:
+                tree = query.from_legacy(data)
+            compiled = query.Query(tree, projectid=data.get('projectid'))
+        except (KeyError, ValueError) as msg:
+            raise tornado.web.HTTPError(400, reason=str(msg))
+        await self.write_stream(self.iter_query_samples(compiled),
+                                key='samples',
+                                add_links=self.add_sample_links)
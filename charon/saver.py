@@ -6,12 +6,17 @@ import couchdb
 
 from . import constants
 from . import utils
+from . import cache
+from . import metrics
+from . import logwriter
 
 
 class Field(object):
     "Specification of a data field for an entity."
 
     type ='text'
+    unique_view = None          # View in which the value must not be a key.
+    unique_parents = ()         # Parent identifiers prefixing the view key.
 
     def __init__(self, key, title=None, description=None,
                  mandatory=False, editable=True, default=None):
@@ -75,6 +80,18 @@ class Field(object):
         "Check that the value, if provided, is valid."
         pass
 
+    def check_unique(self, saver, value, parents=dict()):
+        """Check that the value is not a key in the unique_view,
+        given the identifiers of the parent entities."""
+        key = self.get_unique_key(parents, value)
+        if saver.is_found(self.unique_view, key):
+            raise ValueError('not unique')
+
+    def get_unique_key(self, parents, value):
+        "Return the key for the value in the unique_view."
+        if not self.unique_parents: return value
+        return tuple([parents[k] for k in self.unique_parents] + [value])
+
     def html_display(self, entity):
         "Return the field value as valid HTML."
         return str(entity.get(self.key) or '-')
@@ -297,10 +314,15 @@ class Saver(object):
         if rqh is not None:
             self.rqh = rqh
             self.db = rqh.db
+            self.async_db = rqh.async_db
             self.current_user = rqh.current_user
+            self.batch = getattr(rqh, 'save_batch', None)
+            self.found = getattr(rqh, 'unique_found', None) or dict()
         elif db is not None:
             self.db = db
             self.current_user = dict()
+            self.batch = None
+            self.found = dict()
         else:
             raise AttributeError('neither db nor rqh given')
         self.doc = doc or dict()
@@ -318,14 +340,34 @@ class Saver(object):
     def __exit__(self, type, value, tb):
         if type is not None: return False # No exceptions handled here
         self.finalize()
-        try:
-            self.db.save(self.doc)
-        except couchdb.http.ResourceConflict:
-            raise IOError('document revision update conflict')
-        if self.changed:
-            utils.log(self.db, self.doc,
-                      changed=self.changed,
-                      current_user=self.current_user)
+        with metrics.timer('save'):
+            try:
+                logwriter.save_sync(self.db, self.doc, self.get_log_entry())
+            except couchdb.http.ResourceConflict:
+                raise IOError('document revision update conflict')
+            finally:
+                cache.documents.evict(self.doc['_id'])
+
+    async def __aenter__(self):
+        await self.setup()
+        return self
+
+    async def __aexit__(self, type, value, tb):
+        """Save the entity and its log entry without blocking.
+        If the request handler has a batch, add them to it instead."""
+        if type is not None: return False # No exceptions handled here
+        self.finalize()
+        if self.batch is not None:
+            self.batch.add(self.doc, self.get_log_entry())
+            return
+        with metrics.timer('save'):
+            try:
+                await logwriter.save(self.async_db, self.doc,
+                                     self.get_log_entry())
+            except couchdb.http.ResourceConflict:
+                raise IOError('document revision update conflict')
+            finally:
+                cache.documents.evict(self.doc['_id'])
 
     def __setitem__(self, key, value):
         "Update the key/value pair."
@@ -351,11 +393,41 @@ class Saver(object):
             self.doc[key] = value
             self.changed[key] = value
         else:
-            field.store(self, value)
+            field.store(self, data={key: value})
 
     def __getitem__(self, key):
         return self.doc[key]
 
+    async def setup(self):
+        """Perform any non-blocking set-up, such as fetching parent entities.
+        Called when entering the context using 'async with'."""
+        pass
+
+    def is_found(self, viewname, key):
+        """Is the key in the view? Use the result from fetch_unique,
+        if there is one, else query the view (blocking)."""
+        try:
+            return self.found[(viewname, key)]
+        except (KeyError, TypeError):
+            return len(list(self.db.view(viewname)[key])) > 0
+
+    @classmethod
+    def get_unique_keys(cls, parents, data):
+        """Return the list of (viewname, key) for checking the uniqueness
+        of the string values in the data, given the parent identifiers."""
+        result = []
+        for field in cls.fields:
+            if not field.unique_view: continue
+            value = data.get(field.key)
+            if not isinstance(value, str): continue
+            try:
+                key = field.get_unique_key(parents, value)
+                hash(key)
+            except (KeyError, TypeError):
+                continue
+            result.append((field.unique_view, key))
+        return result
+
     def initialize(self):
         "Perform actions when creating the entity."
         self.doc['created'] = utils.timestamp()
@@ -376,8 +448,35 @@ class Saver(object):
         "Perform any final modifications before saving the entity."
         self.doc['modified'] = utils.timestamp()
 
+    def get_log_entry(self):
+        "Return the log entry for the changes, or None if no changes."
+        if not self.changed: return None
+        return utils.log_entry(self.doc,
+                               changed=self.changed,
+                               current_user=self.current_user)
+
     def get(self, key, default=None):
         try:
             return self[key]
         except KeyError:
             return default
+
+
+async def fetch_unique(async_db, keys):
+    """Find which of the (viewname, key) pairs are in their views,
+    using one 'keys' query per view. Return a dictionary of
+    (viewname, key) -> bool, for the savers to check uniqueness with
+    instead of one blocking query per value."""
+    result = dict()
+    views = dict()
+    for viewname, key in keys:
+        views.setdefault(viewname, set()).add(key)
+        result[(viewname, key)] = False
+    for viewname, viewkeys in views.items():
+        rows = await async_db.view(viewname,
+                                   keys=[list(k) if isinstance(k, tuple) else k
+                                         for k in viewkeys])
+        for row in rows:
+            key = tuple(row.key) if isinstance(row.key, list) else row.key
+            result[(viewname, key)] = True
+    return result
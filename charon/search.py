@@ -0,0 +1,160 @@
+" Charon: In-memory prefix search index, kept up to date from the changes feed. "
+
+import bisect
+import logging
+import re
+import threading
+import time
+
+from . import constants
+from . import settings
+from .changes import ChangesFollower
+
+
+# Name fragments are separated by any of these characters.
+SPLIT_RX = re.compile(r'[\s._-]+')
+
+# Rank of a match; lower is better.
+EXACT, PREFIX, FRAGMENT = 0, 1, 2
+
+# Order of the document types in the result, within the same rank.
+DOCTYPES = [constants.PROJECT, constants.SAMPLE, constants.USER]
+
+
+def get_fragments(value):
+    """Return the fragments of the value: the rest of the value from the
+    start of each part after the first, e.g. 'B_1' and '1' for 'A.B_1'."""
+    return [value[m.end():] for m in SPLIT_RX.finditer(value)
+            if m.end() < len(value) and m.start() > 0]
+
+
+class SearchIndex(object):
+    """Prefix index over project ids, names and name fragments, sample ids,
+    and user emails, names and name fragments.
+    The terms are held lowercased in a sorted list of (term, rank, doc id),
+    so that the terms having a given prefix are found by bisection.
+    Only the fields needed for displaying a hit are kept for each document."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.terms = []                 # Sorted list of (term, rank, doc id)
+        self.items = dict()             # doc id -> (item, list of terms)
+        self.changes = 0
+
+    def load(self, db):
+        "Index all projects, samples and users in the database."
+        with self.lock:
+            self.terms = []
+            self.items.clear()
+            for viewname in ['project/projectid', 'sample/sampleid',
+                             'user/email']:
+                for row in db.iterview(viewname, 1000, include_docs=True):
+                    self.add(row.doc, sort=False)
+            self.terms.sort()
+
+    def changed(self, change):
+        """Callback for the changes feed, which must include the docs.
+        Re-index the changed document."""
+        with self.lock:
+            self.remove(change['id'])
+            if not change.get('deleted'):
+                self.add(change['doc'])
+            self.changes += 1
+
+    def add(self, doc, sort=True):
+        "Index the document, if it is of a searchable type."
+        doctype = doc.get(constants.DB_DOCTYPE)
+        item = {constants.DB_DOCTYPE: doctype,
+                '_id': doc['_id'],
+                'modified': doc.get('modified') or ''}
+        terms = []
+        if doctype == constants.PROJECT:
+            item['projectid'] = doc.get('projectid')
+            item['name'] = doc.get('name')
+            terms.append((item['projectid'], EXACT))
+            if item['name']:
+                terms.append((item['name'], PREFIX))
+                terms.extend([(f, FRAGMENT)
+                              for f in get_fragments(item['name'])])
+        elif doctype == constants.SAMPLE:
+            item['projectid'] = doc.get('projectid')
+            item['sampleid'] = doc.get('sampleid')
+            terms.append((item['sampleid'], EXACT))
+        elif doctype == constants.USER:
+            item['email'] = doc.get('email')
+            item['name'] = doc.get('name')
+            terms.append((item['email'], EXACT))
+            if item['name']:
+                terms.append((item['name'], PREFIX))
+                terms.extend([(f, FRAGMENT)
+                              for f in get_fragments(item['name'])])
+        else:
+            return
+        terms = [(t.lower(), rank, doc['_id']) for t, rank in terms if t]
+        self.items[doc['_id']] = (item, terms)
+        for term in terms:
+            if sort:
+                bisect.insort(self.terms, term)
+            else:
+                self.terms.append(term)
+
+    def remove(self, docid):
+        "Remove the document from the index, if it is there."
+        try:
+            item, terms = self.items.pop(docid)
+        except KeyError:
+            return
+        for term in terms:
+            pos = bisect.bisect_left(self.terms, term)
+            if pos < len(self.terms) and self.terms[pos] == term:
+                del self.terms[pos]
+
+    def search(self, term, limit=100):
+        """Return the items having a term beginning with the given one,
+        case-insensitively. An exact match of the whole term ranks before
+        a prefix match; an id, email or whole name before a name fragment.
+        Within the same rank, projects come before samples and users,
+        and the most recently modified first. Return at most limit items."""
+        term = term.strip().lower()
+        if not term or limit < 1: return []
+        hits = dict()                   # doc id -> best (exact, rank)
+        with self.lock:
+            pos = bisect.bisect_left(self.terms, (term,))
+            while pos < len(self.terms):
+                found, rank, docid = self.terms[pos]
+                if not found.startswith(term): break
+                score = (found != term, rank)
+                if docid not in hits or score < hits[docid]:
+                    hits[docid] = score
+                pos += 1
+            items = [(score, self.items[docid][0])
+                     for docid, score in hits.items()]
+        items.sort(key=lambda i: i[1]['modified'], reverse=True)
+        items.sort(key=lambda i: (i[0],
+                                  DOCTYPES.index(i[1][constants.DB_DOCTYPE])))
+        return [dict(item) for score, item in items[:limit]]
+
+    def get_stats(self):
+        "Return the statistics for the search index as a dictionary."
+        with self.lock:
+            return dict(enabled=self.enabled,
+                        items=len(self.items),
+                        terms=len(self.terms),
+                        changes=self.changes)
+
+
+index = SearchIndex()
+
+def start(db):
+    """Build the search index, unless settings['SEARCH_INDEX'] is false,
+    and start following the changes feed to keep it up to date."""
+    if not settings.get('SEARCH_INDEX', True): return
+    since = db.info()['update_seq']
+    start = time.monotonic()
+    index.load(db)
+    logging.info("search index built in %.1f s", time.monotonic() - start)
+    follower = ChangesFollower(index.changed, since=since, include_docs=True)
+    follower.start()
+    index.enabled = True
+    return follower
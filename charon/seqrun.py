@@ -18,14 +18,17 @@ from .sample import SampleSaver
 class SeqrunidField(IdField):
     "The unique identifier for the seqrun within the project."
 
+    unique_view = 'seqrun/seqrunid'
+    unique_parents = ('projectid', 'sampleid', 'libprepid')
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         if not constants.RID_RX.match(value):
             raise ValueError('invalid identifier value (disallowed characters)')
-        key = (saver.project['projectid'], saver.sample['sampleid'], saver.libprep['libprepid'], value)
-        view = saver.db.view('seqrun/seqrunid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value,
+                          dict(projectid=saver.project['projectid'],
+                               sampleid=saver.sample['sampleid'],
+                               libprepid=saver.libprep['libprepid']))
 
 
 
@@ -56,25 +59,73 @@ class SeqrunSaver(Saver):
         if self.is_new():
             assert libprep
             assert 'libprepid' not in self.doc
-            self.project = rqh.get_project(libprep['projectid'])
-            self.sample = rqh.get_sample(libprep['projectid'],
-                                         libprep['sampleid'])
-            self.libprep = libprep
             self.doc['projectid'] = libprep['projectid']
             self.doc['sampleid'] = libprep['sampleid']
             self.doc['libprepid'] = libprep['libprepid']
-        else:
-            self.project = rqh.get_project(self.doc['projectid'])
-            self.sample = rqh.get_sample(self.doc['projectid'],
-                                         self.doc['sampleid'])
-            if libprep:
-                assert (self.doc['libprepid'] == libprep['libprepid']) and \
-                    (self.doc['projectid'] == libprep['projectid'])
-                self.libprep = libprep
+        elif libprep:
+            assert (self.doc['libprepid'] == libprep['libprepid']) and \
+                (self.doc['projectid'] == libprep['projectid'])
+        self.libprep = libprep
+
+    async def setup(self):
+        "Get the project and sample, and the libprep unless given."
+        self.project = await self.rqh.get_project(self.doc['projectid'])
+        self.sample = await self.rqh.get_sample(self.doc['projectid'],
+                                                self.doc['sampleid'])
+        if self.libprep is None:
+            self.libprep = await self.rqh.get_libprep(self.doc['projectid'],
+                                                      self.doc['sampleid'],
+                                                      self.doc['libprepid'])
+
+
+class UpdateSampleCovMixin(object):
+    """Mixin providing a method to update the sample totals of coverage
+    and reads from its seqruns."""
+
+    async def update_sample_cov(self, projectid, sampleid):
+        """Set the sample total_autosomal_coverage and total_sequenced_reads
+        to the sums over its seqruns, excluding those with failed alignment.
+        To be called after each seqrun create, update and delete; any value
+        of those two fields set directly on the sample is overwritten.
+        The sums are obtained from the reduce view in one query, and only
+        those two fields are written, if changed. On a revision conflict,
+        the sample and the sums are read again, at most
+        constants.SAMPLE_COV_RETRIES times. The seqrun has been saved
+        already, so a failure is logged, not raised.
+        Return the sample, or None if it could not be updated."""
+        key = (projectid, sampleid)
+        for attempt in range(constants.SAMPLE_COV_RETRIES):
+            rows = await self.async_db.view('seqrun/sample_totals',
+                                            key=list(key),
+                                            group=True)
+            if rows:
+                totalcov, totalreads = rows[0].value
             else:
-                self.libprep = rqh.get_libprep(self.doc['projectid'],
-                                               self.doc['sampleid'],
-                                               self.doc['libprepid'])
+                totalcov, totalreads = 0.0, 0.0
+            try:
+                sample = await self.get_sample(projectid, sampleid)
+            except tornado.web.HTTPError as error:
+                reason = error.reason
+                break
+            if sample.get('total_autosomal_coverage') == totalcov and \
+               sample.get('total_sequenced_reads') == totalreads:
+                return sample
+            try:
+                async with SampleSaver(doc=sample, rqh=self) as saver:
+                    saver['total_autosomal_coverage'] = totalcov
+                    saver['total_sequenced_reads'] = totalreads
+            except ValueError as msg:
+                reason = str(msg)
+                break
+            except IOError as msg:
+                reason = str(msg)
+                # Re-read the sample, not the one saved in this request.
+                self._samples.pop(key, None)
+            else:
+                return sample
+        logging.warning("could not update totals of sample %s %s: %s",
+                        projectid, sampleid, reason)
+        return None
 
 
 class Seqrun(RequestHandler):
@@ -83,12 +134,12 @@ class Seqrun(RequestHandler):
     saver = SeqrunSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid, libprepid, seqrunid):
-        project = self.get_project(projectid)
-        sample = self.get_sample(projectid, sampleid)
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
-        logs = self.get_logs(seqrun['_id']) # XXX limit?
+    async def get(self, projectid, sampleid, libprepid, seqrunid):
+        project = await self.get_project(projectid)
+        sample = await self.get_sample(projectid, sampleid)
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
+        seqrun = await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        logs = await self.get_logs(seqrun['_id']) # XXX limit?
         self.render('seqrun.html',
                     project=project,
                     sample=sample,
@@ -98,24 +149,24 @@ class Seqrun(RequestHandler):
                     logs=logs)
 
 
-class SeqrunCreate(RequestHandler):
+class SeqrunCreate(UpdateSampleCovMixin, RequestHandler):
     "Create a seqrun within a libprep."
 
     saver = SeqrunSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid, libprepid):
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+    async def get(self, projectid, sampleid, libprepid):
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         self.render('seqrun_create.html',
                     libprep=libprep,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid, sampleid, libprepid):
+    async def post(self, projectid, sampleid, libprepid):
         self.check_xsrf_cookie()
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         try:
-            with self.saver(rqh=self, libprep=libprep) as saver:
+            async with self.saver(rqh=self, libprep=libprep) as saver:
                 saver.store()
                 seqrun = saver.doc
         except (IOError, ValueError) as msg:
@@ -124,6 +175,7 @@ class SeqrunCreate(RequestHandler):
                         fields=self.saver.fields,
                         error=str(msg))
         else:
+            await self.update_sample_cov(projectid, sampleid)
             url = self.reverse_url('seqrun',
                                    projectid,
                                    sampleid,
@@ -132,24 +184,24 @@ class SeqrunCreate(RequestHandler):
             self.redirect(url)
 
 
-class SeqrunEdit(RequestHandler):
+class SeqrunEdit(UpdateSampleCovMixin, RequestHandler):
     "Edit an existing seqrun."
 
     saver = SeqrunSaver
 
     @tornado.web.authenticated
-    def get(self, projectid, sampleid, libprepid, seqrunid):
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+    async def get(self, projectid, sampleid, libprepid, seqrunid):
+        seqrun = await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         self.render('seqrun_edit.html',
                     seqrun=seqrun,
                     fields=self.saver.fields)
 
     @tornado.web.authenticated
-    def post(self, projectid, sampleid, libprepid, seqrunid):
+    async def post(self, projectid, sampleid, libprepid, seqrunid):
         self.check_xsrf_cookie()
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        seqrun = await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         try:
-            with self.saver(doc=seqrun, rqh=self) as saver:
+            async with self.saver(doc=seqrun, rqh=self) as saver:
                 saver.store()
         except (IOError, ValueError) as msg:
             self.render('seqrun_edit.html',
@@ -157,112 +209,78 @@ class SeqrunEdit(RequestHandler):
                         fields=self.saver.fields,
                         error=str(msg))
         else:
+            await self.update_sample_cov(projectid, sampleid)
             url = self.reverse_url('seqrun', projectid, sampleid, libprepid, seqrunid)
             self.redirect(url)
 
 
-class ApiSeqrun(ApiRequestHandler):
+class ApiSeqrun(UpdateSampleCovMixin, ApiRequestHandler):
     "Access a seqrun in a libprep."
 
     saver = SeqrunSaver
 
-    def get(self, projectid, sampleid, libprepid, seqrunid):
+    async def get(self, projectid, sampleid, libprepid, seqrunid):
         """Return the seqrun data.
         Return HTTP 404 if no such seqrun, libprep, sample or project."""
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        seqrun = await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         if not seqrun: return
         self.add_seqrun_links(seqrun)
         self.write(seqrun)
 
-    def put(self, projectid, sampleid, libprepid, seqrunid):
+    async def put(self, projectid, sampleid, libprepid, seqrunid):
         """Update the seqrun data.
         Return HTTP 204 "No Content".
         Return HTTP 404 if no such seqrun, libprep, sample or project.
         Return HTTP 400 if any problem with a value."""
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        seqrun = await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         try:
             data = json.loads(self.request.body)
         except Exception as msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=seqrun, rqh=self) as saver:
+                async with self.saver(doc=seqrun, rqh=self) as saver:
                     saver.store(data=data)
             except ValueError as msg:
                 self.send_error(400, reason=str(msg))
             except IOError as msg:
                 self.send_error(409, reason=str(msg))
             else:
+                await self.update_sample_cov(projectid, sampleid)
                 self.set_status(204)
 
-    def delete(self, projectid, sampleid, libprepid, seqrunid):
+    async def delete(self, projectid, sampleid, libprepid, seqrunid):
         """NOTE: This is for unit test purposes only!
         Delete the libprepand all of its dependent entities.
         Returns HTTP 204 "No Content"."""
-        seqrun= self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        seqrun= await self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         if not seqrun: return
         utils.delete_seqrun(self.db, seqrun)
+        await self.update_sample_cov(projectid, sampleid)
         logging.debug("deleted seqrun {0}, {1}, {2}",
                       projectid, sampleid, libprepid, seqrunid)
         self.set_status(204)
 
 
-    def update_sample_cov(self, projectid, sampleid):
-        """this calculates the total of each mean autosomalcoverage and updates sample level.
-        This should be done every time a seqrun is updated/created
-        This also updated total_sequenced_reads"""
-        try:
-            seqruns = self.get_seqruns(projectid, sampleid)
-            totalcov=0
-            totalreads=0
-            for seqrun in seqruns:
-                if seqrun['alignment_status'] != constants.SEQRUN_ANALYSIS_STATUS['FAILED']:
-                    if seqrun.get('mean_autosomal_coverage'):
-                        totalcov+=float(seqrun['mean_autosomal_coverage'])
-                    if seqrun.get('total_reads'):
-                        totalreads+=float(seqrun['total_reads'])
-
-            doc= self.get_sample(projectid, sampleid)
-
-            doc['total_autosomal_coverage']=totalcov
-            doc['total_sequenced_reads']=totalreads
-            logging.info(doc)
-        except Exception as msg:
-            self.send_error(400, reason=str("Failed to update total_autosomal_coverage and total_sequenced_reads. Check that the reads field and the mean_autosomal_coverage field are not set to None"+msg))
-        except IOError as msg:
-            self.send_error(409, reason=str(msg))
-        else:
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError as msg:
-                self.send_error(400, reason=str("failed to update sample "+msg))
-            except IOError as msg:
-                self.send_error(409, reason=str(msg))
-            else:
-                self.set_status(204)
-
-
-
-class ApiSeqrunCreate(ApiRequestHandler):
+class ApiSeqrunCreate(UpdateSampleCovMixin, ApiRequestHandler):
     "Create a seqrun within a libprep."
 
     saver = SeqrunSaver
 
-    def post(self, projectid, sampleid, libprepid):
+    async def post(self, projectid, sampleid, libprepid):
         """Create a seqrun within a libprep.
         Return HTTP 201, seqrun URL in header "Location", and seqrun data.
         Return HTTP 400 if something is wrong with the values.
         Return HTTP 404 if no such project, sample or libprep.
         Return HTTP 409 if there is a document revision conflict."""
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+        libprep = await self.get_libprep(projectid, sampleid, libprepid)
         try:
             data = json.loads(self.request.body)
         except Exception as msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(rqh=self, libprep=libprep) as saver:
+                async with self.saver(rqh=self, libprep=libprep) as saver:
                     saver.store(data=data)
                     seqrun = saver.doc
             except ValueError as msg:
@@ -270,6 +288,7 @@ class ApiSeqrunCreate(ApiRequestHandler):
             except IOError as msg:
                 raise tornado.web.HTTPError(409, reason=str(msg))
             else:
+                await self.update_sample_cov(projectid, sampleid)
                 url = self.reverse_url('api_seqrun',
                                        projectid,
                                        sampleid,
@@ -280,60 +299,28 @@ class ApiSeqrunCreate(ApiRequestHandler):
                 self.add_seqrun_links(seqrun)
                 self.write(seqrun)
 
-    def update_sample_cov(self, projectid, sampleid):
-        """this calculates the total of each mean autosomal coverage and updates sample leve.
-        This should be done every time a seqrun is updated/created"""
-        logging.debug('Updating total_sequenced_reads and total_autosomal_coverage of sample {0}'.format(sampleid))
-        try:
-            seqruns = self.get_seqruns(projectid, sampleid)
-            totalcov=0
-            totalreads=0
-            for seqrun in seqruns:
-                if seqrun['alignment_status'] != constants.SEQRUN_ANALYSIS_STATUS['FAILED']:
-                    if seqrun['mean_autosomal_coverage']:
-                        totalcov+=float(seqrun['mean_autosomal_coverage'])
-                    if seqrun['total_reads']:
-                        totalreads+=float(seqrun['total_reads'])
-
-            doc= self.get_sample(projectid, sampleid)
-
-            doc['total_autosomal_coverage']=totalcov
-            doc['total_sequenced_reads']=totalreads
-        except Exception as msg:
-            self.send_error(400, reason=str(msg))
-        except IOError as msg:
-            self.send_error(409, reason=str(msg))
-        else:
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError as msg:
-                self.send_error(400, reason=str("Failed to update total_autosomal_coverage and total_sequenced_reads. Check that the reads field and the mean_autosomal_coverage field are not set to None"+msg))
-            except IOError as msg:
-                self.send_error(409, reason=str(msg))
-            else:
-                self.set_status(201)
-
-
-
 
 class ApiProjectSeqruns(ApiRequestHandler):
     "Access to all seqruns for a project."
 
-    def get(self, projectid):
-        "Return list of all seqruns for the given project."
-        seqruns = self.get_seqruns(projectid)
-        for seqrun in seqruns:
-            self.add_seqrun_links(seqrun)
-        self.write(dict(seqruns=seqruns))
+    async def get(self, projectid):
+        """Return list of all seqruns for the given project.
+        The seqruns are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'.
+        One page of seqruns if the query argument 'limit' or 'cursor'
+        is given, with the cursor and link for the next page."""
+        await self.write_page('seqrun/seqrunid',
+                              self.get_seqruns_range(projectid),
+                              key='seqruns',
+                              add_links=self.add_seqrun_links)
 
 
 class ApiSampleSeqruns(ApiRequestHandler):
     "Access to all seqruns for a sample."
 
-    def get(self, projectid, sampleid):
+    async def get(self, projectid, sampleid):
         "Return list of all seqruns for the given sample and project."
-        seqruns = self.get_seqruns(projectid, sampleid)
+        seqruns = await self.get_seqruns(projectid, sampleid)
         for seqrun in seqruns:
             self.add_seqrun_links(seqrun)
         self.write(dict(seqruns=seqruns))
@@ -342,9 +329,9 @@ class ApiSampleSeqruns(ApiRequestHandler):
 class ApiLibprepSeqruns(ApiRequestHandler):
     "Access to all seqruns for a libprep."
 
-    def get(self, projectid, sampleid, libprepid):
+    async def get(self, projectid, sampleid, libprepid):
         "Return list of all seqruns for the given libprep, sample and project."
-        seqruns = self.get_seqruns(projectid, sampleid, libprepid)
+        seqruns = await self.get_seqruns(projectid, sampleid, libprepid)
         for seqrun in seqruns:
             self.add_seqrun_links(seqrun)
         self.write(dict(seqruns=seqruns))
@@ -352,11 +339,10 @@ class ApiLibprepSeqruns(ApiRequestHandler):
 class ApiSeqrunsDone(ApiRequestHandler):
     "Accesses all seqruns either failed or analyzed"
 
-    def get(self):
-        seqruns=self.get_seqruns()
-        filtered_seqr=[]
-        for s in seqruns:
-            if s.get('alignment_status') in constants.EXTENDED_STATUS[2:3]:
-                filtered_seqr.append(s)
-
-        self.write(json.dumps(filtered_seqr))
+    async def get(self):
+        """Return the list of seqruns having alignment status 'DONE'.
+        The seqruns are streamed; as NDJSON if the 'Accept' header
+        is 'application/x-ndjson' or the query argument 'format=ndjson'."""
+        seqruns = (s async for s in self.iter_seqruns()
+                   if s.get('alignment_status') in constants.EXTENDED_STATUS[2:3])
+        await self.write_stream(seqruns)
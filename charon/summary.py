@@ -0,0 +1,274 @@
+" Charon: Sample summary counters, kept up to date from the changes feed. "
+
+import logging
+import threading
+import time
+
+import couchdb
+
+from . import constants
+from . import settings
+from .changes import ChangesFollower
+
+
+CHECKPOINT_ID = '_local/charon_summary'
+
+
+def get_number(value):
+    "Return the value as a float; zero if undefined or not a number."
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Summary(object):
+    """Counters of samples, in total and per project, held in memory.
+    The contribution of each sample, seqrun and project document is
+    recorded, so that a changed or deleted document is first subtracted
+    and then added in its new state; applying a change twice is harmless.
+    The contributions are computed from the views at start. Only the
+    counters are checkpointed, to a local document, so that they can
+    be served while the contributions are being computed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.db = None                  # For checkpointing.
+        self.seq = 0
+        self.rev = None                 # Revision of the checkpoint document.
+        self.checkpointed = 0.0
+        self.changes = 0
+        self.samples = dict()   # doc id -> [projectid, analysis_status, cov]
+        self.seqruns = dict()   # doc id -> [projectid, sampleid]
+        self.projects = dict()  # doc id -> [projectid, delivery_projects]
+        self.counts = dict()    # projectid, or None for all -> counters
+        self.sequenced = dict() # (projectid, sampleid) -> number of seqruns
+        self.delivery_projects = dict() # projectid -> delivery_projects
+
+    def restore(self, db):
+        """Set the counters from the checkpoint document, if any.
+        Return True if there was one."""
+        try:
+            doc = db[CHECKPOINT_ID]
+        except couchdb.http.ResourceNotFound:
+            return False
+        with self.lock:
+            self.rev = doc['_rev']
+            self.counts = dict([(projectid, counts)
+                                for projectid, counts in doc['counts']])
+            self.delivery_projects = doc['delivery_projects']
+        return True
+
+    def load(self, db):
+        """Compute the contributions and counters from the views, and
+        replace the current state by them. Set the update sequence
+        from which to follow the changes feed."""
+        fresh = Summary()
+        fresh.seq = db.info()['update_seq']
+        for row in db.iterview('sample/sampleid', 1000, include_docs=True):
+            fresh.add(row.doc)
+        for row in db.iterview('seqrun/seqrunid', 1000):
+            fresh.add_seqrun(row.id, row.key[0], row.key[1])
+        for row in db.iterview('project/projectid', 1000,
+                               include_docs=True):
+            fresh.add(row.doc)
+        with self.lock:
+            for key in ('seq', 'samples', 'seqruns', 'projects', 'counts',
+                        'sequenced', 'delivery_projects'):
+                setattr(self, key, getattr(fresh, key))
+            self.checkpointed = time.monotonic()
+
+    def checkpoint(self, db):
+        """Save the counters and the sequence of the last change applied;
+        the sequence tells how current the counters are, for inspection.
+        If another process has saved the document meanwhile, overwrite it;
+        the counters of either are equally valid."""
+        with self.lock:
+            doc = dict(_id=CHECKPOINT_ID,
+                       seq=self.seq,
+                       counts=[[projectid, counts.copy()]
+                               for projectid, counts in self.counts.items()],
+                       delivery_projects=self.delivery_projects.copy())
+            self.checkpointed = time.monotonic()
+        for attempt in range(2):
+            if self.rev:
+                doc['_rev'] = self.rev
+            try:
+                db.save(doc)
+            except couchdb.http.ResourceConflict:
+                self.rev = db[CHECKPOINT_ID]['_rev']
+            else:
+                self.rev = doc['_rev']
+                return
+        logging.warning("could not checkpoint summary: revision conflict")
+
+    def changed(self, change):
+        """Callback for the changes feed, which must include the docs.
+        Apply the change, and checkpoint if it is time to do so."""
+        with self.lock:
+            self.remove(change['id'])
+            if not change.get('deleted'):
+                self.add(change['doc'])
+            self.seq = change['seq']
+            self.changes += 1
+            interval = settings.get('SUMMARY_CHECKPOINT_SECONDS', 60)
+            due = time.monotonic() - self.checkpointed >= interval
+        if due and self.db is not None:
+            try:
+                self.checkpoint(self.db)
+            except couchdb.http.HTTPError as msg:
+                logging.warning("could not checkpoint summary: %s", msg)
+
+    def add(self, doc):
+        "Add the contribution of the document, if any."
+        doctype = doc.get(constants.DB_DOCTYPE)
+        if doctype == constants.SAMPLE:
+            self.add_sample(doc['_id'],
+                            doc.get('projectid'),
+                            doc.get('analysis_status'),
+                            get_number(doc.get('total_autosomal_coverage')))
+        elif doctype == constants.SEQRUN:
+            self.add_seqrun(doc['_id'], doc.get('projectid'),
+                            doc.get('sampleid'))
+        elif doctype == constants.PROJECT:
+            self.add_project(doc['_id'], doc.get('projectid'),
+                             doc.get('delivery_projects') or [])
+
+    def add_sample(self, docid, projectid, analysis_status, cov):
+        "Add the sample to the counters."
+        self.samples[docid] = [projectid, analysis_status, cov]
+        self.update_counts(projectid, analysis_status, cov, 1)
+
+    def add_seqrun(self, docid, projectid, sampleid):
+        "Count the sample as sequenced, if this is its first seqrun."
+        self.seqruns[docid] = [projectid, sampleid]
+        key = (projectid, sampleid)
+        count = self.sequenced.get(key, 0)
+        self.sequenced[key] = count + 1
+        if count == 0:
+            self.get_counts(projectid)['seq'] += 1
+            self.get_counts(None)['seq'] += 1
+
+    def add_project(self, docid, projectid, delivery_projects):
+        "Record the delivery projects of the project."
+        self.projects[docid] = [projectid, delivery_projects]
+        self.delivery_projects[projectid] = delivery_projects
+
+    def remove(self, docid):
+        "Subtract the contribution of the document, if any."
+        try:
+            projectid, analysis_status, cov = self.samples.pop(docid)
+        except KeyError:
+            pass
+        else:
+            self.update_counts(projectid, analysis_status, cov, -1)
+            return
+        try:
+            projectid, sampleid = self.seqruns.pop(docid)
+        except KeyError:
+            pass
+        else:
+            key = (projectid, sampleid)
+            self.sequenced[key] -= 1
+            if self.sequenced[key] == 0:
+                del self.sequenced[key]
+                self.get_counts(projectid)['seq'] -= 1
+                self.get_counts(None)['seq'] -= 1
+            return
+        try:
+            projectid, delivery_projects = self.projects.pop(docid)
+        except KeyError:
+            pass
+        else:
+            self.delivery_projects.pop(projectid, None)
+
+    def get_counts(self, projectid):
+        "Get the counters for the project, or for all if None."
+        try:
+            return self.counts[projectid]
+        except KeyError:
+            counts = self.counts[projectid] = dict(tot=0, passed=0, failed=0,
+                                                   runn=0, seq=0, cov=0.0)
+            return counts
+
+    def update_counts(self, projectid, analysis_status, cov, sign):
+        "Add (sign 1) or subtract (sign -1) a sample from the counters."
+        key = dict(ANALYZED='passed',
+                   FAILED='failed',
+                   UNDER_ANALYSIS='runn').get(analysis_status)
+        for counts in [self.get_counts(projectid), self.get_counts(None)]:
+            counts['tot'] += sign
+            counts['cov'] += sign * cov
+            if key:
+                counts[key] += sign
+
+    def get(self, projectid=None):
+        """Return the summary for the project, or for all if None,
+        in the same form as the data computed from the views."""
+        with self.lock:
+            counts = self.counts.get(projectid) or dict(tot=0, passed=0,
+                                                        failed=0, runn=0,
+                                                        seq=0, cov=0.0)
+            data = dict(tot=counts['tot'],
+                        ab=0,
+                        passed=counts['passed'],
+                        passed_unab=0,
+                        failed=counts['failed'],
+                        ana=counts['passed'] + counts['failed'],
+                        runn=counts['runn'],
+                        seq=counts['seq'],
+                        cov=round(counts['cov'], 6))
+            data['hge'] = int(data['cov'] / 30)
+            data['gdp'] = list(self.delivery_projects.get(projectid) or [])
+        return data
+
+    def get_stats(self):
+        "Return the statistics for the summary service as a dictionary."
+        with self.lock:
+            return dict(enabled=self.enabled,
+                        seq=self.seq,
+                        changes=self.changes,
+                        samples=len(self.samples),
+                        seqruns=len(self.seqruns),
+                        projects=len(self.projects))
+
+
+
+service = Summary()
+
+def start(db):
+    """Serve the summary counters from the checkpoint, if any, while they
+    are computed from the views in a background thread, which then follows
+    the changes feed to keep them up to date. They are checkpointed at most
+    every settings['SUMMARY_CHECKPOINT_SECONDS'] seconds; 0 disables the
+    service. Return the thread.
+    NOTE: Every start scans all samples, seqruns and projects, since the
+    feed cannot be resumed from the 'seq' of the checkpoint: a change is
+    applied by subtracting the previous contribution of the document,
+    and the contributions are not checkpointed, to bound its size.
+    Without a checkpoint, the start waits for the scan."""
+    if settings.get('SUMMARY_CHECKPOINT_SECONDS', 60) == 0: return
+    service.db = db
+    if service.restore(db):
+        service.enabled = True
+    loaded = threading.Event()
+    thread = threading.Thread(target=run, args=(db, loaded),
+                              name='Summary', daemon=True)
+    thread.start()
+    if not service.enabled:
+        loaded.wait()
+    return thread
+
+def run(db, loaded):
+    """Compute the summary counters, set the event, and then follow
+    the changes feed."""
+    start = time.monotonic()
+    service.load(db)
+    service.checkpoint(db)
+    logging.info("summary loaded in %.1f s", time.monotonic() - start)
+    service.enabled = True
+    loaded.set()
+    follower = ChangesFollower(service.changed, since=service.seq,
+                               include_docs=True)
+    follower.run()
@@ -0,0 +1,117 @@
+""" Charon: nosetests /api/v1/bulk
+Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
+"""
+
+import os
+import json
+import requests
+import nose
+
+def url(*segments):
+    "Synthesize absolute URL from path segments."
+    return "{0}api/v1/{1}".format(BASE_URL,'/'.join([str(s) for s in segments]))
+
+API_TOKEN = os.getenv('CHARON_API_TOKEN')
+if not API_TOKEN: raise ValueError('no API token')
+BASE_URL = os.getenv('CHARON_BASE_URL')
+if not BASE_URL: raise ValueError('no base URL')
+
+PROJECTID = 'P0'
+SAMPLEID = 'S1'
+LIBPREPID = 'A'
+SEQRUNID = '140101_ST-E00000_0001_AH00000ALXX'
+
+api_token = {'X-Charon-API-token': API_TOKEN}
+session = requests.Session()
+
+
+def my_teardown():
+    "Delete the project and all its dependents."
+    session.delete(url('project', PROJECTID), headers=api_token)
+
+@nose.with_setup(None, my_teardown)
+def test_bulk_create():
+    "Create a project, sample, libprep and seqrun in one call."
+    items = [dict(action='create', entity='project',
+                  data=dict(projectid=PROJECTID)),
+             dict(action='create', entity='sample', projectid=PROJECTID,
+                  data=dict(sampleid=SAMPLEID)),
+             dict(action='create', entity='libprep', projectid=PROJECTID,
+                  sampleid=SAMPLEID,
+                  data=dict(libprepid=LIBPREPID)),
+             dict(action='create', entity='seqrun', projectid=PROJECTID,
+                  sampleid=SAMPLEID, libprepid=LIBPREPID,
+                  data=dict(seqrunid=SEQRUNID, total_reads=1000))]
+    response = session.post(url('bulk'),
+                            data=json.dumps(dict(items=items)),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    results = response.json()['results']
+    assert len(results) == len(items)
+    for result in results:
+        assert result['status'] == 201, result
+    response = session.get(url('seqrun', PROJECTID, SAMPLEID,
+                               LIBPREPID, SEQRUNID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    seqrun = response.json()
+    assert seqrun['total_reads'] == 1000
+    response = session.get(url('logs', seqrun['_id']), headers=api_token)
+    assert response.status_code == 200, response
+    assert len(response.json()['logs']) == 1
+
+@nose.with_setup(None, my_teardown)
+def test_bulk_update():
+    "Update a sample created in the same call; one invalid item."
+    items = [dict(action='create', entity='project',
+                  data=dict(projectid=PROJECTID)),
+             dict(action='create', entity='sample', projectid=PROJECTID,
+                  data=dict(sampleid=SAMPLEID)),
+             dict(action='update', entity='sample', projectid=PROJECTID,
+                  sampleid=SAMPLEID,
+                  data=dict(analysis_status='UNDER_ANALYSIS')),
+             dict(action='update', entity='sample', projectid=PROJECTID,
+                  sampleid=SAMPLEID,
+                  data=dict(analysis_status='no such status'))]
+    response = session.post(url('bulk'),
+                            data=json.dumps(dict(items=items)),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    results = response.json()['results']
+    assert [r['status'] for r in results] == [201, 201, 200, 400], results
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    assert response.json()['analysis_status'] == 'UNDER_ANALYSIS'
+
+@nose.with_setup(None, my_teardown)
+def test_bulk_invalid():
+    "Items referring to non-existent or duplicate entities."
+    items = [dict(action='create', entity='sample', projectid=PROJECTID,
+                  data=dict(sampleid=SAMPLEID)),
+             dict(action='create', entity='project',
+                  data=dict(projectid=PROJECTID)),
+             dict(action='create', entity='project',
+                  data=dict(projectid=PROJECTID)),
+             dict(action='delete', entity='project', projectid=PROJECTID)]
+    response = session.post(url('bulk'),
+                            data=json.dumps(dict(items=items)),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    results = response.json()['results']
+    assert [r['status'] for r in results] == [404, 201, 400, 400], results
+    items = [dict(action='create', entity='sample', projectid=PROJECTID,
+                  data=dict(sampleid=SAMPLEID)),
+             dict(action='create', entity='project',
+                  data=dict(projectid=PROJECTID))]
+    for expected in ([201, 400], [400, 400]):
+        response = session.post(url('bulk'),
+                                data=json.dumps(dict(items=items)),
+                                headers=api_token)
+        assert response.status_code == 200, response
+        results = response.json()['results']
+        assert [r['status'] for r in results] == expected, results
+    response = session.post(url('bulk'),
+                            data=json.dumps(dict(data=items)),
+                            headers=api_token)
+    assert response.status_code == 400, response
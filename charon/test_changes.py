@@ -0,0 +1,110 @@
+""" Charon: nosetests /api/v1/changes
+Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
+"""
+
+import os
+import json
+import requests
+import nose
+
+def url(*segments):
+    "Synthesize absolute URL from path segments."
+    return "{0}api/v1/{1}".format(BASE_URL,'/'.join([str(s) for s in segments]))
+
+API_TOKEN = os.getenv('CHARON_API_TOKEN')
+if not API_TOKEN: raise ValueError('no API token')
+BASE_URL = os.getenv('CHARON_BASE_URL')
+if not BASE_URL: raise ValueError('no base URL')
+
+PROJECTID = 'P0'
+SAMPLEID = 'S1'
+
+api_token = {'X-Charon-API-token': API_TOKEN}
+session = requests.Session()
+
+
+def my_setup():
+    "Create the project to work with changes."
+    data = dict(projectid=PROJECTID)
+    session.post(url('project'), data=json.dumps(data), headers=api_token)
+
+def my_teardown():
+    "Delete the project and all its dependents."
+    session.delete(url('project', PROJECTID), headers=api_token)
+
+def get_changes(**params):
+    "Get the changes, following the token until there are no more."
+    changes = []
+    while True:
+        response = session.get(url('changes'), params=params,
+                               headers=api_token)
+        assert response.status_code == 200, response
+        data = response.json()
+        changes.extend(data['changes'])
+        params['since'] = data['since']
+        if not data['changes']: return changes, data['since']
+
+@nose.with_setup(my_setup, my_teardown)
+def test_changes():
+    "Get the changes since a token, and only of the given doctype."
+    changes, since = get_changes(limit=1000)
+    assert not [c for c in changes
+                if c.get('doc', {}).get('charon_doctype') == 'log']
+    data = dict(sampleid=SAMPLEID)
+    response = session.post(url('sample', PROJECTID),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    changes, since = get_changes(since=since)
+    assert [c['doc']['sampleid'] for c in changes] == [SAMPLEID]
+    changes, since = get_changes(since=since)
+    assert not changes
+    data = dict(name='changed')
+    response = session.put(url('project', PROJECTID),
+                           data=json.dumps(data),
+                           headers=api_token)
+    assert response.status_code == 204, response
+    changes, since = get_changes(since=since, doctype='sample')
+    assert not changes
+    response = session.get(url('changes'),
+                           params=dict(since=since, feed='longpoll',
+                                       timeout=0.1),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    assert response.json()['changes'] == []
+    response = session.get(url('changes'), params=dict(doctype='log'),
+                           headers=api_token)
+    assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_changes_deleted():
+    "Get the deletion of an entity, without those of its log entries."
+    changes, since = get_changes(limit=1000)
+    data = dict(sampleid=SAMPLEID)
+    response = session.post(url('sample', PROJECTID),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    changes, since = get_changes(since=since, doctype='sample')
+    sampleids = [c['id'] for c in changes]
+    assert len(sampleids) == 1
+    response = session.delete(url('sample', PROJECTID, SAMPLEID),
+                              headers=api_token)
+    assert response.status_code == 204, response
+    changes, _ = get_changes(since=since)
+    assert [c['id'] for c in changes] == sampleids
+    assert changes[0]['deleted']
+    changes, _ = get_changes(since=since, doctype='project')
+    assert not changes
+
+def test_changes_invalid():
+    "Get HTTP 400 for an invalid token, or an invalid timeout."
+    for since in ('x', 'WzFd', 'dHJ1ZQ=='):  # Not a token; [1]; true.
+        response = session.get(url('changes'), params=dict(since=since),
+                               headers=api_token)
+        assert response.status_code == 400, response
+    for timeout in ('-1', 'nan', 'x'):
+        response = session.get(url('changes'),
+                               params=dict(feed='longpoll', timeout=timeout),
+                               headers=api_token)
+        assert response.status_code == 400, response
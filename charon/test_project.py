@@ -4,6 +4,7 @@ Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
 
 import os
 import json
+import time
 import requests
 
 def url(*segments):
@@ -114,6 +115,57 @@ def test_project_modify_status_field():
                            headers=api_token)
     assert response.status_code == 400, response
 
+def test_project_summary():
+    "Get the sample summary for a project, and for all projects."
+    for params in [dict(projectid=PROJECTID), dict()]:
+        response = session.get(url('summary'), params=params,
+                               headers=api_token)
+        assert response.status_code == 200, response
+        data = response.json()
+        for key in ['tot', 'passed', 'failed', 'runn', 'seq', 'cov', 'hge']:
+            assert key in data, key
+
+def get_summary(projectid, **expected):
+    """Get the sample summary for the project, waiting for the summary
+    to have the expected values, since it is updated asynchronously."""
+    for attempt in range(50):
+        response = session.get(url('summary'), params=dict(projectid=projectid),
+                               headers=api_token)
+        assert response.status_code == 200, response
+        data = response.json()
+        if all([data[k] == v for k, v in expected.items()]): return data
+        time.sleep(0.1)
+    raise AssertionError("summary {0} is not {1}".format(data, expected))
+
+def test_project_summary_counts():
+    "Check the sample summary counts after sample create, update, delete."
+    projectid = PROJECTID + '_SUMMARY'
+    session.delete(url('project', projectid), headers=api_token)
+    response = session.post(url('project'),
+                            data=json.dumps(dict(projectid=projectid)),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    try:
+        for sampleid in ['S1', 'S2']:
+            data = dict(sampleid=sampleid, total_autosomal_coverage=15.0)
+            response = session.post(url('sample', projectid),
+                                    data=json.dumps(data),
+                                    headers=api_token)
+            assert response.status_code == 201, response
+        get_summary(projectid, tot=2, passed=0, cov=30.0)
+        data = dict(analysis_status='ANALYZED')
+        response = session.put(url('sample', projectid, 'S1'),
+                               data=json.dumps(data),
+                               headers=api_token)
+        assert response.status_code == 204, response
+        get_summary(projectid, tot=2, passed=1, ana=1)
+        response = session.delete(url('sample', projectid, 'S1'),
+                                  headers=api_token)
+        assert response.status_code == 204, response
+        get_summary(projectid, tot=1, passed=0, cov=15.0)
+    finally:
+        session.delete(url('project', projectid), headers=api_token)
+
 def test_project_delete():
     "Delete a project."
     response = session.delete(url('project', PROJECTID), headers=api_token)
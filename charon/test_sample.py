@@ -107,3 +107,165 @@ def test_sample_create_collision():
                             data=json.dumps(data),
                             headers=api_token)
     assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_list():
+    "Create samples, and get them as JSON and as NDJSON."
+    for sampleid in (SAMPLEID, SAMPLEID + '_2'):
+        data = dict(sampleid=sampleid)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    response = session.get(url('samples', PROJECTID), headers=api_token)
+    assert response.status_code == 200, response
+    samples = response.json()['samples']
+    assert [s['sampleid'] for s in samples] == [SAMPLEID, SAMPLEID + '_2']
+    headers = {'Accept': 'application/x-ndjson'}
+    headers.update(api_token)
+    response = session.get(url('samples', PROJECTID), headers=headers)
+    assert response.status_code == 200, response
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    samples = [json.loads(line) for line in response.text.splitlines()]
+    assert [s['sampleid'] for s in samples] == [SAMPLEID, SAMPLEID + '_2']
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_by_status():
+    "Create samples with different status, and get those having one."
+    for sampleid, status in ((SAMPLEID, 'FRESH'), (SAMPLEID + '_2', 'STALE')):
+        data = dict(sampleid=sampleid, status=status)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    response = session.get(url('samples', PROJECTID),
+                           params=dict(status='STALE'),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    samples = response.json()['samples']
+    assert [s['sampleid'] for s in samples] == [SAMPLEID + '_2']
+    response = session.get(url('samplesnotdone', PROJECTID), headers=api_token)
+    assert response.status_code == 200, response
+    samples = response.json()['samples']
+    assert len(samples) == 2
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_by_analysis_status():
+    "Create samples with different analysis status, and get them by status."
+    for sampleid, status in ((SAMPLEID, 'ANALYZED'),
+                             (SAMPLEID + '_2', 'FAILED'),
+                             (SAMPLEID + '_3', 'UNDER_ANALYSIS')):
+        data = dict(sampleid=sampleid, analysis_status=status)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    for path, sampleids in (('samplesrunning', [SAMPLEID + '_3']),
+                            ('samplesfailed', [SAMPLEID + '_2']),
+                            ('samplesdonefailed', [SAMPLEID, SAMPLEID + '_2'])):
+        response = session.get(url(path), params=dict(projectid=PROJECTID),
+                               headers=api_token)
+        assert response.status_code == 200, response
+        assert [s['sampleid'] for s in response.json()] == sampleids
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_custom_query():
+    "Create samples, and get those matching a filter, and a legacy query."
+    for sampleid, status, reads in ((SAMPLEID, 'ANALYZED', 10.0),
+                                    (SAMPLEID + '_2', 'FAILED', 20.0),
+                                    (SAMPLEID + '_3', 'ANALYZED', 30.0)):
+        data = dict(sampleid=sampleid, analysis_status=status,
+                    total_sequenced_reads=reads)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    data = dict(projectid=PROJECTID,
+                filter={'and': [{'field': 'analysis_status', 'op': '==',
+                                 'value': 'ANALYZED'},
+                                {'field': 'total_sequenced_reads',
+                                 'op': 'range', 'value': [20, None]}]})
+    response = session.post(url('customquery'), data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    samples = response.json()['samples']
+    assert [s['sampleid'] for s in samples] == [SAMPLEID + '_3']
+    data = dict(projectid=PROJECTID, sampleField='total_sequenced_reads',
+                operator='<', value='25', type='float')
+    response = session.post(url('customquery'), data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    samples = response.json()['samples']
+    assert [s['sampleid'] for s in samples] == [SAMPLEID, SAMPLEID + '_2']
+    for data in (dict(projectid=PROJECTID,
+                      filter={'field': 'x', 'op': 'like'}),
+                 dict(projectid=PROJECTID,
+                      filter={'field': 'x', 'op': ['==']}),
+                 dict(projectid=PROJECTID,
+                      filter={'field': 'x', 'op': 'in', 'value': [[1]]}),
+                 dict(projectid=PROJECTID, sampleField='x',
+                      operator='==', value=None, type='int')):
+        response = session.post(url('customquery'), data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_sample_search():
+    "Create samples, and search for them across projects, page by page."
+    for sampleid, status, coverage in ((SAMPLEID, 'ANALYZED', 10.0),
+                                       (SAMPLEID + '_2', 'ANALYZED', 40.0),
+                                       (SAMPLEID + '_3', 'ANALYZED', 50.0),
+                                       (SAMPLEID + '_4', 'FAILED', 60.0)):
+        data = dict(sampleid=sampleid, analysis_status=status,
+                    total_autosomal_coverage=coverage)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    params = dict(analysis_status='ANALYZED', min_coverage=30, limit=1)
+    sampleids = []
+    while True:
+        response = session.get(url('samplesearch'), params=params,
+                               headers=api_token)
+        assert response.status_code == 200, response
+        data = response.json()
+        sampleids.extend([s['sampleid'] for s in data['samples']
+                          if s['projectid'] == PROJECTID])
+        if not data['cursor']: break
+        params['cursor'] = data['cursor']
+    assert sampleids == [SAMPLEID + '_2', SAMPLEID + '_3']
+    response = session.get(url('samplesearch'),
+                           params=dict(min_coverage='nan'),
+                           headers=api_token)
+    assert response.status_code == 400, response
+    response = session.get(url('projectidsfromsampleid', SAMPLEID + '_4'),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    assert PROJECTID in response.json()
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_paged():
+    "Create samples, and list them page by page following the next links."
+    sampleids = [SAMPLEID + '_' + str(i) for i in range(5)]
+    for sampleid in sampleids:
+        data = dict(sampleid=sampleid)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    found = []
+    next_url = url('samples', PROJECTID) + '?limit=2'
+    while next_url:
+        response = session.get(next_url, headers=api_token)
+        assert response.status_code == 200, response
+        data = response.json()
+        assert len(data['samples']) <= 2
+        found.extend([s['sampleid'] for s in data['samples']])
+        links = [l['href'] for l in data['links'] if l['rel'] == 'next']
+        next_url = links and links[0] or None
+        assert bool(next_url) == bool(data['cursor'])
+    assert found == sampleids
+    response = session.get(url('samples', PROJECTID),
+                           params=dict(cursor='junk'),
+                           headers=api_token)
+    assert response.status_code == 400, response
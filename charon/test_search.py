@@ -0,0 +1,63 @@
+""" Charon: nosetests of the in-memory search index.
+Requires no server.
+"""
+
+from charon import constants
+from charon.search import SearchIndex
+
+
+def make_index():
+    "Return an index of a few projects, samples and users."
+    index = SearchIndex()
+    for doc in [dict(_id='p1', projectid='P1', name='Doe.Lab_RNA',
+                     modified='2020-01-01'),
+                dict(_id='p2', projectid='P2', name='Lab', modified='2020-02-01'),
+                dict(_id='s1', projectid='P1', sampleid='P1_101',
+                     modified='2020-03-01'),
+                dict(_id='s2', projectid='P1', sampleid='lab',
+                     modified='2020-04-01'),
+                dict(_id='u1', email='lab@example.com', name='Per Lab')]:
+        if 'sampleid' in doc:
+            doc[constants.DB_DOCTYPE] = constants.SAMPLE
+        elif 'projectid' in doc:
+            doc[constants.DB_DOCTYPE] = constants.PROJECT
+        else:
+            doc[constants.DB_DOCTYPE] = constants.USER
+        index.add(doc)
+    return index
+
+def ids(items):
+    "Return the doc ids of the items."
+    return [i['_id'] for i in items]
+
+def test_search_order():
+    "Exact matches first, then by rank, doctype and modified."
+    index = make_index()
+    assert ids(index.search(' LAB ')) == ['s2', 'p2', 'u1', 'p1']
+    assert ids(index.search('p1')) == ['p1', 's1']
+    assert ids(index.search('p')) == ['p2', 'p1', 's1', 'u1']
+    assert ids(index.search('rna')) == ['p1']
+    assert ids(index.search('lab', limit=2)) == ['s2', 'p2']
+
+def test_search_empty():
+    "No items for an empty term, a non-positive limit, or no match."
+    index = make_index()
+    assert index.search('') == []
+    assert index.search('lab', limit=0) == []
+    assert index.search('lab', limit=-1) == []
+    assert index.search('x') == []
+
+def test_search_remove():
+    "A removed or re-added document is found only by its current terms."
+    index = make_index()
+    index.remove('p2')
+    index.remove('p2')
+    assert ids(index.search('lab')) == ['s2', 'u1', 'p1']
+    index.changed(dict(id='p1', deleted=True))
+    assert ids(index.search('lab')) == ['s2', 'u1']
+    index.changed(dict(id='s2', doc={'_id': 's2', 'projectid': 'P1',
+                                     'sampleid': 'S2',
+                                     constants.DB_DOCTYPE: constants.SAMPLE}))
+    assert ids(index.search('lab')) == ['u1']
+    assert ids(index.search('s2')) == ['s2']
+    assert index.get_stats()['items'] == 3
@@ -4,6 +4,7 @@ Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
 
 import os
 import json
+import concurrent.futures
 import requests
 import nose
 
@@ -102,3 +103,49 @@ def test_delete_seqrun():
     seqrun_url= BASE_URL.rstrip('/') + response.headers['location']
     response = session.delete(seqrun_url, headers=api_token)
     assert response.status_code == 204, response.reason
+
+@nose.with_setup(my_setup, my_teardown)
+def test_sample_totals():
+    "Create two seqruns, and check the sample totals; then update one."
+    for seqrunid, cov, reads in (('1', 10.0, 1000), ('2', 20.5, 3000)):
+        data = dict(seqrunid=seqrunid, alignment_status='DONE',
+                    mean_autosomal_coverage=cov, total_reads=reads)
+        response = session.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    sample = response.json()
+    assert sample['total_autosomal_coverage'] == 30.5, sample
+    assert sample['total_sequenced_reads'] == 4000, sample
+    data = dict(alignment_status='FAILED')
+    response = session.put(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID, '2'),
+                           data=json.dumps(data),
+                           headers=api_token)
+    assert response.status_code == 204, response
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    sample = response.json()
+    assert sample['total_autosomal_coverage'] == 10.0, sample
+    assert sample['total_sequenced_reads'] == 1000, sample
+
+@nose.with_setup(my_setup, my_teardown)
+def test_sample_totals_concurrent():
+    "Create seqruns for one sample concurrently; all succeed, totals add up."
+    def create(seqrunid):
+        data = dict(seqrunid=seqrunid, alignment_status='DONE',
+                    mean_autosomal_coverage=1.0, total_reads=100)
+        return requests.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                             data=json.dumps(data),
+                             headers=api_token)
+    seqrunids = [str(i) for i in range(4)]
+    with concurrent.futures.ThreadPoolExecutor(len(seqrunids)) as executor:
+        for response in executor.map(create, seqrunids):
+            assert response.status_code == 201, response
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    sample = response.json()
+    assert sample['total_autosomal_coverage'] == 4.0, sample
+    assert sample['total_sequenced_reads'] == 400, sample
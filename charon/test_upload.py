@@ -49,6 +49,7 @@ def test_upload_project_new_samples():
                             files=files,
                             headers=api_token)
     assert response.status_code == 200, response
+    assert '3 samples added' in response.json()['messages'], response
     # Sample exists?
     response = session.get(url('sample', PROJECTID, 'S2'), headers=api_token)
     assert response.status_code == 200, response
@@ -60,3 +61,43 @@ def test_upload_project_new_samples():
                             files=files,
                             headers=api_token)
     assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_upload_project_duplicate_samples():
+    "Upload a CSV file with a sample given twice; none are added."
+    files = dict(csvfile=('new_samples.csv', "S5\nS6\nS5\n"))
+    response = session.post(url('project', PROJECTID),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 400, response
+    assert 'No samples added.' in response.json()['messages'], response
+    response = session.get(url('sample', PROJECTID, 'S5'), headers=api_token)
+    assert response.status_code == 404, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_update_project_samples():
+    "Update samples from a CSV file; a sample given twice updates none."
+    files = dict(csvfile=('new_samples.csv', NEW_SAMPLES))
+    response = session.post(url('project', PROJECTID),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 200, response
+    files = dict(csvfile=('update_samples.csv',
+                          "sampleid,analysis_status\n"
+                          "S1,ANALYZED\nS2,FAILED\nS1,FAILED\n"))
+    response = session.post(url('project', PROJECTID, 'update'),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 400, response
+    response = session.get(url('sample', PROJECTID, 'S2'), headers=api_token)
+    assert response.json().get('analysis_status') != 'FAILED', response
+    files = dict(csvfile=('update_samples.csv',
+                          "sampleid,analysis_status\n"
+                          "S1,ANALYZED\nS2,FAILED\n"))
+    response = session.post(url('project', PROJECTID, 'update'),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 200, response
+    assert '2 samples updated.' in response.json()['messages'], response
+    response = session.get(url('sample', PROJECTID, 'S2'), headers=api_token)
+    assert response.json()['analysis_status'] == 'FAILED', response
@@ -29,3 +29,12 @@ def test_version_no_header():
     "No access without header carrying API token."
     response = session.get(url('version'))
     assert response.status_code == 401
+
+def test_metrics():
+    "Access performance metrics in Prometheus text format."
+    session.get(url('version'), headers=api_token)
+    response = session.get(url('metrics'), headers=api_token)
+    assert response.status_code == requests.codes.ok
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert 'charon_requests_total{handler="api_version",status="200"}' \
+        in response.text
@@ -11,6 +11,7 @@ import requests
 from . import constants
 from . import settings
 from . import utils
+from . import cache
 from .requesthandler import RequestHandler
 from .saver import Saver
 
@@ -28,10 +29,10 @@ class Login(RequestHandler):
                     error=None,
                     next=self.get_argument('next', None))
 
-    def post(self):
+    async def post(self):
         self.check_xsrf_cookie()
         try:
-            self.authenticate_user(self.get_argument('email'),
+            await self.authenticate_user(self.get_argument('email'),
                                    self.get_argument('password'))
             url = self.get_argument('next', None)
             if not url:
@@ -43,7 +44,7 @@ class Login(RequestHandler):
                         error=str(msg),
                         next=self.get_argument('next', None))
 
-    def authenticate_user(self, email, password):
+    async def authenticate_user(self, email, password):
         """Authenticate the given email and password.
         This is done by consulting the Userman web service.
         Save or update the user in this database.
@@ -66,7 +67,7 @@ class Login(RequestHandler):
             user = response.json()
         else:
             user.update(response.json())
-        with UserSaver(doc=user, rqh=self) as saver:
+        async with UserSaver(doc=user, rqh=self) as saver:
             # All other changes already made.
             if not user.get('api_token'):
                 saver['api_token'] = utils.get_iuid()
@@ -87,21 +88,21 @@ class User(RequestHandler):
     "User account handler."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         user = self.get_user(email)
         current_user = self.get_current_user()
         privileged = current_user == user or current_user['role'] == 'admin'
         self.render('user.html',
                     user=user,
                     privileged=privileged,
-                    logs=self.get_logs(user['_id']))
+                    logs=await self.get_logs(user['_id']))
 
 
 class UserApiToken(RequestHandler):
     "API token handler for user account."
 
     @tornado.web.authenticated
-    def post(self, email):
+    async def post(self, email):
         "Set the API token for the user."
         self.check_xsrf_cookie()
         user = self.get_user(email)
@@ -109,7 +110,8 @@ class UserApiToken(RequestHandler):
         privileged = current_user == user or current_user['role'] == 'admin'
         if not privileged:
             raise tornado.web.HTTPError(403)
-        with UserSaver(doc=user, rqh=self) as saver:
+        cache.tokens.evict_user(user['_id'])
+        async with UserSaver(doc=user, rqh=self) as saver:
             saver['api_token'] = utils.get_iuid()
         self.redirect(self.reverse_url('user', user['email']))
 
@@ -118,7 +120,7 @@ class Users(RequestHandler):
     "Display all users."
 
     @tornado.web.authenticated
-    def get(self):
-        view = self.db.view('user/email')
-        users = [self.get_user(r.key) for r in view]
+    async def get(self):
+        rows = await self.async_db.view('user/email')
+        users = [self.get_user(r.key) for r in rows]
         self.render('users.html', users=users)
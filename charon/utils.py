@@ -1,12 +1,17 @@
 " Charon: Various utility functions. "
 
 import os
+import base64
+import json
 import socket
 import logging
 import urllib.parse
 import uuid
 import datetime
 import unicodedata
+import threading
+import time
+import weakref
 
 import tornado.web
 import couchdb
@@ -15,6 +20,8 @@ import yaml
 import charon
 from . import constants
 from . import settings
+from . import cache
+from . import metrics
 
 def load_settings(filepath=None):
     """Load and return the settings from the given settings file,
@@ -79,7 +86,7 @@ def load_settings(filepath=None):
     if len(settings['COOKIE_SECRET']) < 10:
         raise ValueError("settings['COOKIE_SECRET'] too short")
     # Settings computable from others
-    settings['DB_SERVER_VERSION'] = couchdb.Server(settings['DB_SERVER']).version()
+    settings['DB_SERVER_VERSION'] = get_server().version()
     if 'PORT' not in settings:
         parts = urllib.parse.urlparse(settings['BASE_URL'])
         items = parts.netloc.split(':')
@@ -93,13 +100,113 @@ def load_settings(filepath=None):
             raise ValueError('could not determine port from BASE_URL')
     return settings
 
+class ConnectionPool(couchdb.http.ConnectionPool):
+    """HTTP keep-alive connection pool for the CouchDB server.
+    At most 'maxsize' idle connections are kept per host; any further
+    released connections are closed. Records utilization statistics.
+    The connections in use are those handed out and not yet released.
+    They are held by weak reference, since couchdb.http.Session drops
+    a connection without releasing it after an error."""
+
+    def __init__(self, timeout, maxsize=10):
+        super(ConnectionPool, self).__init__(timeout)
+        self.maxsize = maxsize
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.in_use = weakref.WeakSet()
+        self.peak_in_use = 0
+
+    def get(self, url):
+        key = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            reuse = bool(self.conns.get(key))
+        conn = super(ConnectionPool, self).get(url)
+        with self.lock:
+            if reuse:
+                self.reused += 1
+            else:
+                self.created += 1
+            self.in_use.add(conn)
+            self.peak_in_use = max(self.peak_in_use, len(self.in_use))
+        return conn
+
+    def release(self, url, conn):
+        key = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            # The session may release a connection twice after an error.
+            if conn not in self.in_use: return
+            self.in_use.discard(conn)
+            idle = self.conns.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+            self.discarded += 1
+        conn.close()
+
+    def get_stats(self):
+        "Return the pool utilization statistics as a dictionary."
+        with self.lock:
+            return dict(requests=self.created + self.reused,
+                        maxsize=self.maxsize,
+                        idle=sum([len(c) for c in self.conns.values()]),
+                        in_use=len(self.in_use),
+                        peak_in_use=self.peak_in_use,
+                        created=self.created,
+                        reused=self.reused,
+                        discarded=self.discarded)
+
+
+class Session(couchdb.http.Session):
+    "HTTP session recording the CouchDB calls made for the current request."
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return super(Session, self).request(method, url, *args, **kwargs)
+        finally:
+            metrics.record_db_call(url, time.monotonic() - start)
+
+
+_servers = dict()
+_dbs = dict()
+_db_lock = threading.Lock()
+
+def get_server():
+    """Return the process-wide handle for the CouchDB server.
+    All requests go through one session with a keep-alive connection pool,
+    sized by settings['DB_POOL_SIZE']."""
+    key = settings['DB_SERVER']
+    with _db_lock:
+        try:
+            return _servers[key]
+        except KeyError:
+            session = Session(timeout=settings.get('DB_TIMEOUT'))
+            session.connection_pool = ConnectionPool(
+                settings.get('DB_TIMEOUT'),
+                maxsize=settings.get('DB_POOL_SIZE', 10))
+            server = _servers[key] = couchdb.Server(key, session=session)
+            return server
+
 def get_db():
-    "Return the handle for the CouchDB database."
+    """Return the handle for the CouchDB database.
+    The handle is created once per process, and then reused."""
+    key = (settings['DB_SERVER'], settings['DB_DATABASE'])
+    try:
+        return _dbs[key]
+    except KeyError:
+        pass
     try:
-        return couchdb.Server(settings['DB_SERVER'])[settings['DB_DATABASE']]
+        db = get_server()[settings['DB_DATABASE']]
     except couchdb.http.ResourceNotFound:
         raise KeyError("CouchDB database '%s' does not exist" %
                        settings['DB_DATABASE'])
+    with _db_lock:
+        return _dbs.setdefault(key, db)
+
+def get_db_pool_stats():
+    "Return the utilization statistics for the CouchDB connection pool."
+    return get_server().resource.session.connection_pool.get_stats()
 
 def get_versions():
     "Get version numbers for software components as list of tuples."
@@ -135,6 +242,11 @@ def to_bool(value):
 
 def log(db, doc, changed={}, current_user=None):
     "Create a log entry for the given document."
+    if changed:
+        db.save(log_entry(doc, changed=changed, current_user=current_user))
+
+def log_entry(doc, changed={}, current_user=None):
+    "Return a new log entry document for the given document."
     entry = {'_id':get_iuid(),
                 'doc':doc['_id'],
                 'doctype':doc[constants.DB_DOCTYPE],
@@ -146,8 +258,7 @@ def log(db, doc, changed={}, current_user=None):
             entry['operator'] = current_user['email']
     except KeyError:
         pass
-    if changed:
-        db.save(entry)
+    return entry
 
 def cmp_timestamp(i, j):
     "Compare the two documents by their 'timestamp' values."
@@ -165,52 +276,137 @@ def cmp(x, y):
 
     return (x > y) - (x < y)
 
+def get_range(*prefix):
+    """Return the startkey and endkey view query options for all rows
+    whose array key begins with the given values; the prefix ends at
+    the first value that is None. No options if the prefix is empty."""
+    values = []
+    for value in prefix:
+        if value is None: break
+        values.append(value)
+    if not values: return dict()
+    return dict(startkey=values, endkey=values + [constants.HIGH_CHAR])
+
+def encode_token(value):
+    "Return the JSON value encoded as an opaque URL-safe token."
+    return base64.urlsafe_b64encode(
+        json.dumps(value).encode('utf-8')).decode('ascii')
+
+def decode_token(token):
+    """Return the JSON value from the opaque token.
+    Raise ValueError if the token is invalid."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('invalid token')
+
+def encode_cursor(key, docid):
+    "Return the opaque cursor for the position of a view row."
+    return encode_token([key, docid])
+
+def decode_cursor(cursor):
+    """Return the view row key and doc id from the cursor.
+    Raise ValueError if the cursor is invalid."""
+    try:
+        key, docid = decode_token(cursor)
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(docid, str):
+        raise ValueError('invalid cursor')
+    return key, docid
+
+# Identifier keys, and the dependent entities with their identifier view.
+_ENTITY_KEYS = {constants.PROJECT: ['projectid'],
+                constants.SAMPLE: ['projectid', 'sampleid'],
+                constants.LIBPREP: ['projectid', 'sampleid', 'libprepid'],
+                constants.SEQRUN: ['projectid', 'sampleid', 'libprepid',
+                                   'seqrunid']}
+_DEPENDENTS = {constants.PROJECT: [(constants.SAMPLE, 'sample/sampleid'),
+                                   (constants.LIBPREP, 'libprep/libprepid'),
+                                   (constants.SEQRUN, 'seqrun/seqrunid')],
+               constants.SAMPLE: [(constants.LIBPREP, 'libprep/libprepid'),
+                                  (constants.SEQRUN, 'seqrun/seqrunid')],
+               constants.LIBPREP: [(constants.SEQRUN, 'seqrun/seqrunid')],
+               constants.SEQRUN: []}
+
+def plan_delete(db, doc, batch_size=1000):
+    """Collect the id and revision of the entity, all its dependent
+    entities, and all their log entries, using one range query per
+    dependent entity type, and batched 'log/doc' and '_all_docs' queries.
+    Return a dictionary with doctype keys, and lists of dict(_id, _rev)."""
+    doctype = doc[constants.DB_DOCTYPE]
+    prefix = [doc[k] for k in _ENTITY_KEYS[doctype]]
+    ids = {doctype: [doc['_id']]}
+    for dependent, viewname in _DEPENDENTS[doctype]:
+        view = db.view(viewname,
+                       startkey=prefix,
+                       endkey=prefix + [constants.HIGH_CHAR])
+        ids[dependent] = [r.id for r in view]
+    entityids = sum(ids.values(), [])
+    ids[constants.LOG] = []
+    for pos in range(0, len(entityids), batch_size):
+        view = db.view('log/doc', keys=entityids[pos:pos+batch_size])
+        ids[constants.LOG].extend([r.id for r in view])
+    result = dict()
+    for doctype, docids in ids.items():
+        result[doctype] = []
+        for pos in range(0, len(docids), batch_size):
+            view = db.view('_all_docs', keys=docids[pos:pos+batch_size])
+            for row in view:
+                if row.id is None or row.value.get('deleted'): continue
+                result[doctype].append(dict(_id=row.id, _rev=row.value['rev']))
+    return result
+
+def delete_planned(db, plan, batch_size=1000):
+    """Delete the documents in the plan from plan_delete, using batched
+    '_bulk_docs' requests. Return the number of documents deleted.
+    The deletion stubs keep the doctype, for filtering the changes feed.
+    Raise IOError if any document could not be deleted."""
+    docs = [{'_id': d['_id'], '_rev': d['_rev'], '_deleted': True,
+             constants.DB_DOCTYPE: doctype}
+            for doctype, planned in plan.items() for d in planned]
+    count = 0
+    failed = []
+    for pos in range(0, len(docs), batch_size):
+        try:
+            for success, id, rev in db.update(docs[pos:pos+batch_size]):
+                if success:
+                    count += 1
+                else:
+                    failed.append(id)
+        finally:
+            for doc in docs[pos:pos+batch_size]:
+                cache.documents.evict(doc['_id'])
+    if failed:
+        raise IOError("could not delete {0} documents, e.g. {1}".format(
+            len(failed), failed[0]))
+    return count
+
 def delete_project(db, project):
     "Delete the project and all its dependent entities."
-    startkey = (project['projectid'], '')
-    endkey = (project['projectid'], constants.HIGH_CHAR)
-    view = db.view('sample/sampleid', include_docs=True)
-    samples = [r.doc for r in view[startkey:endkey]]
-    for sample in samples:
-        delete_sample(db, sample)
-    delete_logs(db, project['_id'])
-    del db[project['_id']]
+    delete_planned(db, plan_delete(db, project))
 
 def delete_sample(db, sample):
     "Delete the sample and all its dependent entities."
-    delete_logs(db, sample['_id'])
-    startkey = (sample['projectid'], sample['sampleid'], '')
-    endkey = (sample['projectid'], sample['sampleid'], constants.HIGH_CHAR)
-    view = db.view('libprep/libprepid', include_docs=True)
-    libpreps = [r.doc for r in view[startkey:endkey]]
-    for libprep in libpreps:
-        delete_libprep(db, libprep)
-    del db[sample['_id']]
+    delete_planned(db, plan_delete(db, sample))
 
 def delete_libprep(db, libprep):
     "Delete the libprep and all its dependent entities."
-    delete_logs(db, libprep['_id'])
-    startkey = (libprep['projectid'], libprep['sampleid'],
-                libprep['libprepid'], '')
-    endkey = (libprep['projectid'], libprep['sampleid'],
-              libprep['libprepid'], constants.HIGH_CHAR)
-    view = db.view('seqrun/seqrunid', include_docs=True)
-    seqruns = [r.doc for r in view[startkey:endkey]]
-    for seqrun in seqruns:
-        delete_seqrun(db, seqrun)
-    logging.debug("deleting libprep %s", startkey)
-    del db[libprep['_id']]
+    delete_planned(db, plan_delete(db, libprep))
 
 def delete_seqrun(db, seqrun):
     "Delete the seqrun and all its dependent entities."
-    delete_logs(db, seqrun['_id'])
-    del db[seqrun['_id']]
+    delete_planned(db, plan_delete(db, seqrun))
 
 def delete_logs(db, id):
     "Delete the log documents for the given doc id."
-    ids = [r.id for r in db.view('log/doc')[id]]
-    for id in ids:
-        del db[id]
+    docs = [dict(_id=r.id, _rev=r.value['rev'], _deleted=True)
+            for r in db.view('_all_docs',
+                             keys=[r.id for r in db.view('log/doc')[id]])
+            if r.id is not None]
+    if docs:
+        db.update(docs)
 
 class QueueHandler(logging.Handler):
     """